@@ -1,9 +1,10 @@
+import os
 from abc import ABC, abstractmethod
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Literal, Optional
 
 from fastapi import APIRouter, Depends, Request
-from pydantic import Field
+from pydantic import Field, field_validator
 
 from jupyverse_api import Config, Router
 
@@ -26,9 +27,10 @@ class Kernels(Router, ABC):
 
         @router.get("/api/kernelspecs")
         async def get_kernelspecs(
+            request: Request,
             user: User = Depends(auth.current_user(permissions={"kernelspecs": ["read"]})),
         ):
-            return await self.get_kernelspecs(user)
+            return await self.get_kernelspecs(request, user)
 
         @router.get("/kernelspecs/{kernel_name}/{file_name}")
         async def get_kernelspec(
@@ -97,6 +99,29 @@ class Kernels(Router, ABC):
         ):
             return await self.execute_cell(request, kernel_id, user)
 
+        @router.get("/api/kernels/{kernel_id}/execution")
+        async def get_execution_queue(
+            kernel_id,
+            user: User = Depends(auth.current_user(permissions={"kernels": ["read"]})),
+        ):
+            return await self.get_execution_queue(kernel_id, user)
+
+        @router.post("/api/kernels/{kernel_id}/execution")
+        async def execute_cells(
+            request: Request,
+            kernel_id,
+            user: User = Depends(auth.current_user(permissions={"kernels": ["write"]})),
+        ):
+            return await self.execute_cells(request, kernel_id, user)
+
+        @router.post("/api/kernels/{kernel_id}/execution/cancel")
+        async def cancel_execution(
+            request: Request,
+            kernel_id,
+            user: User = Depends(auth.current_user(permissions={"kernels": ["write"]})),
+        ):
+            return await self.cancel_execution(request, kernel_id, user)
+
         @router.get("/api/kernels/{kernel_id}")
         async def get_kernel(
             kernel_id,
@@ -137,6 +162,7 @@ class Kernels(Router, ABC):
     @abstractmethod
     async def get_kernelspecs(
         self,
+        request: Request,
         user: User,
     ):
         ...
@@ -213,6 +239,32 @@ class Kernels(Router, ABC):
     ):
         ...
 
+    @abstractmethod
+    async def get_execution_queue(
+        self,
+        kernel_id,
+        user: User,
+    ):
+        ...
+
+    @abstractmethod
+    async def execute_cells(
+        self,
+        request: Request,
+        kernel_id,
+        user: User,
+    ):
+        ...
+
+    @abstractmethod
+    async def cancel_execution(
+        self,
+        request: Request,
+        kernel_id,
+        user: User,
+    ):
+        ...
+
     @abstractmethod
     async def get_kernel(
         self,
@@ -257,3 +309,162 @@ class KernelsConfig(Config):
         default=None,
     )
     require_yjs: bool = False
+    session_queue_size: int = Field(
+        description=(
+            "The maximum number of kernel messages queued for a session's websocket, so that a "
+            "slow client doesn't block the other sessions of a kernel."
+        ),
+        default=1024,
+    )
+    session_queue_overflow: Literal["drop", "disconnect"] = Field(
+        description=(
+            'What to do when a session\'s queue is full: "drop" the message, or "disconnect" '
+            "the session. The client will reconnect. Only IOPub messages are dropped, a session "
+            "that cannot receive a reply is always disconnected."
+        ),
+        default="disconnect",
+    )
+    iopub_msg_rate_limit: Optional[float] = Field(
+        description=(
+            "The maximum rate of output messages per second sent by a kernel on IOPub, averaged "
+            "over iopub_rate_limit_window. Above it, output is throttled and the clients are "
+            "notified. None for no limit."
+        ),
+        default=1000,
+    )
+    iopub_data_rate_limit: Optional[float] = Field(
+        description=(
+            "The maximum rate of output bytes per second sent by a kernel on IOPub, averaged "
+            "over iopub_rate_limit_window. Above it, output is throttled and the clients are "
+            "notified. None for no limit."
+        ),
+        default=1_000_000,
+    )
+    iopub_rate_limit_window: float = Field(
+        description="The duration in seconds over which the IOPub rates are averaged.",
+        default=3,
+    )
+    iopub_replay_buffer_size: int = Field(
+        description=(
+            "The number of recent IOPub messages kept per kernel, which are replayed to a session "
+            "that reconnects with the same session ID. 0 to disable replay."
+        ),
+        default=1024,
+    )
+    iopub_replay_buffer_max_bytes: int = Field(
+        description=(
+            "The maximum total size in bytes of the IOPub messages kept per kernel for replay. "
+            "The oldest messages are dropped first."
+        ),
+        default=16 * 1024 * 1024,
+    )
+    kernel_pool_size: int = Field(
+        description=(
+            "The number of ready kernels kept per pooled kernelspec, so that a new session "
+            "attaches to an already running kernel. 0 to disable the kernel pool."
+        ),
+        default=0,
+    )
+    pooled_kernels: Optional[List[str]] = Field(
+        description=(
+            "The names of the Python kernelspecs to keep ready kernels for. Defaults to the "
+            "default kernel."
+        ),
+        default=None,
+    )
+    kernel_launcher: Literal["subprocess", "forkserver"] = Field(
+        description=(
+            'How Python kernels are launched: "subprocess" starts a new interpreter for each '
+            'kernel, "forkserver" forks them from a template process which has already imported '
+            "forkserver_preload, which is not supported on Windows. Kernels of other languages are "
+            "always launched as subprocesses."
+        ),
+        default="subprocess",
+    )
+    forkserver_preload: List[str] = Field(
+        description=(
+            'The modules imported once by the template process of the "forkserver" kernel '
+            "launcher, e.g. numpy."
+        ),
+        default=["ipykernel.kernelapp"],
+    )
+    heartbeat_interval: float = Field(
+        description=(
+            "The interval in seconds between the heartbeats sent to each kernel. A kernel that "
+            'doesn\'t reply within this interval is reported with the "unknown" execution state. '
+            "0 to disable heartbeats."
+        ),
+        default=3,
+    )
+    kernel_auto_restart: bool = Field(
+        description=(
+            "Whether to restart a kernel whose process died. A kernel that is not restarted is "
+            'reported with the "dead" execution state.'
+        ),
+        default=True,
+    )
+    kernel_restart_limit: int = Field(
+        description=(
+            "The maximum number of consecutive automatic restarts of a kernel that dies before "
+            "it is ready."
+        ),
+        default=5,
+    )
+    execution_pipeline_depth: int = Field(
+        description=(
+            "The maximum number of cells of a server-side execution queue that are sent to the "
+            "kernel at once, so that the kernel doesn't wait for the server between cells. The "
+            "other cells are queued in the server, where they can be cancelled. Pipelining only "
+            "happens within a batch of cells requested together: a batch is not sent to the "
+            "kernel while a previous batch that stops on error is running."
+        ),
+        default=2,
+    )
+    kernel_transport: Literal["tcp", "ipc"] = Field(
+        description=(
+            'The transport of the channels of the kernels launched by the server: "tcp" on '
+            'the local interface, or "ipc" for Unix domain sockets in the runtime directory, '
+            "which don't need to allocate ports and are not supported on Windows."
+        ),
+        default="tcp",
+    )
+    kernel_shutdown_timeout: float = Field(
+        description=(
+            "The time in seconds given to a kernel to shut down when it is restarted, before it "
+            "is terminated."
+        ),
+        default=5,
+    )
+    cull_idle_timeout: float = Field(
+        description=(
+            "The time in seconds after which an idle kernel is shut down. A kernel is idle when "
+            "it hasn't reported any activity. 0 to disable culling."
+        ),
+        default=0,
+    )
+    cull_interval: float = Field(
+        description="The interval in seconds between checks for idle kernels.",
+        default=300,
+    )
+    cull_connected: bool = Field(
+        description="Whether to cull idle kernels that still have clients connected.",
+        default=False,
+    )
+    cull_busy: bool = Field(
+        description="Whether to cull kernels that are busy, e.g. running a long computation.",
+        default=False,
+    )
+
+    @field_validator("kernel_launcher")
+    @classmethod
+    def check_kernel_launcher(cls, kernel_launcher: str) -> str:
+        if kernel_launcher == "forkserver" and os.name == "nt":
+            raise ValueError('The "forkserver" kernel launcher is not supported on Windows')
+        return kernel_launcher
+
+    @field_validator("kernel_transport")
+    @classmethod
+    def check_kernel_transport(cls, kernel_transport: str) -> str:
+        if kernel_transport == "ipc" and os.name == "nt":
+            raise ValueError('The "ipc" kernel transport is not supported on Windows')
+        return kernel_transport
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 
 from pydantic import BaseModel
 
@@ -40,3 +40,18 @@ class Session(BaseModel):
 class Execution(BaseModel):
     document_id: str
     cell_id: str
+
+
+class BatchExecution(BaseModel):
+    document_id: str
+    cell_ids: List[str]
+    stop_on_error: bool = True
+
+
+class CancelExecution(BaseModel):
+    cell_ids: Optional[List[str]] = None
+
+
+class ExecutionQueueStatus(BaseModel):
+    running: List[Execution]
+    queued: List[Execution]
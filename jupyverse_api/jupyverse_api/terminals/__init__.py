@@ -1,9 +1,11 @@
 from abc import ABC, abstractmethod
+from datetime import datetime
 from typing import List
 
 from fastapi import APIRouter, Depends
+from pydantic import Field
 
-from jupyverse_api import Router
+from jupyverse_api import Config, Router
 
 from ..app import App
 from ..auth import Auth, User
@@ -78,10 +80,31 @@ class Terminals(Router, ABC):
 
 
 class TerminalServer(ABC):
+    # the time of the last input or output of the terminal
+    last_activity: datetime
+
     @abstractmethod
     async def serve(self, websocket, permissions):
         ...
 
     @abstractmethod
-    def quit(self, websocket):
+    def quit(self, websocket=None):
         ...
+
+
+class TerminalsConfig(Config):
+    cull_inactive_timeout: float = Field(
+        description=(
+            "The time in seconds after which a terminal without input or output is closed. "
+            "0 to disable culling."
+        ),
+        default=0,
+    )
+    cull_interval: float = Field(
+        description="The interval in seconds between checks for inactive terminals.",
+        default=300,
+    )
+    cull_connected: bool = Field(
+        description="Whether to cull inactive terminals that still have clients connected.",
+        default=False,
+    )
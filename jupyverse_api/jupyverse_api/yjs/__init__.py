@@ -1,7 +1,8 @@
 from abc import ABC, abstractmethod
-from typing import Any
+from typing import Any, List, Literal, Optional
 
 from fastapi import APIRouter, Depends, Request, Response
+from pydantic import Field
 
 from jupyverse_api import Config, Router
 
@@ -11,6 +12,7 @@ from ..auth import Auth, User
 
 class Yjs(Router, ABC):
     websocket_server: Any
+    output_store: Any
 
     def __init__(self, app: App, auth: Auth):
         super().__init__(app=app)
@@ -35,6 +37,19 @@ class Yjs(Router, ABC):
         ):
             return await self.create_roomid(path, request, response, user)
 
+        @router.get("/api/collaboration/outputs/{output_id}")
+        async def get_output(
+            output_id: str,
+            user: User = Depends(auth.current_user(permissions={"yjs": ["read"]})),
+        ):
+            return await self.get_output(output_id, user)
+
+        @router.get("/api/collaboration/metrics")
+        async def get_room_metrics(
+            user: User = Depends(auth.current_user(permissions={"yjs": ["read"]})),
+        ):
+            return await self.get_room_metrics(user)
+
         self.include_router(router)
 
     @abstractmethod
@@ -55,6 +70,21 @@ class Yjs(Router, ABC):
     ):
         ...
 
+    @abstractmethod
+    async def get_output(
+        self,
+        output_id: str,
+        user: User,
+    ):
+        ...
+
+    @abstractmethod
+    async def get_room_metrics(
+        self,
+        user: User,
+    ):
+        ...
+
     @abstractmethod
     def get_document(
         self,
@@ -66,3 +96,94 @@ class Yjs(Router, ABC):
 class YjsConfig(Config):
     document_cleanup_delay: float = 60
     document_save_delay: float = 1
+    view_update_delay: float = Field(
+        description=(
+            "The delay in seconds of inactivity after which the changes made in an alternate "
+            "view of a file (e.g. the text view of a notebook) are applied to the authoritative "
+            "document of the file."
+        ),
+        default=1,
+    )
+    output_store_threshold: Optional[int] = Field(
+        description=(
+            "The size in bytes above which a cell output is stored out-of-band and referenced "
+            "from the shared document, instead of living in it. This applies to the outputs "
+            "written by kernels and clients, and to the notebooks opened from disk. A reference "
+            "has the application/vnd.jupyverse.output-ref+json mimetype, and its output is "
+            "fetched lazily through /api/collaboration/outputs/{output_id}. Outputs are inlined "
+            "when the notebook is saved. Defaults to None, i.e. all outputs live in the shared "
+            "document."
+        ),
+        default=None,
+    )
+    output_store_path: str = Field(
+        description="The directory where out-of-band outputs are stored.",
+        default=".jupyter_outputs",
+    )
+    viewer_update_interval: float = Field(
+        description=(
+            "The interval in seconds at which document updates are batched and sent to "
+            "read-only clients."
+        ),
+        default=0.1,
+    )
+    client_max_message_size: Optional[int] = Field(
+        description=(
+            "The maximum size in bytes of a message received from a collaboration client. "
+            "Defaults to None, i.e. no limit."
+        ),
+        default=None,
+    )
+    client_max_messages_per_second: Optional[float] = Field(
+        description=(
+            "The maximum sustained rate of messages received from a collaboration client, "
+            "allowing bursts of up to one second's worth. Defaults to None, i.e. no limit."
+        ),
+        default=None,
+    )
+    client_max_bytes_per_second: Optional[float] = Field(
+        description=(
+            "The maximum sustained rate of bytes received from a collaboration client, "
+            "allowing bursts of up to one second's worth. Defaults to None, i.e. no limit."
+        ),
+        default=None,
+    )
+    client_limit_action: Literal["drop", "disconnect"] = Field(
+        description=(
+            'What to do when a collaboration client exceeds a limit: "drop" the message, '
+            'or "disconnect" the client.'
+        ),
+        default="drop",
+    )
+    shard_urls: List[str] = Field(
+        description=(
+            "The base URLs of the jupyverse instances sharing the collaboration rooms, e.g. "
+            "several processes on the same machine. Each room is owned by one instance, chosen "
+            "by a stable hash of its ID, which serves it, persists its updates and saves its "
+            "file, and connections received by other instances are proxied to it. All instances "
+            "must share the same root directory and file ID database. Defaults to an empty list, "
+            "i.e. no sharding."
+        ),
+        default=[],
+    )
+    shard_index: int = Field(
+        description="The index of this instance in shard_urls.",
+        default=0,
+    )
+    replication_url: Optional[str] = Field(
+        description=(
+            "The base URL of a primary jupyverse instance from which rooms are replicated, "
+            "with an optional query string (e.g. ?token=...). Replicated rooms are kept in sync "
+            "with the primary, and served read-only without loading or saving files. "
+            "Defaults to None, i.e. no replication."
+        ),
+        default=None,
+    )
+    replicated_rooms: List[str] = Field(
+        description=(
+            "The IDs of the rooms to replicate from the primary instance, as glob patterns "
+            "(e.g. json:notebook:*). Rooms given without wildcards are replicated as soon as "
+            "this instance starts, the other ones when a client first joins them."
+        ),
+        default=[],
+    )
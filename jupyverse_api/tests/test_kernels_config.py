@@ -0,0 +1,25 @@
+import os
+
+import pytest
+from jupyverse_api.kernels import KernelsConfig
+from pydantic import ValidationError
+
+
+def test_kernel_launcher(monkeypatch):
+    assert KernelsConfig(kernel_launcher="forkserver").kernel_launcher == "forkserver"
+    with pytest.raises(ValidationError):
+        KernelsConfig(kernel_launcher="spawn")
+    monkeypatch.setattr(os, "name", "nt")
+    assert KernelsConfig(kernel_launcher="subprocess").kernel_launcher == "subprocess"
+    with pytest.raises(ValidationError):
+        KernelsConfig(kernel_launcher="forkserver")
+
+
+def test_kernel_transport(monkeypatch):
+    assert KernelsConfig(kernel_transport="ipc").kernel_transport == "ipc"
+    with pytest.raises(ValidationError):
+        KernelsConfig(kernel_transport="inproc")
+    monkeypatch.setattr(os, "name", "nt")
+    assert KernelsConfig(kernel_transport="tcp").kernel_transport == "tcp"
+    with pytest.raises(ValidationError):
+        KernelsConfig(kernel_transport="ipc")
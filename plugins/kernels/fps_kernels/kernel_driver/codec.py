@@ -0,0 +1,42 @@
+import json
+from typing import Any, Union
+
+# the JSON codec of kernel messages: orjson if it is installed, the standard library otherwise
+# what orjson doesn't support (e.g. integers larger than 64 bits, or decoding NaN) falls back to
+# the standard library
+try:
+    import orjson
+
+    orjson_installed = True
+except ImportError:
+    orjson_installed = False
+
+
+def json_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def json_loads(s: Union[bytes, memoryview, str]) -> Any:
+    if isinstance(s, memoryview):
+        s = s.tobytes()
+    return json.loads(s)
+
+
+if orjson_installed:
+
+    def dumps(obj: Any) -> bytes:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            return json_dumps(obj)
+
+    def loads(s: Union[bytes, memoryview, str]) -> Any:
+        # orjson reads memoryviews without copying them
+        try:
+            return orjson.loads(s)
+        except ValueError:
+            return json_loads(s)
+
+else:
+    dumps = json_dumps
+    loads = json_loads
@@ -7,13 +7,17 @@ import subprocess
 import sys
 import tempfile
 import uuid
-from typing import Dict, Optional, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union, cast
 
 import zmq
 from anyio import open_process
 from anyio.abc import Process
 from zmq.asyncio import Socket
 
+from .paths import jupyter_runtime_dir
+
+channels = ["shell", "iopub", "stdin", "control", "hb"]
+
 channel_socket_types = {
     "hb": zmq.REQ,
     "shell": zmq.DEALER,
@@ -36,6 +40,12 @@ def get_port(ip: str) -> int:
     return port
 
 
+def get_ipc_path(ip: str, port: Union[str, int]) -> str:
+    # the IPC transport uses the IP as the prefix of the paths of the Unix domain sockets,
+    # and the ports as their suffixes
+    return f"{ip}-{port}"
+
+
 def write_connection_file(
     fname: str = "",
     ip: str = "",
@@ -43,16 +53,29 @@ def write_connection_file(
     signature_scheme: str = "hmac-sha256",
     kernel_name: str = "",
 ) -> Tuple[str, cfg_t]:
-    ip = ip or "127.0.0.1"
-
     if not fname:
         fd, fname = tempfile.mkstemp(suffix=".json")
         os.close(fd)
     f = open(fname, "wt")
 
-    channels = ["shell", "iopub", "stdin", "control", "hb"]
-
-    cfg: cfg_t = {f"{c}_port": get_port(ip) for c in channels}
+    cfg: cfg_t
+    if transport == "ipc":
+        # no port is allocated, the sockets are files in the runtime directory
+        if not ip:
+            runtime_dir = jupyter_runtime_dir()
+            os.makedirs(runtime_dir, exist_ok=True)
+            # the path of a Unix domain socket is limited to about 100 characters
+            ip = os.path.join(runtime_dir, f"kernel-{uuid.uuid4().hex[:8]}")
+        cfg = {}
+        port = 0
+        for c in channels:
+            port += 1
+            while os.path.exists(get_ipc_path(ip, port)):
+                port += 1
+            cfg[f"{c}_port"] = port
+    else:
+        ip = ip or "127.0.0.1"
+        cfg = {f"{c}_port": get_port(ip) for c in channels}
 
     cfg["ip"] = ip
     cfg["key"] = uuid.uuid4().hex
@@ -73,9 +96,18 @@ def read_connection_file(fname: str) -> cfg_t:
     return cfg
 
 
-async def launch_kernel(
-    kernelspec_path: str, connection_file_path: str, kernel_cwd: str | None, capture_output: bool
-) -> Process:
+def remove_ipc_files(cfg: cfg_t) -> None:
+    # the Unix domain sockets of a kernel that didn't exit cleanly are left behind
+    if cfg.get("transport") != "ipc":
+        return
+    for c in channels:
+        try:
+            os.remove(get_ipc_path(cast(str, cfg["ip"]), cfg[f"{c}_port"]))
+        except OSError:
+            pass
+
+
+def get_kernel_command(kernelspec_path: str, connection_file_path: str) -> List[str]:
     with open(kernelspec_path) as f:
         kernelspec = json.load(f)
     cmd = [s.format(connection_file=connection_file_path) for s in kernelspec["argv"]]
@@ -85,6 +117,13 @@ async def launch_kernel(
         "python%i.%i" % sys.version_info[:2],
     }:
         cmd[0] = sys.executable
+    return cmd
+
+
+async def launch_kernel(
+    kernelspec_path: str, connection_file_path: str, kernel_cwd: str | None, capture_output: bool
+) -> Process:
+    cmd = get_kernel_command(kernelspec_path, connection_file_path)
     if capture_output:
         stdout = subprocess.DEVNULL
         stderr = subprocess.STDOUT
@@ -98,9 +137,12 @@ async def launch_kernel(
 
 
 def create_socket(channel: str, cfg: cfg_t, identity: Optional[bytes] = None) -> Socket:
-    ip = cfg["ip"]
+    ip = cast(str, cfg["ip"])
     port = cfg[f"{channel}_port"]
-    url = f"tcp://{ip}:{port}"
+    if cfg.get("transport") == "ipc":
+        url = f"ipc://{get_ipc_path(ip, port)}"
+    else:
+        url = f"tcp://{ip}:{port}"
     socket_type = channel_socket_types[channel]
     sock = context.socket(socket_type)
     sock.linger = 1000  # set linger to 1s to prevent hangs at exit
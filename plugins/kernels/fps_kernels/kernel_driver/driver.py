@@ -1,9 +1,12 @@
+from __future__ import annotations
+
 import os
 import time
 import uuid
-from typing import Any, Dict, Optional, cast
+from typing import TYPE_CHECKING, Any, Dict, Optional, Set, cast
 
 import anyio
+import structlog
 from anyio import (
     TASK_STATUS_IGNORED,
     Event,
@@ -12,15 +15,37 @@ from anyio import (
     fail_after,
 )
 from anyio.abc import TaskGroup, TaskStatus
+from anyio.streams.memory import MemoryObjectReceiveStream
 from anyio.streams.stapled import StapledObjectStream
 from pycrdt import Array, Map
 
 from jupyverse_api.yjs import Yjs
 
-from .connect import cfg_t, connect_channel, launch_kernel, read_connection_file
+from .connect import (
+    cfg_t,
+    connect_channel,
+    launch_kernel,
+    read_connection_file,
+    remove_ipc_files,
+)
 from .connect import write_connection_file as _write_connection_file
+from .execution import ExecutionQueue
+from .iopub import (
+    MAX_COALESCED_MESSAGES,
+    OUTPUT_MSG_TYPES,
+    IOPubRateLimiter,
+    coalesce_stream_messages,
+)
 from .kernelspec import find_kernelspec
-from .message import create_message, receive_message, send_message
+from .lifecycle import wait_for_ready
+from .message import create_message, deserialize, pack, receive_message, send_message
+
+if TYPE_CHECKING:
+    from ..kernel_server.message import KernelMessage
+    from ..kernel_server.server import KernelServer
+
+
+logger = structlog.get_logger()
 
 
 def deadline_to_timeout(deadline: float) -> float:
@@ -39,6 +64,11 @@ class KernelDriver:
         write_connection_file: bool = True,
         capture_kernel_output: bool = True,
         yjs: Optional[Yjs] = None,
+        iopub_msg_rate_limit: Optional[float] = None,
+        iopub_data_rate_limit: Optional[float] = None,
+        iopub_rate_limit_window: float = 3,
+        transport: str = "tcp",
+        execution_pipeline_depth: int = 2,
     ) -> None:
         self.write_connection_file = write_connection_file
         self.capture_kernel_output = capture_kernel_output
@@ -48,7 +78,9 @@ class KernelDriver:
         if not self.kernelspec_path:
             raise RuntimeError("Could not find a kernel, maybe you forgot to install one?")
         if write_connection_file:
-            self.connection_file_path, self.connection_cfg = _write_connection_file(connection_file)
+            self.connection_file_path, self.connection_cfg = _write_connection_file(
+                connection_file, transport=transport
+            )
         else:
             self.connection_file_path = connection_file
             self.connection_cfg = read_connection_file(connection_file)
@@ -59,7 +91,15 @@ class KernelDriver:
         self.comm_messages: StapledObjectStream = StapledObjectStream(
             *create_memory_object_stream[dict](max_buffer_size=1024)
         )
+        self.comm_ids: Set[str] = set()
+        self.widget_rooms: Dict[str, str] = {}  # a dictionary of comm_id:room_name
+        self.iopub_rate_limiter = IOPubRateLimiter(
+            iopub_msg_rate_limit, iopub_data_rate_limit, iopub_rate_limit_window
+        )
+        self.execution_queue = ExecutionQueue(self, execution_pipeline_depth)
         self.stopped_event = Event()
+        # the kernel server whose channels are shared, if any
+        self.kernel_server: Optional[KernelServer] = None
 
     async def restart(self, startup_timeout: float = float("inf")) -> None:
         self.task_group.cancel_scope.cancel()
@@ -68,11 +108,11 @@ class KernelDriver:
         async with create_task_group() as tg:
             self.task_group = tg
             msg = create_message("shutdown_request", content={"restart": True})
-            await send_message(msg, self.control_channel, self.key, change_date_to_str=True)
+            await send_message(msg, self.control_channel, self.key)
             while True:
                 msg = cast(
                     Dict[str, Any],
-                    await receive_message(self.control_channel, change_str_to_date=True),
+                    await receive_message(self.control_channel),
                 )
                 if msg["msg_type"] == "shutdown_reply" and msg["content"]["restart"]:
                     break
@@ -106,6 +146,49 @@ class KernelDriver:
         self.listen_channels()
         self.task_group.start_soon(self._handle_comms)
 
+    async def attach(
+        self, kernel_server: KernelServer, *, task_status: TaskStatus[None] = TASK_STATUS_IGNORED
+    ) -> None:
+        """Share the channels of a kernel server which is connected to the kernel, instead of
+        launching a kernel or connecting to it: the server dispatches the messages for this
+        driver, so that they are not received and parsed twice.
+        """
+        try:
+            async with create_task_group() as tg:
+                self.task_group = tg
+                self.kernel_server = kernel_server
+                self.shell_channel = kernel_server.shell_channel
+                self.control_channel = kernel_server.control_channel
+                messages = kernel_server.subscribe(
+                    self.session_id, comm_messages=self.handles_comms
+                )
+                tg.start_soon(self.listen_server, messages)
+                tg.start_soon(self._handle_comms)
+                tg.start_soon(self.execution_queue.run)
+                task_status.started()
+        finally:
+            kernel_server.unsubscribe(self.session_id)
+            for comm_id in list(self.comm_ids):
+                self._close_comm(comm_id)
+            self.stopped_event.set()
+
+    async def listen_server(self, messages: MemoryObjectReceiveStream[KernelMessage]) -> None:
+        async with messages:
+            async for message in messages:
+                msg = deserialize(message.parts, parent_header=message.parent_header)
+                if message.channel_name == "iopub":
+                    await self._dispatch_iopub(msg)
+                elif message.channel_name == "shell":
+                    await self._dispatch_shell(msg)
+        # the kernel server unsubscribed this driver, which cannot receive replies anymore
+        logger.warning("Kernel driver unsubscribed, stopping it", session_id=self.session_id)
+        self.task_group.cancel_scope.cancel()
+
+    @property
+    def handles_comms(self) -> bool:
+        """Whether the comm messages of the kernel are handled, for collaborative widgets."""
+        return self.yjs is not None and self.yjs.widgets is not None  # type: ignore
+
     def connect_channels(self, connection_cfg: Optional[cfg_t] = None):
         connection_cfg = connection_cfg or self.connection_cfg
         self.shell_channel = connect_channel("shell", connection_cfg)
@@ -115,8 +198,17 @@ class KernelDriver:
     def listen_channels(self):
         self.task_group.start_soon(self.listen_iopub)
         self.task_group.start_soon(self.listen_shell)
+        self.task_group.start_soon(self.execution_queue.run)
 
     async def stop(self) -> None:
+        # the widgets of this kernel are gone, so are their rooms
+        for comm_id in list(self.comm_ids):
+            self._close_comm(comm_id)
+        if self.kernel_server is not None:
+            # the kernel belongs to the server
+            self.kernel_server.unsubscribe(self.session_id)
+            self.task_group.cancel_scope.cancel()
+            return
         try:
             self.kernel_process.terminate()
         except ProcessLookupError:
@@ -129,22 +221,56 @@ class KernelDriver:
                 await path.unlink()
             except Exception:
                 pass
+            remove_ipc_files(self.connection_cfg)
 
     async def listen_iopub(self):
         while True:
-            msg = await receive_message(self.iopub_channel, change_str_to_date=True)
-            parent_id = msg["parent_header"].get("msg_id")
-            if msg["msg_type"] in ("comm_open", "comm_msg"):
+            msgs = [await receive_message(self.iopub_channel)]
+            # the messages that are already pending are received at once,
+            # so that consecutive stream messages are appended to the outputs as one
+            while len(msgs) < MAX_COALESCED_MESSAGES:
+                msg = await receive_message(self.iopub_channel, timeout=0)
+                if msg is None:
+                    break
+                msgs.append(msg)
+            for msg in coalesce_stream_messages(msgs):
+                await self._dispatch_iopub(msg)
+
+    async def _dispatch_iopub(self, msg: Dict[str, Any]) -> None:
+        parent_id = msg["parent_header"].get("msg_id")
+        if msg["msg_type"] in ("comm_open", "comm_msg", "comm_close"):
+            # comm messages that are not handled would fill the stream
+            if self.handles_comms:
                 await self.comm_messages.send(msg)
-            elif parent_id in self.execute_requests.keys():
-                await self.execute_requests[parent_id]["iopub_msg"].send(msg)
+        elif parent_id in self.execute_requests.keys():
+            limited_msg = self._limit_iopub_rate(msg)
+            if limited_msg is not None:
+                await self.execute_requests[parent_id]["iopub_msg"].send(limited_msg)
+
+    def _limit_iopub_rate(self, msg: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        rate_limiter = self.iopub_rate_limiter
+        if not rate_limiter.enabled or msg["msg_type"] not in OUTPUT_MSG_TYPES:
+            return msg
+        action = rate_limiter.limit(len(pack(msg["content"])))
+        if action == "drop":
+            return None
+        if action == "notify":
+            notice = create_message(
+                "stream", content={"name": "stderr", "text": rate_limiter.notice}
+            )
+            notice["parent_header"] = msg["parent_header"]
+            return notice
+        return msg
 
     async def listen_shell(self):
         while True:
-            msg = await receive_message(self.shell_channel, change_str_to_date=True)
-            msg_id = msg["parent_header"].get("msg_id")
-            if msg_id in self.execute_requests.keys():
-                await self.execute_requests[msg_id]["shell_msg"].send(msg)
+            msg = await receive_message(self.shell_channel)
+            await self._dispatch_shell(msg)
+
+    async def _dispatch_shell(self, msg: Dict[str, Any]) -> None:
+        msg_id = msg["parent_header"].get("msg_id")
+        if msg_id in self.execute_requests.keys():
+            await self.execute_requests[msg_id]["shell_msg"].send(msg)
 
     async def execute(
         self,
@@ -155,8 +281,33 @@ class KernelDriver:
     ) -> None:
         if ycell["cell_type"] != "code":
             return
+        msg_id = await self.send_execute_request(ycell, msg_id=msg_id)
+        if wait_for_executed:
+            await self.wait_for_executed(msg_id, ycell, timeout)
+        else:
+            self.task_group.start_soon(lambda: self.wait_for_executed(msg_id, ycell))
+
+    async def send_execute_request(
+        self, ycell: Map, msg_id: str = "", stop_on_error: bool = True
+    ) -> str:
+        """Send a request to execute a code cell, whose outputs are handled by
+        wait_for_executed.
+
+        Arguments:
+            ycell: The cell to execute.
+            msg_id: The ID of the request, generated if empty.
+            stop_on_error: Whether the kernel aborts the execute requests it has already
+                received if this one fails.
+
+        Returns:
+            The ID of the request.
+        """
         ycell["execution_state"] = "busy"
-        content = {"code": str(ycell["source"]), "silent": False}
+        content = {
+            "code": str(ycell["source"]),
+            "silent": False,
+            "stop_on_error": stop_on_error,
+        }
         msg = create_message(
             "execute_request", content, session_id=self.session_id, msg_id=str(self.msg_cnt)
         )
@@ -165,7 +316,7 @@ class KernelDriver:
         else:
             msg_id = msg["header"]["msg_id"]
         self.msg_cnt += 1
-        await send_message(msg, self.shell_channel, self.key, change_date_to_str=True)
+        # the request is registered before its replies can be received
         self.execute_requests[msg_id] = {
             "iopub_msg": StapledObjectStream(
                 *create_memory_object_stream[dict](max_buffer_size=1024)
@@ -174,12 +325,24 @@ class KernelDriver:
                 *create_memory_object_stream[dict](max_buffer_size=1024)
             ),
         }
-        if wait_for_executed:
-            deadline = time.time() + timeout
+        await send_message(msg, self.shell_channel, self.key)
+        return msg_id
+
+    async def wait_for_executed(
+        self, msg_id: str, ycell: Map, timeout: float = float("inf")
+    ) -> Dict[str, Any]:
+        """Handle the outputs of an execute request until it is executed.
+
+        Returns:
+            The execute reply.
+        """
+        streams = self.execute_requests[msg_id]
+        deadline = time.time() + timeout
+        try:
             while True:
                 try:
                     with fail_after(deadline_to_timeout(deadline)):
-                        msg = await self.execute_requests[msg_id]["iopub_msg"].receive()
+                        msg = await streams["iopub_msg"].receive()
                 except TimeoutError:
                     error_message = f"Kernel didn't respond in {timeout} seconds"
                     raise RuntimeError(error_message)
@@ -191,33 +354,23 @@ class KernelDriver:
                     break
             try:
                 with fail_after(deadline_to_timeout(deadline)):
-                    msg = await self.execute_requests[msg_id]["shell_msg"].receive()
+                    msg = await streams["shell_msg"].receive()
             except TimeoutError:
                 error_message = f"Kernel didn't respond in {timeout} seconds"
                 raise RuntimeError(error_message)
-            with ycell.doc.transaction():
-                ycell["execution_count"] = msg["content"]["execution_count"]
-                ycell["execution_state"] = "idle"
+        finally:
             del self.execute_requests[msg_id]
-        else:
-            self.task_group.start_soon(lambda: self._handle_iopub(msg_id, ycell))
-
-    async def _handle_iopub(self, msg_id: str, ycell: Map) -> None:
-        while True:
-            msg = await self.execute_requests[msg_id]["iopub_msg"].receive()
-            await self._handle_outputs(ycell["outputs"], msg)
-            if (
-                msg["header"]["msg_type"] == "status"
-                and msg["content"]["execution_state"] == "idle"
-            ):
-                msg = await self.execute_requests[msg_id]["shell_msg"].receive()
-                with ycell.doc.transaction():
-                    ycell["execution_count"] = msg["content"]["execution_count"]
-                    ycell["execution_state"] = "idle"
-                break
+            for stream in streams.values():
+                await stream.aclose()
+        with ycell.doc.transaction():
+            # an aborted request has no execution count
+            if "execution_count" in msg["content"]:
+                ycell["execution_count"] = msg["content"]["execution_count"]
+            ycell["execution_state"] = "idle"
+        return msg
 
     async def _handle_comms(self) -> None:
-        if self.yjs is None or self.yjs.widgets is None:  # type: ignore
+        if not self.handles_comms:
             return
 
         while True:
@@ -226,32 +379,31 @@ class KernelDriver:
             if msg_type == "comm_open":
                 comm_id = msg["content"]["comm_id"]
                 comm = Comm(comm_id, self.shell_channel, self.session_id, self.key, self.task_group)
+                self.comm_ids.add(comm_id)
                 self.yjs.widgets.comm_open(msg, comm)  # type: ignore
             elif msg_type == "comm_msg":
                 self.yjs.widgets.comm_msg(msg)  # type: ignore
+            elif msg_type == "comm_close":
+                self._close_comm(msg["content"]["comm_id"])
+
+    def _close_comm(self, comm_id: str) -> None:
+        self.comm_ids.discard(comm_id)
+        if self.yjs is None or self.yjs.widgets is None:  # type: ignore
+            return
+        self.yjs.widgets.comm_close({"content": {"comm_id": comm_id}})  # type: ignore
+        room_name = self.widget_rooms.pop(comm_id, None)
+        if room_name is not None:
+            self.yjs.room_manager.release_room(room_name, comm_id)  # type: ignore
 
     async def _wait_for_ready(self, timeout):
-        deadline = time.time() + timeout
-        new_timeout = timeout
-        while True:
-            msg = create_message(
-                "kernel_info_request", session_id=self.session_id, msg_id=str(self.msg_cnt)
-            )
-            self.msg_cnt += 1
-            await send_message(msg, self.shell_channel, self.key, change_date_to_str=True)
-            msg = await receive_message(
-                self.shell_channel, timeout=new_timeout, change_str_to_date=True
-            )
-            if msg is None:
-                error_message = f"Kernel didn't respond in {timeout} seconds"
-                raise RuntimeError(error_message)
-            if msg["msg_type"] == "kernel_info_reply":
-                msg = await receive_message(
-                    self.iopub_channel, timeout=0.2, change_str_to_date=True
+        try:
+            with fail_after(timeout):
+                await wait_for_ready(
+                    self.shell_channel, self.iopub_channel, self.key, self.session_id
                 )
-                if msg is not None:
-                    break
-            new_timeout = deadline_to_timeout(deadline)
+        except TimeoutError:
+            error_message = f"Kernel didn't respond in {timeout} seconds"
+            raise RuntimeError(error_message)
 
     async def _handle_outputs(self, outputs: Array, msg: Dict[str, Any]):
         msg_type = msg["header"]["msg_type"]
@@ -282,7 +434,9 @@ class KernelDriver:
                     if model_id in self.yjs.widgets.widgets:  # type: ignore
                         doc = self.yjs.widgets.widgets[model_id]["model"].ydoc  # type: ignore
                         path = f"ywidget:{doc.guid}"
-                        await self.yjs.room_manager.websocket_server.get_room(path, ydoc=doc)  # type: ignore
+                        # the room lives as long as the widget or one of its clients
+                        await self.yjs.room_manager.acquire_room(path, model_id, ydoc=doc)  # type: ignore
+                        self.widget_rooms[model_id] = path
                         outputs.append(doc)
             else:
                 output = {
@@ -292,6 +446,9 @@ class KernelDriver:
                 }
                 if msg_type == "execute_result":
                     output["execution_count"] = content["execution_count"]
+                if self.yjs is not None:
+                    # large outputs are kept out of the shared document
+                    output = await self.yjs.output_store.externalize(output)
                 outputs.append(output)
         elif msg_type == "error":
             outputs.append(
@@ -325,5 +482,5 @@ class Comm:
         )
         self.msg_cnt += 1
         self.task_group.start_soon(
-            lambda: send_message(msg, self.shell_channel, self.key, change_date_to_str=True)
+            lambda: send_message(msg, self.shell_channel, self.key)
         )
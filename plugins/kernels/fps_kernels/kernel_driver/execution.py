@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+from collections import deque
+from typing import TYPE_CHECKING, Any, Deque, Dict, List, Optional
+
+import structlog
+from anyio import Event, create_task_group
+from anyio.abc import Process
+from pycrdt import Map
+
+if TYPE_CHECKING:
+    from .driver import KernelDriver
+
+logger = structlog.get_logger()
+
+
+class QueuedCell:
+    def __init__(self, document_id: str, ycell: Map, batch_id: int, stop_on_error: bool) -> None:
+        self.document_id = document_id
+        self.ycell = ycell
+        self.cell_id = str(ycell["id"])
+        self.batch_id = batch_id
+        self.stop_on_error = stop_on_error
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"document_id": self.document_id, "cell_id": self.cell_id}
+
+
+class ExecutionQueue:
+    """The cells to execute in a kernel, in order.
+
+    Up to pipeline_depth execute requests are sent ahead to the kernel, so that it doesn't wait
+    for the server between cells. The other cells are queued in the server, where they can be
+    cancelled. When a cell of a batch fails and the batch stops on error, the next cells of the
+    batch are not executed. The kernel aborts all the requests it has received after a failing
+    request that stops on error, so the cells of a batch are not sent while cells of a previous
+    batch that stops on error are running.
+
+    A running cell whose kernel dies or is restarted is considered failed.
+    """
+
+    def __init__(self, driver: KernelDriver, pipeline_depth: int = 2) -> None:
+        """
+        Arguments:
+            driver: The driver of the kernel executing the cells.
+            pipeline_depth: The maximum number of cells sent to the kernel at once.
+        """
+        self.driver = driver
+        self.pipeline_depth = max(pipeline_depth, 1)
+        self._queued: Deque[QueuedCell] = deque()
+        self._running: List[QueuedCell] = []
+        self._batch_nb = 0
+        self._changed = Event()
+
+    @property
+    def status(self) -> Dict[str, List[Dict[str, str]]]:
+        return {
+            "running": [cell.to_dict() for cell in self._running],
+            "queued": [cell.to_dict() for cell in self._queued],
+        }
+
+    def put(self, document_id: str, ycells: List[Map], stop_on_error: bool = True) -> None:
+        """Queue a batch of cells, e.g. all the cells of a notebook, to be executed in order.
+        Only the code cells are executed.
+        """
+        self._batch_nb += 1
+        for ycell in ycells:
+            if ycell["cell_type"] == "code":
+                self._queued.append(QueuedCell(document_id, ycell, self._batch_nb, stop_on_error))
+        self._changed.set()
+
+    def cancel(self, cell_ids: Optional[List[str]] = None) -> List[str]:
+        """Cancel queued cells. The cells that were already sent to the kernel are executed.
+
+        Arguments:
+            cell_ids: The IDs of the cells to cancel, or None to cancel all the queued cells.
+
+        Returns:
+            The IDs of the cancelled cells.
+        """
+        cancelled = [cell for cell in self._queued if cell_ids is None or cell.cell_id in cell_ids]
+        for cell in cancelled:
+            self._queued.remove(cell)
+        return [cell.cell_id for cell in cancelled]
+
+    def _can_send(self) -> bool:
+        if not self._queued or len(self._running) >= self.pipeline_depth:
+            return False
+        batch_id = self._queued[0].batch_id
+        return not any(
+            cell.stop_on_error and cell.batch_id != batch_id for cell in self._running
+        )
+
+    def _get_kernel_process(self) -> Optional[Process]:
+        if self.driver.kernel_server is not None:
+            return getattr(self.driver.kernel_server, "kernel_process", None)
+        return getattr(self.driver, "kernel_process", None)
+
+    async def run(self) -> None:
+        async with create_task_group() as tg:
+            while True:
+                while not self._can_send():
+                    self._changed = Event()
+                    await self._changed.wait()
+                cell = self._queued.popleft()
+                self._running.append(cell)
+                del cell.ycell["outputs"][:]
+                kernel_process = self._get_kernel_process()
+                msg_id = await self.driver.send_execute_request(
+                    cell.ycell, stop_on_error=cell.stop_on_error
+                )
+                tg.start_soon(self._wait_for_executed, cell, msg_id, kernel_process)
+
+    async def _wait_for_executed(
+        self, cell: QueuedCell, msg_id: str, kernel_process: Optional[Process]
+    ) -> None:
+        reply: Optional[Dict[str, Any]] = None
+        try:
+            async with create_task_group() as tg:
+
+                async def wait_for_reply() -> None:
+                    nonlocal reply
+                    reply = await self.driver.wait_for_executed(msg_id, cell.ycell)
+                    tg.cancel_scope.cancel()
+
+                tg.start_soon(wait_for_reply)
+                if kernel_process is not None:
+                    # a kernel that died or was restarted will never reply
+                    await kernel_process.wait()
+                    logger.warning("Kernel exited while executing cell", cell_id=cell.cell_id)
+                    cell.ycell["execution_state"] = "idle"
+                    tg.cancel_scope.cancel()
+        except Exception as e:
+            logger.error("Could not execute cell", cell_id=cell.cell_id, exc_info=e)
+        finally:
+            self._running.remove(cell)
+            self._changed.set()
+        failed = reply is None or reply["content"]["status"] != "ok"
+        if failed and cell.stop_on_error:
+            # the cells of the batch that were already sent are aborted by the kernel
+            cancelled = [c for c in self._queued if c.batch_id == cell.batch_id]
+            for c in cancelled:
+                self._queued.remove(c)
+            if cancelled:
+                logger.info(
+                    "Cell failed, not executing the next cells",
+                    cell_id=cell.cell_id,
+                    cancelled_cell_nb=len(cancelled),
+                )
@@ -0,0 +1,341 @@
+"""A kernel launcher forking Python kernels from a template process.
+
+The template process imports a list of modules once (e.g. ipykernel and its dependencies), and
+then forks a child process for each kernel, which runs the kernel's module with the kernel's
+connection file, without importing these modules again.
+
+Run as a script, this module is the template process. It reads requests from its standard
+input and writes events to its standard output, one JSON object per line:
+
+- request: {"argv": ["-m", "ipykernel_launcher", "-f", "kernel.json"], "cwd": "/path",
+  "capture_output": true}
+- event when a kernel is forked: {"pid": 1234}
+- event when a kernel exits: {"exited": 1234, "returncode": 0}
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import runpy
+import select
+import signal
+import subprocess
+import sys
+import traceback
+from importlib import import_module
+from typing import Dict, List, Optional
+
+import structlog
+from anyio import (
+    TASK_STATUS_IGNORED,
+    EndOfStream,
+    Event,
+    IncompleteRead,
+    Lock,
+    create_memory_object_stream,
+    create_task_group,
+    move_on_after,
+    open_process,
+)
+from anyio.abc import ByteReceiveStream, ByteSendStream, Process, TaskStatus
+from anyio.streams.buffered import BufferedByteReceiveStream
+
+from .connect import get_kernel_command, launch_kernel
+
+logger = structlog.get_logger()
+
+# the interval in seconds at which a kernel is checked for exit when its exit is not reported
+ORPHAN_POLL_INTERVAL = 1
+
+
+def _is_running(pid: int) -> bool:
+    """
+    Returns:
+        Whether a process that is not a child of this process is still running.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # a process that exited but was not reaped by its new parent yet is a zombie
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except (OSError, IndexError):
+        return True
+
+
+class ForkedProcess(Process):
+    """A kernel process forked by the template process, which is its parent process."""
+
+    def __init__(self, pid: int) -> None:
+        self._pid = pid
+        self._returncode: Optional[int] = None
+        self._exited = Event()
+        self._orphaned = False
+
+    def set_returncode(self, returncode: int) -> None:
+        self._returncode = returncode
+        self._exited.set()
+
+    def set_orphaned(self) -> None:
+        """The template process is gone, so the exit of the process will not be reported:
+        whether it is still running is checked instead.
+        """
+        self._orphaned = True
+
+    def _check_running(self) -> None:
+        if self._orphaned and self._returncode is None and not _is_running(self._pid):
+            # the exit status of a process that is not a child of this process is unknown
+            self.set_returncode(-1)
+
+    async def aclose(self) -> None:
+        await self.wait()
+
+    async def wait(self) -> int:
+        while True:
+            self._check_running()
+            if self._returncode is not None:
+                return self._returncode
+            with move_on_after(ORPHAN_POLL_INTERVAL):
+                await self._exited.wait()
+
+    def terminate(self) -> None:
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self) -> None:
+        self.send_signal(signal.SIGKILL)
+
+    def send_signal(self, signal: int) -> None:
+        self._check_running()
+        # the PID of an exited process could have been reused
+        if self._returncode is not None:
+            raise ProcessLookupError
+        os.kill(self._pid, signal)
+
+    @property
+    def pid(self) -> int:
+        return self._pid
+
+    @property
+    def returncode(self) -> Optional[int]:
+        self._check_running()
+        return self._returncode
+
+    @property
+    def stdin(self) -> Optional[ByteSendStream]:
+        return None
+
+    @property
+    def stdout(self) -> Optional[ByteReceiveStream]:
+        return None
+
+    @property
+    def stderr(self) -> Optional[ByteReceiveStream]:
+        return None
+
+
+class ForkServer:
+    """Launches Python kernels by forking them from a template process, which has already
+    imported the preloaded modules.
+
+    Only the kernels run with "python -m <module>" by the same Python interpreter as Jupyverse
+    can be forked, other kernels are launched as subprocesses.
+    """
+
+    def __init__(self, preload: List[str]) -> None:
+        """
+        Arguments:
+            preload: The modules imported once by the template process.
+        """
+        self.preload = preload
+        self._processes: Dict[int, ForkedProcess] = {}
+        self._lock = Lock()
+        self._running = False
+
+    async def start(self, *, task_status: TaskStatus[None] = TASK_STATUS_IGNORED) -> None:
+        async with create_task_group() as tg:
+            self.task_group = tg
+            self._process = await open_process(
+                [sys.executable, "-m", __name__, *self.preload],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=None,
+            )
+            self._running = True
+            self._send_pid, self._receive_pid = create_memory_object_stream[int](max_buffer_size=1)
+            tg.start_soon(self._read_events)
+            task_status.started()
+
+    async def stop(self) -> None:
+        # the template process exits when its standard input is closed
+        assert self._process.stdin is not None
+        await self._process.stdin.aclose()
+        await self._process.wait()
+        self.task_group.cancel_scope.cancel()
+
+    def can_fork(self, cmd: List[str]) -> bool:
+        return (
+            self._running
+            and hasattr(os, "fork")
+            and len(cmd) > 2
+            and cmd[0] == sys.executable
+            and cmd[1] == "-m"
+        )
+
+    async def launch_kernel(
+        self,
+        kernelspec_path: str,
+        connection_file_path: str,
+        kernel_cwd: str | None,
+        capture_output: bool,
+    ) -> Process:
+        """Fork a kernel from the template process, or launch it as a subprocess if it cannot
+        be forked. The arguments are the same as launch_kernel's.
+        """
+        cmd = get_kernel_command(kernelspec_path, connection_file_path)
+        if self.can_fork(cmd):
+            request = {
+                "argv": cmd[1:],
+                "cwd": kernel_cwd or None,
+                "capture_output": capture_output,
+            }
+            assert self._process.stdin is not None
+            # the template process answers requests in order
+            async with self._lock:
+                try:
+                    await self._process.stdin.send(json.dumps(request).encode() + b"\n")
+                    pid = await self._receive_pid.receive()
+                except Exception:
+                    pass
+                else:
+                    logger.debug("Forked kernel", pid=pid, kernelspec_path=kernelspec_path)
+                    return self._processes[pid]
+            logger.warning("Kernel forkserver is not running, launching kernel as a subprocess")
+        return await launch_kernel(
+            kernelspec_path, connection_file_path, kernel_cwd, capture_output
+        )
+
+    async def _read_events(self) -> None:
+        assert self._process.stdout is not None
+        stdout = BufferedByteReceiveStream(self._process.stdout)
+        try:
+            while True:
+                event = json.loads(await stdout.receive_until(b"\n", 65536))
+                if "pid" in event:
+                    pid = event["pid"]
+                    # register the process before its exit event can be received
+                    self._processes[pid] = ForkedProcess(pid)
+                    await self._send_pid.send(pid)
+                else:
+                    process = self._processes.pop(event["exited"], None)
+                    if process is not None:
+                        process.set_returncode(event["returncode"])
+        except (EndOfStream, IncompleteRead):
+            pass
+        finally:
+            self._running = False
+            self._send_pid.close()
+            # the kernels are not children of this process, and keep running without the
+            # template process, which doesn't report their exit anymore
+            for process in self._processes.values():
+                process.set_orphaned()
+            self._processes.clear()
+
+
+def _write_event(event: Dict[str, int]) -> None:
+    os.write(sys.stdout.fileno(), json.dumps(event).encode() + b"\n")
+
+
+def _reap_children() -> None:
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+        _write_event({"exited": pid, "returncode": os.waitstatus_to_exitcode(status)})
+
+
+def _run_kernel(request: dict) -> None:
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    if request["capture_output"]:
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+    else:
+        # the standard output of the template process is used for its events
+        os.dup2(2, 1)
+    os.close(devnull)
+    if request["cwd"]:
+        os.chdir(request["cwd"])
+    argv = request["argv"]
+    # run_module sets sys.argv[0] to the module's path, like "python -m <module>"
+    sys.argv = argv[1:]
+    returncode = 0
+    try:
+        runpy.run_module(argv[1], run_name="__main__", alter_sys=True)
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            returncode = e.code
+        elif e.code is not None:
+            returncode = 1
+    except BaseException:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(returncode)
+
+
+def main(preload: List[str]) -> None:
+    for module in preload:
+        try:
+            import_module(module)
+        except Exception:
+            print(f"Kernel forkserver could not preload module: {module}", file=sys.stderr)
+    # the kernels are interrupted individually
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # the exit of a kernel wakes up the main loop
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    stdin = sys.stdin.fileno()
+    buffer = b""
+    while True:
+        try:
+            readable, _, _ = select.select([stdin, wakeup_r], [], [])
+        except InterruptedError:
+            continue
+        if wakeup_r in readable:
+            os.read(wakeup_r, 4096)
+            _reap_children()
+        if stdin not in readable:
+            continue
+        data = os.read(stdin, 65536)
+        if not data:
+            # Jupyverse is gone
+            return
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            request = json.loads(line)
+            pid = os.fork()
+            if pid == 0:
+                signal.set_wakeup_fd(-1)
+                os.close(wakeup_r)
+                os.close(wakeup_w)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                _run_kernel(request)
+            _write_event({"pid": pid})
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,162 @@
+from collections import deque
+from time import monotonic
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from .message import Part, pack, unpack
+
+# the messages that can be rate limited, other messages (e.g. status or comm messages)
+# are always forwarded because clients need them to track the state of the kernel
+OUTPUT_MSG_TYPES = {"stream", "display_data", "update_display_data", "execute_result"}
+# the maximum number of pending messages that are received at once to be coalesced
+MAX_COALESCED_MESSAGES = 1024
+
+
+def get_throttle_notice(msg_rate_limit: Optional[float], data_rate_limit: Optional[float]) -> str:
+    return (
+        "IOPub output rate exceeded.\n"
+        "The server will temporarily stop sending output to the client,\n"
+        "in order to avoid crashing it.\n"
+        "To change these limits, set the kernels module's configuration:\n"
+        f"iopub_msg_rate_limit={msg_rate_limit} (msgs/sec)\n"
+        f"iopub_data_rate_limit={data_rate_limit} (bytes/sec)\n"
+    )
+
+
+class IOPubRateLimiter:
+    """Limits the rate of the output messages of a kernel on IOPub.
+
+    The rates are averaged over a sliding window. When a rate is exceeded, output messages are
+    dropped until the rates are back below their limits, similarly to classic Jupyter's
+    iopub_msg_rate_limit and iopub_data_rate_limit.
+    """
+
+    def __init__(
+        self,
+        msg_rate_limit: Optional[float] = None,
+        data_rate_limit: Optional[float] = None,
+        window: float = 3,
+    ) -> None:
+        """
+        Arguments:
+            msg_rate_limit: The maximum number of output messages per second, or None for no limit.
+            data_rate_limit: The maximum number of output bytes per second, or None for no limit.
+            window: The duration in seconds over which the rates are averaged.
+        """
+        self.msg_rate_limit = msg_rate_limit
+        self.data_rate_limit = data_rate_limit
+        self.window = window
+        self.throttled = False
+        self._messages: Deque[Tuple[float, int]] = deque()
+        self._msg_count = 0
+        self._byte_count = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.msg_rate_limit is not None or self.data_rate_limit is not None
+
+    @property
+    def notice(self) -> str:
+        return get_throttle_notice(self.msg_rate_limit, self.data_rate_limit)
+
+    def limit(self, size: int) -> str:
+        """Account for an output message.
+
+        Arguments:
+            size: The size of the message in bytes.
+
+        Returns:
+            "forward" if the message can be forwarded, "notify" if the output just started to be
+                throttled (the message must be dropped and the clients notified), or "drop".
+        """
+        if not self.enabled:
+            return "forward"
+        now = monotonic()
+        while self._messages and self._messages[0][0] <= now - self.window:
+            _, old_size = self._messages.popleft()
+            self._msg_count -= 1
+            self._byte_count -= old_size
+        self._messages.append((now, size))
+        self._msg_count += 1
+        self._byte_count += size
+        exceeded = (
+            self.msg_rate_limit is not None and self._msg_count / self.window > self.msg_rate_limit
+        ) or (
+            self.data_rate_limit is not None
+            and self._byte_count / self.window > self.data_rate_limit
+        )
+        if exceeded:
+            if self.throttled:
+                return "drop"
+            self.throttled = True
+            return "notify"
+        self.throttled = False
+        return "forward"
+
+
+def coalesce_stream_parts(batch: List[List[Part]]) -> List[List[Part]]:
+    """Merge consecutive stream messages of the same name and parent into one message.
+
+    Arguments:
+        batch: The messages received from the kernel, as lists of ZMQ frames starting with the
+            signature.
+
+    Returns:
+        The messages, with consecutive stream messages merged. A merged message has the header
+            of the first message it was merged from, and an empty signature.
+    """
+    if len(batch) < 2:
+        return batch
+    coalesced: List[List[Part]] = []
+    texts: List[str] = []
+    stream_key = None
+    for parts in batch:
+        if b'"stream"' in parts[1] and unpack(parts[1])["msg_type"] == "stream":
+            content = unpack(parts[4])
+            # the parent header is compared without being parsed
+            key = (parts[2], content.get("name"))
+            if key == stream_key:
+                texts.append(content["text"])
+                continue
+            _flush_texts(coalesced, texts)
+            stream_key = key
+            texts = [content["text"]]
+        else:
+            _flush_texts(coalesced, texts)
+            stream_key = None
+            texts = []
+        coalesced.append(parts)
+    _flush_texts(coalesced, texts)
+    return coalesced
+
+
+def _flush_texts(coalesced: List[List[Part]], texts: List[str]) -> None:
+    if len(texts) < 2:
+        return
+    parts = coalesced[-1]
+    content = unpack(parts[4])
+    content["text"] = "".join(texts)
+    coalesced[-1] = [b"", parts[1], parts[2], parts[3], pack(content)] + parts[5:]
+
+
+def coalesce_stream_messages(msgs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Merge consecutive stream messages of the same name and parent into one message.
+
+    Arguments:
+        msgs: The deserialized messages received from the kernel.
+
+    Returns:
+        The messages, with consecutive stream messages merged.
+    """
+    coalesced: List[Dict[str, Any]] = []
+    for msg in msgs:
+        if msg["msg_type"] == "stream" and coalesced:
+            last_msg = coalesced[-1]
+            if (
+                last_msg["msg_type"] == "stream"
+                and last_msg["parent_header"].get("msg_id") == msg["parent_header"].get("msg_id")
+                and last_msg["content"]["name"] == msg["content"]["name"]
+            ):
+                last_msg["content"]["text"] += msg["content"]["text"]
+                continue
+        coalesced.append(msg)
+    return coalesced
@@ -1,8 +1,17 @@
+import hashlib
+import json
 import os
 import sys
+from typing import Any, Dict, List, Optional
+
+import structlog
+from anyio import Event
+from watchfiles import Change, awatch
 
 from .paths import jupyter_data_dir
 
+logger = structlog.get_logger()
+
 if os.name == "nt":
     programdata = os.environ.get("PROGRAMDATA", None)
     if programdata:
@@ -66,3 +75,84 @@ def find_kernelspec(kernel_name):
             if kname not in d:
                 d[kname] = os.path.join(spec, "kernel.json")
     return d.get(kernel_name, "")
+
+
+class KernelspecRegistry:
+    """The kernelspecs of the kernelspec directories, kept in memory.
+
+    The kernelspecs are read once, and read again when a kernelspec directory changes, so that
+    looking up a kernelspec or listing the kernelspecs doesn't access the file system.
+    """
+
+    def __init__(self, dirs: Optional[List[str]] = None) -> None:
+        """
+        Arguments:
+            dirs: The kernelspec directories, by order of priority. Defaults to the Jupyter
+                kernelspec directories.
+        """
+        self.dirs = kernelspec_dirs() if dirs is None else dirs
+        # kernel name -> {"spec": kernel.json content, "dir": kernelspec directory,
+        # "resources": file names of the other files in the kernelspec directory}
+        self.kernelspecs: Dict[str, Dict[str, Any]] = {}
+        self.etag = ""
+        self.refresh()
+
+    def refresh(self) -> None:
+        kernelspecs: Dict[str, Dict[str, Any]] = {}
+        for kernel_dir in self.dirs:
+            for name, path in sorted(_list_kernels_in(kernel_dir).items()):
+                if name in kernelspecs:
+                    # a kernelspec in a directory of higher priority takes precedence
+                    continue
+                try:
+                    with open(os.path.join(path, "kernel.json")) as f:
+                        spec = json.load(f)
+                    resources = sorted(
+                        f
+                        for f in os.listdir(path)
+                        if f != "kernel.json" and os.path.isfile(os.path.join(path, f))
+                    )
+                except Exception as e:
+                    logger.warning("Could not read kernelspec", path=path, exc_info=e)
+                    continue
+                kernelspecs[name] = {"spec": spec, "dir": path, "resources": resources}
+        self.kernelspecs = kernelspecs
+        content = json.dumps(kernelspecs, sort_keys=True).encode()
+        self.etag = f'"{hashlib.sha1(content).hexdigest()}"'
+
+    def find(self, kernel_name: str) -> str:
+        """
+        Returns:
+            The path to the kernel.json file of the kernelspec, or "" if it doesn't exist.
+        """
+        kernelspec = self.kernelspecs.get(kernel_name)
+        if kernelspec is None:
+            return ""
+        return os.path.join(kernelspec["dir"], "kernel.json")
+
+    async def watch(self, stop_event: Optional[Event] = None) -> None:
+        """Refresh the kernelspecs when the kernelspec directories change, until stop_event is
+        set.
+
+        A kernelspec directory that doesn't exist yet is watched through its parent directory,
+        if it exists.
+        """
+        watched_paths = set()
+        for kernel_dir in self.dirs:
+            if os.path.isdir(kernel_dir):
+                watched_paths.add(kernel_dir)
+            elif os.path.isdir(os.path.dirname(kernel_dir)):
+                watched_paths.add(os.path.dirname(kernel_dir))
+        if not watched_paths:
+            return
+
+        def in_kernelspec_dirs(change: Change, path: str) -> bool:
+            return any(
+                os.path.commonpath([path, kernel_dir]) == kernel_dir for kernel_dir in self.dirs
+            )
+
+        async for _ in awatch(
+            *watched_paths, watch_filter=in_kernelspec_dirs, stop_event=stop_event
+        ):
+            logger.debug("Kernelspecs changed, refreshing them")
+            self.refresh()
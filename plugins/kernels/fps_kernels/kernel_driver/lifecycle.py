@@ -0,0 +1,86 @@
+import structlog
+from anyio import Event, create_task_group, move_on_after, sleep
+from zmq.asyncio import Socket
+
+from .connect import cfg_t, connect_channel
+from .message import create_message, receive_message, send_message
+
+logger = structlog.get_logger()
+
+# the time to wait for the status messages of a kernel_info_request on IOPub, after its reply
+IOPUB_STATUS_DELAY = 0.1
+
+
+async def wait_for_ready(
+    shell_channel: Socket, iopub_channel: Socket, key: str, session_id: str = ""
+) -> None:
+    """Wait for a kernel to be ready, and for its IOPub channel to be connected.
+
+    A kernel_info_request is sent, and sent again after it is replied to, until a message is
+    received on IOPub (a SUB socket misses the messages that are published before it is
+    connected). A request sent before the kernel listens is delivered when it does, so the
+    kernel is not polled while it starts.
+    """
+    iopub_connected = Event()
+
+    async def wait_for_iopub() -> None:
+        await receive_message(iopub_channel)
+        iopub_connected.set()
+
+    async with create_task_group() as tg:
+        tg.start_soon(wait_for_iopub)
+        msg_cnt = 0
+        while True:
+            msg = create_message(
+                "kernel_info_request", session_id=session_id, msg_id=f"kernel_info_{msg_cnt}"
+            )
+            msg_cnt += 1
+            await send_message(msg, shell_channel, key)
+            await receive_message(shell_channel)
+            with move_on_after(IOPUB_STATUS_DELAY):
+                await iopub_connected.wait()
+            if iopub_connected.is_set():
+                return
+
+
+class Heartbeat:
+    """Checks that a kernel is responsive, by sending pings on its heartbeat channel.
+
+    The kernel replies to pings from a thread, even while it is executing code, so a kernel
+    that doesn't reply is hung or gone.
+    """
+
+    def __init__(self, connection_cfg: cfg_t, interval: float = 3) -> None:
+        """
+        Arguments:
+            connection_cfg: The connection configuration of the kernel.
+            interval: The interval in seconds between pings. A kernel that doesn't reply to a
+                ping within this interval is unresponsive.
+        """
+        self.connection_cfg = connection_cfg
+        self.interval = interval
+        self.responsive = True
+
+    async def run(self) -> None:
+        hb_channel = connect_channel("hb", self.connection_cfg)
+        try:
+            while True:
+                await hb_channel.send(b"ping")
+                responsive = False
+                with move_on_after(self.interval):
+                    await hb_channel.recv()
+                    responsive = True
+                if not responsive:
+                    # a REQ socket cannot send another ping until it receives a reply
+                    hb_channel.close(linger=0)
+                    hb_channel = connect_channel("hb", self.connection_cfg)
+                if responsive != self.responsive:
+                    if responsive:
+                        logger.info("Kernel is responsive again")
+                    else:
+                        logger.warning("Kernel is unresponsive", interval=self.interval)
+                    self.responsive = responsive
+                if responsive:
+                    await sleep(self.interval)
+        finally:
+            hb_channel.close(linger=0)
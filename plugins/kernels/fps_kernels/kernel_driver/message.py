@@ -1,24 +1,47 @@
 import hashlib
 import hmac
 from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional, Tuple, cast
+from typing import Any, Dict, List, Optional, Tuple, Union, cast
 from uuid import uuid4
 
 from dateutil.parser import parse as dateutil_parse
+from zmq import Frame
 from zmq.asyncio import Socket
-from zmq.utils import jsonapi
+
+from .codec import dumps, loads
 
 protocol_version_info = (5, 3)
 protocol_version = "%i.%i" % protocol_version_info
 
 DELIM = b"<IDS|MSG>"
 
+# a part of a kernel message: the JSON parts are bytes, the buffers can be memoryviews
+Part = Union[bytes, memoryview]
+
 
 def feed_identities(msg_list: List[bytes]) -> Tuple[List[bytes], List[bytes]]:
     idx = msg_list.index(DELIM)
     return msg_list[:idx], msg_list[idx + 1 :]  # noqa
 
 
+def feed_frames(frames: List[Frame]) -> List[Part]:
+    """
+    Arguments:
+        frames: The frames of a message received from a kernel without copying.
+
+    Returns:
+        The parts of the message after the identities: the signature and the JSON parts are copied
+            to bytes, since they are small and parsed, but the buffers are views of the frames.
+    """
+    for idx, frame in enumerate(frames):
+        if frame.buffer == DELIM:
+            break
+    else:
+        raise ValueError("Message delimiter not found")
+    frames = frames[idx + 1 :]  # noqa
+    return [frame.bytes for frame in frames[:5]] + [frame.buffer for frame in frames[5:]]
+
+
 def str_to_date(obj: Dict[str, Any]) -> Dict[str, Any]:
     if "date" in obj:
         obj["date"] = dateutil_parse(obj["date"])
@@ -72,14 +95,14 @@ def create_message(
 
 
 def pack(obj: Dict[str, Any]) -> bytes:
-    return jsonapi.dumps(obj)
+    return dumps(obj)
 
 
-def unpack(s: bytes) -> Dict[str, Any]:
-    return cast(Dict[str, Any], jsonapi.loads(s))
+def unpack(s: Part) -> Dict[str, Any]:
+    return cast(Dict[str, Any], loads(s))
 
 
-def sign(msg_list: List[bytes], key: str) -> bytes:
+def sign(msg_list: List[Part], key: str) -> bytes:
     auth = hmac.new(key.encode("ascii"), digestmod=hashlib.sha256)
     h = auth.copy()
     for m in msg_list:
@@ -87,9 +110,9 @@ def sign(msg_list: List[bytes], key: str) -> bytes:
     return h.hexdigest().encode()
 
 
-def serialize(msg: Dict[str, Any], key: str, change_date_to_str: bool = False) -> List[bytes]:
+def serialize(msg: Dict[str, Any], key: str, change_date_to_str: bool = False) -> List[Part]:
     _date_to_str = date_to_str if change_date_to_str else lambda x: x
-    message = [
+    message: List[Part] = [
         pack(_date_to_str(msg["header"])),
         pack(_date_to_str(msg["parent_header"])),
         pack(_date_to_str(msg["metadata"])),
@@ -100,7 +123,7 @@ def serialize(msg: Dict[str, Any], key: str, change_date_to_str: bool = False) -
 
 
 def deserialize(
-    msg_list: List[bytes],
+    msg_list: List[Part],
     parent_header: Optional[Dict[str, Any]] = None,
     change_str_to_date: bool = False,
 ) -> Dict[str, Any]:
@@ -123,7 +146,9 @@ def deserialize(
 async def send_message(
     msg: Dict[str, Any], sock: Socket, key: str, change_date_to_str: bool = False
 ) -> None:
-    await sock.send_multipart(serialize(msg, key, change_date_to_str=change_date_to_str), copy=True)
+    to_send = serialize(msg, key, change_date_to_str=change_date_to_str)
+    # pyzmq still copies small frames, but buffers are sent without being copied
+    await sock.send_multipart(to_send, copy=False)
 
 
 async def receive_message(
@@ -132,7 +157,6 @@ async def receive_message(
     timeout *= 1000  # in ms
     ready = await sock.poll(timeout)
     if ready:
-        msg_list = await sock.recv_multipart()
-        idents, msg_list = feed_identities(msg_list)
-        return deserialize(msg_list, change_str_to_date=change_str_to_date)
+        frames = await sock.recv_multipart(copy=False)
+        return deserialize(feed_frames(frames), change_str_to_date=change_str_to_date)
     return None
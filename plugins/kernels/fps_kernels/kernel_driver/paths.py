@@ -53,7 +53,7 @@ def jupyter_config_dir():
     if os.environ.get("JUPYTER_NO_CONFIG"):
         return _mkdtemp_once("jupyter-clean-cfg")
     if "JUPYTER_CONFIG_DIR" in os.environ:
-        return os.environ.env["JUPYTER_CONFIG_DIR"]
+        return os.environ["JUPYTER_CONFIG_DIR"]
     home = get_home_dir()
     return os.path.join(home, ".jupyter")
 
@@ -81,7 +81,7 @@ def jupyter_data_dir():
 
 def jupyter_runtime_dir():
     if "JUPYTER_RUNTIME_DIR" in os.environ:
-        return os.environ("JUPYTER_RUNTIME_DIR")
+        return os.environ["JUPYTER_RUNTIME_DIR"]
     return os.path.join(jupyter_data_dir(), "runtime")
 
 
@@ -1,17 +1,17 @@
-import json
 import struct
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from zmq.asyncio import Socket
 
-from ..kernel_driver.message import DELIM, deserialize, feed_identities, sign, unpack
+from ..kernel_driver.codec import dumps, loads
+from ..kernel_driver.message import DELIM, Part, deserialize, feed_frames, sign, unpack
 
 
 def to_binary(msg: Dict[str, Any]) -> Optional[bytes]:
     if not msg["buffers"]:
         return None
     buffers = msg.pop("buffers")
-    bmsg = json.dumps(msg).encode("utf8")
+    bmsg = dumps(msg)
     buffers.insert(0, bmsg)
     n = len(buffers)
     offsets = [4 * (n + 1)]
@@ -23,60 +23,158 @@ def to_binary(msg: Dict[str, Any]) -> Optional[bytes]:
 
 
 def from_binary(bmsg: bytes) -> Dict[str, Any]:
-    n = struct.unpack("!i", bmsg[:4])[0]
-    offsets = list(struct.unpack("!" + "I" * n, bmsg[4 : 4 * (n + 1)]))  # noqa
-    offsets.append(None)
-    buffers = []
-    for start, stop in zip(offsets[:-1], offsets[1:]):
-        buffers.append(bmsg[start:stop])
-    msg = json.loads(buffers[0].decode("utf8"))
-    msg["buffers"] = buffers[1:]
+    # the buffers are views of the websocket message, they are not copied
+    view = memoryview(bmsg)
+    n = struct.unpack_from("!i", view)[0]
+    offsets = list(struct.unpack_from(f"!{n}I", view, 4))
+    offsets.append(len(view))
+    msg = loads(view[offsets[0] : offsets[1]])  # noqa
+    msg["buffers"] = [view[start:stop] for start, stop in zip(offsets[1:-1], offsets[2:])]
     return msg
 
 
-async def send_raw_message(parts: List[bytes], sock: Socket, key: str) -> None:
+async def send_raw_message(parts: List[Part], sock: Socket, key: str) -> None:
     msg = parts[:4]
     buffers = parts[4:]
     to_send = [DELIM, sign(msg, key)] + msg + buffers
-    await sock.send_multipart(to_send)
+    # pyzmq still copies small frames, but buffers are sent without being copied
+    await sock.send_multipart(to_send, copy=False)
 
 
-def deserialize_msg_from_ws_v1(ws_msg: bytes) -> Tuple[str, List[bytes]]:
-    offset_number = int.from_bytes(ws_msg[:8], "little")
-    offsets = [
-        int.from_bytes(ws_msg[8 * (i + 1) : 8 * (i + 2)], "little")  # noqa
-        for i in range(offset_number)
-    ]
-    channel = ws_msg[offsets[0] : offsets[1]].decode("utf-8")  # noqa
-    msg_list = [ws_msg[offsets[i] : offsets[i + 1]] for i in range(1, offset_number - 1)]  # noqa
+def deserialize_msg_from_ws_v1(ws_msg: bytes) -> Tuple[str, List[memoryview]]:
+    # the parts are views of the websocket message, they are not copied
+    view = memoryview(ws_msg)
+    offset_number = struct.unpack_from("<Q", view)[0]
+    offsets = struct.unpack_from(f"<{offset_number}Q", view, 8)
+    channel = str(view[offsets[0] : offsets[1]], "utf-8")  # noqa
+    msg_list = [view[offsets[i] : offsets[i + 1]] for i in range(1, offset_number - 1)]  # noqa
     return channel, msg_list
 
 
-async def get_zmq_parts(socket: Socket) -> List[bytes]:
-    parts = await socket.recv_multipart()
-    idents, parts = feed_identities(parts)
-    return parts
+async def get_zmq_parts(socket: Socket) -> List[Part]:
+    frames = await socket.recv_multipart(copy=False)
+    return feed_frames(frames)
 
 
 def get_msg_from_parts(
-    parts: List[bytes], parent_header: Optional[Dict[str, Any]] = None
+    parts: List[Part], parent_header: Optional[Dict[str, Any]] = None
 ) -> Dict[str, Any]:
     return deserialize(parts, parent_header=parent_header)
 
 
-def serialize_msg_to_ws_v1(msg_list: List[bytes], channel: str) -> List[bytes]:
+def serialize_msg_to_ws_v1(msg_list: List[Part], channel: str) -> List[Part]:
+    """
+    Returns:
+        The chunks of the message in the v1.kernel.websocket.jupyter.org protocol, which are
+            joined only once into the websocket frame.
+    """
     msg_list = msg_list[1:]
     channel_b = channel.encode("utf-8")
-    offsets = []
-    offsets.append(8 * (1 + 1 + len(msg_list) + 1))
+    offsets = [8 * (1 + 1 + len(msg_list) + 1)]
     offsets.append(len(channel_b) + offsets[-1])
     for msg in msg_list:
         offsets.append(len(msg) + offsets[-1])
-    offset_number = len(offsets).to_bytes(8, byteorder="little")
-    offsets_b = [offset.to_bytes(8, byteorder="little") for offset in offsets]
-    bin_msg = [offset_number] + offsets_b + [channel_b] + msg_list
-    return bin_msg
+    offsets_b = struct.pack(f"<{len(offsets) + 1}Q", len(offsets), *offsets)
+    return [offsets_b, channel_b] + msg_list
 
 
-def get_parent_header(parts: List[bytes]) -> Dict[str, Any]:
+def get_parent_header(parts: List[Part]) -> Dict[str, Any]:
     return unpack(parts[2])
+
+
+class KernelMessage:
+    """A message received from a kernel, to be sent to websockets.
+
+    Its wire representation for each websocket protocol is computed once, when first needed,
+    and shared by all the sessions it is sent to.
+    """
+
+    def __init__(
+        self, parts: List[Part], parent_header: Dict[str, Any], channel_name: str
+    ) -> None:
+        self.parts = parts
+        self.parent_header = parent_header
+        self.channel_name = channel_name
+        # the sequence number of an IOPub message, used to replay it to a reconnecting session
+        self.seq: Optional[int] = None
+        self._header: Optional[Dict[str, Any]] = None
+        self._legacy: Optional[Union[str, bytes]] = None
+        self._v1: Optional[bytes] = None
+
+    @property
+    def header(self) -> Dict[str, Any]:
+        if self._header is None:
+            self._header = unpack(self.parts[1])
+        return self._header
+
+    @property
+    def size(self) -> int:
+        return sum(len(part) for part in self.parts)
+
+    def uncached(self) -> "KernelMessage":
+        """
+        Returns:
+            The message without its wire representations, which are computed again when needed.
+        """
+        message = KernelMessage(self.parts, self.parent_header, self.channel_name)
+        message.seq = self.seq
+        message._header = self._header
+        return message
+
+    def to_legacy(self) -> Union[str, bytes]:
+        """
+        Returns:
+            The message in the legacy protocol: a JSON string, or bytes if the message has
+                buffers.
+        """
+        if self._legacy is None:
+            self._legacy = serialize_msg_to_ws_legacy(
+                self.parts, self.header, self.channel_name
+            )
+        return self._legacy
+
+    def to_v1(self) -> bytes:
+        """
+        Returns:
+            The message in the v1.kernel.websocket.jupyter.org protocol.
+        """
+        if self._v1 is None:
+            self._v1 = b"".join(serialize_msg_to_ws_v1(self.parts, self.channel_name))
+        return self._v1
+
+
+def serialize_msg_to_ws_legacy(
+    parts: List[Part], header: Dict[str, Any], channel: str
+) -> Union[str, bytes]:
+    # the JSON message is spliced from the JSON parts received from the kernel,
+    # which are not decoded and re-encoded
+    buffers = parts[5:]
+    json_msg = b"".join(
+        [
+            b'{"header":',
+            parts[1],
+            b',"msg_id":',
+            dumps(header["msg_id"]),
+            b',"msg_type":',
+            dumps(header["msg_type"]),
+            b',"parent_header":',
+            parts[2],
+            b',"metadata":',
+            parts[3],
+            b',"content":',
+            parts[4],
+            b',"channel":',
+            dumps(channel),
+            b"}" if buffers else b',"buffers":[]}',
+        ]
+    )
+    if not buffers:
+        return json_msg.decode("utf-8")
+    # same layout as to_binary
+    chunks = [json_msg, *buffers]
+    n = len(chunks)
+    offsets = [4 * (n + 1)]
+    for chunk in chunks[:-1]:
+        offsets.append(offsets[-1] + len(chunk))
+    offsets_b = struct.pack(f"!{n + 1}I", n, *offsets)
+    return b"".join([offsets_b, *chunks])
@@ -0,0 +1,132 @@
+import json
+from typing import Callable, Dict, List, Optional
+
+import structlog
+from anyio import TASK_STATUS_IGNORED, Event, create_task_group
+from anyio.abc import TaskGroup, TaskStatus
+
+from ..kernel_driver.kernelspec import find_kernelspec
+from ..kernel_driver.message import create_message, send_message
+from .server import KernelServer
+
+logger = structlog.get_logger()
+
+
+def is_python_kernel(kernel_name: str) -> bool:
+    kernelspec_path = find_kernelspec(kernel_name)
+    if not kernelspec_path:
+        return False
+    with open(kernelspec_path) as f:
+        kernelspec = json.load(f)
+    return kernelspec.get("language", "").lower() == "python"
+
+
+class KernelPool:
+    """A pool of ready kernels per kernelspec, so that a new session attaches to an already
+    running kernel instead of waiting for a kernel to start.
+
+    Only Python kernels can be pooled, since a kernel's working directory is changed by
+    executing code when it is checked out.
+    """
+
+    task_group: TaskGroup
+
+    def __init__(
+        self,
+        size: int,
+        kernel_names: List[str],
+        create_kernel_server: Callable[[str, str], KernelServer],
+    ) -> None:
+        """
+        Arguments:
+            size: The number of ready kernels kept per kernelspec.
+            kernel_names: The names of the kernelspecs to keep ready kernels for.
+            create_kernel_server: A function creating a kernel server, given a kernel name and
+                the kernel's working directory.
+        """
+        self.size = size
+        self.kernel_names = []
+        for kernel_name in kernel_names:
+            if is_python_kernel(kernel_name):
+                self.kernel_names.append(kernel_name)
+            else:
+                logger.warning("Only Python kernels can be pooled", kernel_name=kernel_name)
+        self._create_kernel_server = create_kernel_server
+        self._ready_kernels: Dict[str, List[KernelServer]] = {
+            kernel_name: [] for kernel_name in self.kernel_names
+        }
+        self._starting_kernels: Dict[str, int] = {
+            kernel_name: 0 for kernel_name in self.kernel_names
+        }
+        self._kernels_started = Event()
+        self._stopping = False
+
+    async def start(self, *, task_status: TaskStatus[None] = TASK_STATUS_IGNORED) -> None:
+        async with create_task_group() as tg:
+            self.task_group = tg
+            for kernel_name in self.kernel_names:
+                self._fill(kernel_name)
+            task_status.started()
+
+    async def stop(self) -> None:
+        # kernels that are still starting are stopped once they are ready
+        self._stopping = True
+        async with create_task_group() as tg:
+            for ready_kernels in self._ready_kernels.values():
+                for kernel_server in ready_kernels:
+                    tg.start_soon(kernel_server.stop)
+                ready_kernels.clear()
+        if any(self._starting_kernels.values()):
+            await self._kernels_started.wait()
+        self.task_group.cancel_scope.cancel()
+
+    def ready_kernels(self, kernel_name: str) -> int:
+        return len(self._ready_kernels.get(kernel_name, []))
+
+    async def checkout(self, kernel_name: str, kernel_cwd: str) -> Optional[KernelServer]:
+        """Take a ready kernel from the pool, which is refilled in the background.
+
+        Arguments:
+            kernel_name: The name of the kernelspec.
+            kernel_cwd: The working directory of the kernel.
+
+        Returns:
+            A running kernel server, or None if there is no ready kernel for this kernelspec.
+        """
+        ready_kernels = self._ready_kernels.get(kernel_name)
+        if not ready_kernels:
+            return None
+        kernel_server = ready_kernels.pop(0)
+        self._fill(kernel_name)
+        kernel_server.kernel_cwd = kernel_cwd
+        # requests on the shell channel are executed in order,
+        # so this is done before anything the session executes
+        code = f"import os; os.chdir({kernel_cwd!r}); del os"
+        msg = create_message(
+            "execute_request", content={"code": code, "silent": True, "store_history": False}
+        )
+        await send_message(msg, kernel_server.shell_channel, kernel_server.key)
+        return kernel_server
+
+    def _fill(self, kernel_name: str) -> None:
+        ready_kernel_nb = len(self._ready_kernels[kernel_name])
+        while ready_kernel_nb + self._starting_kernels[kernel_name] < self.size:
+            self._starting_kernels[kernel_name] += 1
+            self._kernels_started = Event()
+            self.task_group.start_soon(self._start_kernel, kernel_name)
+
+    async def _start_kernel(self, kernel_name: str) -> None:
+        kernel_server = self._create_kernel_server(kernel_name, "")
+        try:
+            await self.task_group.start(kernel_server.start)
+        except Exception as e:
+            logger.error("Could not start pooled kernel", kernel_name=kernel_name, exc_info=e)
+        else:
+            if self._stopping:
+                await kernel_server.stop()
+            else:
+                self._ready_kernels[kernel_name].append(kernel_server)
+                logger.debug("Pooled kernel ready", kernel_name=kernel_name)
+        self._starting_kernels[kernel_name] -= 1
+        if not any(self._starting_kernels.values()):
+            self._kernels_started.set()
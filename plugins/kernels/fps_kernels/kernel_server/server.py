@@ -1,33 +1,73 @@
-import json
 import signal
 import uuid
+from collections import deque
 from datetime import datetime, timezone
-from typing import Dict, Iterable, List, Optional, cast
+from typing import Deque, Dict, Iterable, List, Literal, Optional, Set, cast
 
 import anyio
-from anyio import TASK_STATUS_IGNORED, Event, create_task_group
+import structlog
+from anyio import (
+    TASK_STATUS_IGNORED,
+    BrokenResourceError,
+    CancelScope,
+    ClosedResourceError,
+    Event,
+    Lock,
+    WouldBlock,
+    create_memory_object_stream,
+    create_task_group,
+    fail_after,
+    move_on_after,
+)
 from anyio.abc import TaskGroup, TaskStatus
+from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
 from fastapi import WebSocket, WebSocketDisconnect
 from starlette.websockets import WebSocketState
 
-from ..kernel_driver.connect import cfg_t, connect_channel, read_connection_file
+from ..kernel_driver.codec import loads
+from ..kernel_driver.connect import (
+    cfg_t,
+    connect_channel,
+    read_connection_file,
+    remove_ipc_files,
+)
 from ..kernel_driver.connect import launch_kernel as _launch_kernel
 from ..kernel_driver.connect import (
     write_connection_file as _write_connection_file,
 )
-from ..kernel_driver.message import create_message, receive_message, send_message
+from ..kernel_driver.forkserver import ForkServer
+from ..kernel_driver.iopub import (
+    MAX_COALESCED_MESSAGES,
+    OUTPUT_MSG_TYPES,
+    IOPubRateLimiter,
+    coalesce_stream_parts,
+)
+from ..kernel_driver.lifecycle import Heartbeat, wait_for_ready
+from ..kernel_driver.message import (
+    Part,
+    create_message,
+    create_message_header,
+    pack,
+    send_message,
+    unpack,
+)
 from .message import (
+    KernelMessage,
     deserialize_msg_from_ws_v1,
     from_binary,
-    get_msg_from_parts,
     get_parent_header,
     get_zmq_parts,
     send_raw_message,
-    serialize_msg_to_ws_v1,
-    to_binary,
 )
 
 kernels: dict = {}
+logger = structlog.get_logger()
+STATUS = b'"status"'
+COMM = b'"comm_'
+# the maximum number of disconnected sessions that can get a replay of missed IOPub messages
+MAX_DISCONNECTED_SESSIONS = 1024
+# the time in seconds after which a subscriber that doesn't receive its messages is unsubscribed
+SUBSCRIBER_TIMEOUT = 10
 
 
 class AcceptedWebSocket:
@@ -56,6 +96,19 @@ class KernelServer:
         connection_file: str = "",
         write_connection_file: bool = True,
         capture_kernel_output: bool = True,
+        session_queue_size: int = 1024,
+        session_queue_overflow: Literal["drop", "disconnect"] = "disconnect",
+        iopub_msg_rate_limit: Optional[float] = None,
+        iopub_data_rate_limit: Optional[float] = None,
+        iopub_rate_limit_window: float = 3,
+        iopub_replay_buffer_size: int = 1024,
+        iopub_replay_buffer_max_bytes: int = 16 * 1024 * 1024,
+        fork_server: Optional[ForkServer] = None,
+        heartbeat_interval: float = 0,
+        auto_restart: bool = False,
+        restart_limit: int = 5,
+        shutdown_timeout: float = 5,
+        transport: Literal["tcp", "ipc"] = "tcp",
     ) -> None:
         self.capture_kernel_output = capture_kernel_output
         self.kernelspec_path = kernelspec_path
@@ -63,17 +116,62 @@ class KernelServer:
         self.connection_cfg = connection_cfg
         self.connection_file = connection_file
         self.write_connection_file = write_connection_file
+        # "tcp", or "ipc" for Unix domain sockets
+        self.transport = transport
+        # Python kernels are forked from the fork server if there is one
+        self.fork_server = fork_server
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat: Optional[Heartbeat] = None
+        # a kernel whose process dies is restarted, unless it keeps dying before it is ready
+        self.auto_restart = auto_restart
+        self.restart_limit = restart_limit
+        # the time given to a kernel to shut down when it is restarted, before it is terminated
+        self.shutdown_timeout = shutdown_timeout
+        self._stopping = False
+        self._launched = False
+        self._restart_lock = Lock()
+        self._kernel_info_replied = Event()
+        # the session of the requests sent by the server itself
+        self.session_id = uuid.uuid4().hex
         self.sessions: Dict[str, AcceptedWebSocket] = {}
+        # messages to a session are queued, and sent by a task per session
+        self.session_queue_size = session_queue_size
+        self.session_queue_overflow = session_queue_overflow
+        self.session_queues: Dict[str, MemoryObjectSendStream] = {}
+        self.session_cancel_scopes: Dict[str, CancelScope] = {}
+        # the messages replying to a subscriber's requests are dispatched to it, e.g. to a
+        # KernelDriver sharing the channels of this server
+        self.subscribers: Dict[str, MemoryObjectSendStream] = {}
+        # the subscribers which also get all the comm messages on IOPub
+        self.comm_subscribers: Set[str] = set()
+        self.iopub_rate_limiter = IOPubRateLimiter(
+            iopub_msg_rate_limit, iopub_data_rate_limit, iopub_rate_limit_window
+        )
+        # the recent IOPub messages, replayed to a session that reconnects
+        self.iopub_buffer: Deque[KernelMessage] = deque()
+        self.iopub_buffer_bytes = 0
+        self.iopub_replay_buffer_size = iopub_replay_buffer_size
+        self.iopub_replay_buffer_max_bytes = iopub_replay_buffer_max_bytes
+        self.iopub_seq = 0
+        # the sequence number of the last IOPub message sent to each session
+        self.session_iopub_seqs: Dict[str, int] = {}
         # blocked messages and allowed messages are mutually exclusive
         self.blocked_messages: List[str] = []
         self.allowed_messages: Optional[List[str]] = None  # when None, all messages are allowed
         # when [], no message is allowed
+        self._set_starting()
         self.setup_connection_file()
 
+    def _set_starting(self) -> None:
+        self.last_activity = {
+            "date": datetime.now(tz=timezone.utc).isoformat().replace("+00:00", "Z"),
+            "execution_state": "starting",
+        }
+
     def setup_connection_file(self):
         if self.write_connection_file:
             self.connection_file_path, self.connection_cfg = _write_connection_file(
-                self.connection_file
+                self.connection_file, transport=self.transport
             )
         elif self.connection_file:
             self.connection_file_path = self.connection_file
@@ -104,24 +202,27 @@ class KernelServer:
     def connections(self) -> int:
         return len(self.sessions)
 
+    @property
+    def execution_state(self) -> str:
+        execution_state = self.last_activity["execution_state"]
+        if self.heartbeat is None or self.heartbeat.responsive:
+            return execution_state
+        if execution_state in ("starting", "restarting", "autorestarting", "dead"):
+            return execution_state
+        return "unknown"
+
     async def start(
         self, launch_kernel: bool = True, *, task_status: TaskStatus[None] = TASK_STATUS_IGNORED
     ) -> None:
         async with create_task_group() as tg:
             self.task_group = tg
-            self.last_activity = {
-                "date": datetime.now(tz=timezone.utc).isoformat().replace("+00:00", "Z"),
-                "execution_state": "starting",
-            }
+            self._stopping = False
+            self._set_starting()
             if launch_kernel:
                 if not self.kernelspec_path:
                     raise RuntimeError("Could not find a kernel, maybe you forgot to install one?")
-                self.kernel_process = await _launch_kernel(
-                    self.kernelspec_path,
-                    self.connection_file_path,
-                    self.kernel_cwd,
-                    self.capture_kernel_output,
-                )
+                await self._launch()
+            self._launched = launch_kernel
             assert self.connection_cfg is not None
             identity = uuid.uuid4().hex.encode("ascii")
             self.shell_channel = connect_channel("shell", self.connection_cfg, identity=identity)
@@ -130,14 +231,69 @@ class KernelServer:
                 "control", self.connection_cfg, identity=identity
             )
             self.iopub_channel = connect_channel("iopub", self.connection_cfg)
-            await self._wait_for_ready()
+            await self._wait_for_ready(launch_kernel)
             tg.start_soon(lambda: self.listen("shell"))
             tg.start_soon(lambda: self.listen("stdin"))
             tg.start_soon(lambda: self.listen("control"))
             tg.start_soon(lambda: self.listen("iopub"))
+            if launch_kernel:
+                await tg.start(self._watch_process)
+            if self.heartbeat_interval > 0:
+                self.heartbeat = Heartbeat(self.connection_cfg, self.heartbeat_interval)
+                tg.start_soon(self.heartbeat.run)
             task_status.started()
 
+    async def _launch(self) -> None:
+        if self.fork_server is None:
+            launch = _launch_kernel
+        else:
+            launch = self.fork_server.launch_kernel
+        self.kernel_process = await launch(
+            self.kernelspec_path,
+            self.connection_file_path,
+            self.kernel_cwd,
+            self.capture_kernel_output,
+        )
+
+    async def _watch_process(self, *, task_status: TaskStatus[None] = TASK_STATUS_IGNORED) -> None:
+        with CancelScope() as self._watch_cancel_scope:
+            task_status.started()
+            await self._restart_dead_kernel()
+
+    async def _restart_dead_kernel(self) -> None:
+        restart_nb = 0
+        while True:
+            await self.kernel_process.wait()
+            if self._stopping:
+                return
+            if self.last_activity["execution_state"] != "autorestarting":
+                # the kernel was ready before it died
+                restart_nb = 0
+            if not self.auto_restart or restart_nb == self.restart_limit:
+                logger.error("Kernel died", returncode=self.kernel_process.returncode)
+                self.set_execution_state("dead")
+                return
+            restart_nb += 1
+            logger.warning(
+                "Kernel died, restarting it",
+                returncode=self.kernel_process.returncode,
+                restart_nb=restart_nb,
+            )
+            self.set_execution_state("autorestarting")
+            # the kernel is launched with the same connection file, so that the channels
+            # reconnect to it, and it is ready when it replies to this request
+            with CancelScope(shield=True):
+                await self._launch()
+                if self._stopping:
+                    self.kernel_process.terminate()
+                    return
+            msg = create_message(
+                "kernel_info_request", session_id=self.session_id, msg_id=f"restart_{restart_nb}"
+            )
+            await send_message(msg, self.shell_channel, self.key)
+
     async def stop(self) -> None:
+        self._stopping = True
         try:
             self.kernel_process.terminate()
         except ProcessLookupError:
@@ -150,14 +306,73 @@ class KernelServer:
                 await path.unlink()
             except Exception:
                 pass
+            assert self.connection_cfg is not None
+            remove_ipc_files(self.connection_cfg)
 
     def interrupt(self) -> None:
         self.kernel_process.send_signal(signal.SIGINT)
 
-    async def restart(self, *, task_status: TaskStatus[None] = TASK_STATUS_IGNORED) -> None:
-        await self.stop()
-        self.setup_connection_file()
-        await self.start(task_status=task_status)
+    async def restart(self) -> None:
+        """Restart the kernel in place: the kernel is asked to shut down, and is launched again
+        with the same connection file, so that the channels and the sessions stay connected.
+        """
+        if not self._launched:
+            raise RuntimeError("Cannot restart a kernel that was not launched by the server")
+        async with self._restart_lock:
+            # the kernel's exit is expected
+            self._watch_cancel_scope.cancel()
+            self.set_execution_state("restarting")
+            msg = create_message(
+                "shutdown_request", session_id=self.session_id, content={"restart": True}
+            )
+            await send_message(msg, self.control_channel, self.key)
+            with move_on_after(self.shutdown_timeout):
+                await self.kernel_process.wait()
+            if self.kernel_process.returncode is None:
+                logger.warning("Kernel did not shut down, terminating it")
+                try:
+                    self.kernel_process.terminate()
+                    with move_on_after(self.shutdown_timeout):
+                        await self.kernel_process.wait()
+                    if self.kernel_process.returncode is None:
+                        self.kernel_process.kill()
+                except ProcessLookupError:
+                    pass
+                await self.kernel_process.wait()
+            if self._stopping:
+                # the kernel was stopped while it was shutting down
+                return
+            with CancelScope(shield=True):
+                await self._launch()
+                if self._stopping:
+                    self.kernel_process.terminate()
+                    await self.kernel_process.wait()
+                    return
+            await self._wait_for_restart()
+            if not self._stopping:
+                await self.task_group.start(self._watch_process)
+
+    async def _wait_for_restart(self) -> None:
+        # the kernel is ready when it replies to this request, which is queued until it listens
+        self._kernel_info_replied = Event()
+        msg = create_message("kernel_info_request", session_id=self.session_id)
+        await send_message(msg, self.shell_channel, self.key)
+        async with create_task_group() as tg:
+
+            async def wait_for_reply() -> None:
+                await self._kernel_info_replied.wait()
+                tg.cancel_scope.cancel()
+
+            tg.start_soon(wait_for_reply)
+            await self.kernel_process.wait()
+            if self._stopping:
+                # the kernel was stopped while it was starting
+                tg.cancel_scope.cancel()
+                return
+            self.set_execution_state("dead")
+            raise RuntimeError(
+                f"Kernel died while restarting (return code {self.kernel_process.returncode})"
+            )
 
     async def serve(
         self,
@@ -167,14 +382,117 @@ class KernelServer:
         stop_event: Event,
     ):
         self.sessions[session_id] = websocket
+        send_stream, receive_stream = create_memory_object_stream[tuple](
+            max_buffer_size=self.session_queue_size
+        )
+        # no await until the session is registered, so that no message is missed
+        self.replay_iopub(session_id, send_stream)
+        self.session_queues[session_id] = send_stream
         self.can_execute = permissions is None or "execute" in permissions.get("kernels", [])
         async with create_task_group() as tg:
+            self.session_cancel_scopes[session_id] = tg.cancel_scope
             tg.start_soon(self.listen_web, websocket, tg)
+            tg.start_soon(self.send_queued_to_ws, websocket, session_id, receive_stream, tg)
             tg.start_soon(self._watch_stop, tg, stop_event)
 
         # the session could have been removed through the REST API, so check if it still exists
         if session_id in self.sessions:
             del self.sessions[session_id]
+        if self.session_queues.get(session_id) is send_stream:
+            del self.session_queues[session_id]
+            del self.session_cancel_scopes[session_id]
+        send_stream.close()
+        # keep the position of the most recently disconnected sessions, for them to reconnect
+        disconnected_sessions = [
+            _session_id
+            for _session_id in self.session_iopub_seqs
+            if _session_id not in self.session_queues
+        ]
+        for _session_id in disconnected_sessions[:-MAX_DISCONNECTED_SESSIONS]:
+            del self.session_iopub_seqs[_session_id]
+
+    def replay_iopub(self, session_id: str, send_stream: MemoryObjectSendStream) -> None:
+        """Queue the IOPub messages that a reconnecting session missed while it was away."""
+        last_seq = self.session_iopub_seqs.get(session_id)
+        if last_seq is None:
+            # a new session only gets the messages from now on
+            self.session_iopub_seqs[session_id] = self.iopub_seq
+            return
+        missed_messages = [
+            message for message in self.iopub_buffer if cast(int, message.seq) > last_seq
+        ]
+        if not missed_messages:
+            return
+        if missed_messages[0].seq != last_seq + 1 or len(missed_messages) > self.session_queue_size:
+            logger.warning("Some IOPub messages are too old to be replayed", session_id=session_id)
+        logger.debug(
+            "Replaying IOPub messages", session_id=session_id, message_nb=len(missed_messages)
+        )
+        for message in missed_messages[-self.session_queue_size :]:  # noqa
+            send_stream.send_nowait(message)
+
+    def subscribe(
+        self, session_id: str, comm_messages: bool = False
+    ) -> MemoryObjectReceiveStream[KernelMessage]:
+        """Subscribe to the messages of the kernel on all channels, instead of connecting to
+        the kernel again: each message is received and its parent header is parsed once,
+        whoever it is dispatched to.
+
+        Arguments:
+            session_id: The session of the subscriber's requests, whose replies and outputs
+                are dispatched to the subscriber.
+            comm_messages: Whether the subscriber also gets all the comm messages on IOPub,
+                whatever their parent.
+
+        Returns:
+            The stream of messages, which is closed when unsubscribing. The kernel's messages
+                are not received while a subscriber's stream is full, and a subscriber that
+                doesn't receive its messages for SUBSCRIBER_TIMEOUT seconds is unsubscribed.
+        """
+        send_stream, receive_stream = create_memory_object_stream[KernelMessage](
+            max_buffer_size=self.session_queue_size
+        )
+        self.subscribers[session_id] = send_stream
+        if comm_messages:
+            self.comm_subscribers.add(session_id)
+        return receive_stream
+
+    def unsubscribe(self, session_id: str) -> None:
+        self.comm_subscribers.discard(session_id)
+        send_stream = self.subscribers.pop(session_id, None)
+        if send_stream is not None:
+            send_stream.close()
+
+    async def dispatch_to_subscribers(self, message: KernelMessage) -> None:
+        session = message.parent_header.get("session")
+        if session in self.subscribers:
+            await self.send_to_subscriber(session, message)
+        if (
+            self.comm_subscribers
+            and message.channel_name == "iopub"
+            and COMM in message.parts[1]
+            and message.header["msg_type"] in ("comm_open", "comm_msg", "comm_close")
+        ):
+            for session_id in list(self.comm_subscribers):
+                if session_id != session:
+                    await self.send_to_subscriber(session_id, message)
+
+    async def send_to_subscriber(self, session_id: str, message: KernelMessage) -> None:
+        send_stream = self.subscribers.get(session_id)
+        if send_stream is None:
+            # the subscriber unsubscribed while another one was receiving the message
+            return
+        try:
+            # missing messages would leave the subscriber in an inconsistent state,
+            # so a subscriber that is behind slows down the kernel's messages
+            with fail_after(SUBSCRIBER_TIMEOUT):
+                await send_stream.send(message)
+        except TimeoutError:
+            logger.warning("Unsubscribing stuck subscriber", session_id=session_id)
+            self.unsubscribe(session_id)
+        except (BrokenResourceError, ClosedResourceError):
+            # the subscriber is gone
+            self.unsubscribe(session_id)
 
     async def _watch_stop(self, tg: TaskGroup, stop_event: Event):
         await stop_event.wait()
@@ -187,41 +505,172 @@ class KernelServer:
             pass
         tg.cancel_scope.cancel()
 
+    async def send_queued_to_ws(
+        self,
+        websocket: AcceptedWebSocket,
+        session_id: str,
+        receive_stream: MemoryObjectReceiveStream,
+        tg: TaskGroup,
+    ):
+        try:
+            async with receive_stream:
+                async for message in receive_stream:
+                    await self.send_to_ws(websocket, message)
+                    if message.seq is not None:
+                        self.session_iopub_seqs[session_id] = message.seq
+        except Exception:
+            # the websocket is closed
+            pass
+        tg.cancel_scope.cancel()
+
+    def queue_message(self, session_id: str, message: KernelMessage) -> None:
+        """Queue a message to be sent to a session, without waiting for the session's websocket.
+
+        If the session's queue is full, an IOPub message is dropped or the session is
+        disconnected, depending on the overflow policy. The session is always disconnected if
+        it cannot receive a shell, control or stdin message, because a reply must not be lost.
+        """
+        try:
+            self.session_queues[session_id].send_nowait(message)
+        except WouldBlock:
+            if self.session_queue_overflow == "drop" and message.channel_name == "iopub":
+                logger.debug("Dropping message to slow session", session_id=session_id)
+            else:
+                logger.warning("Disconnecting slow session", session_id=session_id)
+                self.session_cancel_scopes[session_id].cancel()
+        except BrokenResourceError:
+            # the session's websocket was closed, and the session is being removed
+            pass
+
     async def listen(self, channel_name: str):
         if channel_name == "shell":
             channel = self.shell_channel
         elif channel_name == "control":
             channel = self.control_channel
         elif channel_name == "iopub":
-            channel = self.iopub_channel
+            await self.listen_iopub()
+            return
         elif channel_name == "stdin":
             channel = self.stdin_channel
 
         while True:
             parts = await get_zmq_parts(channel)
             parent_header = get_parent_header(parts)
-            if channel == self.iopub_channel:
-                # broadcast to all web clients
-                for websocket in self.sessions.values():
-                    await self.send_to_ws(websocket, parts, parent_header, channel_name)
-            else:
-                session = parent_header["session"]
-                if session in self.sessions:
-                    websocket = self.sessions[session]
-                    await self.send_to_ws(websocket, parts, parent_header, channel_name)
+            # the message is serialized at most once per protocol, for all sessions
+            message = KernelMessage(parts, parent_header, channel_name)
+            session = parent_header["session"]
+            if session in self.session_queues:
+                self.queue_message(session, message)
+            elif session in self.subscribers:
+                await self.dispatch_to_subscribers(message)
+            elif session == self.session_id:
+                if parent_header.get("msg_type") != "kernel_info_request":
+                    continue
+                if self.last_activity["execution_state"] in ("autorestarting", "restarting"):
+                    # the kernel was restarted, and its status messages could have been
+                    # published before IOPub reconnected
+                    self.set_execution_state("idle")
+                self._kernel_info_replied.set()
 
-    async def _wait_for_ready(self):
+    async def listen_iopub(self):
         while True:
-            msg = create_message("kernel_info_request")
-            await send_message(msg, self.shell_channel, self.key)
-            msg = await receive_message(self.shell_channel, timeout=0.2)
-            if msg is not None and msg["msg_type"] == "kernel_info_reply":
-                msg = await receive_message(self.iopub_channel, timeout=0.2)
-                if msg is None:
-                    # IOPub not connected, start over
-                    pass
-                else:
-                    break
+            batch = [await get_zmq_parts(self.iopub_channel)]
+            # the messages that are already pending are received at once,
+            # so that consecutive stream messages are sent as one message
+            while len(batch) < MAX_COALESCED_MESSAGES and await self.iopub_channel.poll(0):
+                batch.append(await get_zmq_parts(self.iopub_channel))
+            for parts in coalesce_stream_parts(batch):
+                message = KernelMessage(parts, get_parent_header(parts), "iopub")
+                self.update_last_activity(message)
+                limited_message = self.limit_iopub_rate(message)
+                if limited_message is not None:
+                    self.broadcast_iopub(limited_message)
+                    if self.subscribers:
+                        # the subscribers get the same rate-limited output as the clients
+                        await self.dispatch_to_subscribers(limited_message)
+
+    def broadcast_iopub(self, message: KernelMessage) -> None:
+        self.iopub_seq += 1
+        message.seq = self.iopub_seq
+        self.buffer_iopub(message)
+        # broadcast to all web clients
+        for session_id in list(self.session_queues):
+            self.queue_message(session_id, message)
+
+    def buffer_iopub(self, message: KernelMessage) -> None:
+        """Keep an IOPub message for replay, within the limits of the replay buffer."""
+        # the buffered message doesn't keep the wire representations of the sent message
+        message = message.uncached()
+        self.iopub_buffer.append(message)
+        self.iopub_buffer_bytes += message.size
+        while (
+            len(self.iopub_buffer) > self.iopub_replay_buffer_size
+            or self.iopub_buffer_bytes > self.iopub_replay_buffer_max_bytes
+        ):
+            self.iopub_buffer_bytes -= self.iopub_buffer.popleft().size
+
+    def limit_iopub_rate(self, message: KernelMessage) -> Optional[KernelMessage]:
+        """
+        Returns:
+            The message to send to the clients: the message itself, a notice if the output
+                just started to be throttled, or None if the message is dropped.
+        """
+        rate_limiter = self.iopub_rate_limiter
+        if not rate_limiter.enabled or message.header["msg_type"] not in OUTPUT_MSG_TYPES:
+            return message
+        action = rate_limiter.limit(message.size)
+        if action == "drop":
+            return None
+        if action == "notify":
+            logger.warning("IOPub output rate exceeded, throttling kernel output")
+            header = create_message_header("stream", "", "")
+            content = {"name": "stderr", "text": rate_limiter.notice}
+            parts = [b"", pack(header), message.parts[2], pack({}), pack(content)]
+            return KernelMessage(parts, message.parent_header, "iopub")
+        return message
+
+    def set_execution_state(self, execution_state: str) -> None:
+        """Set the execution state of a kernel that cannot report it, e.g. because it died,
+        and broadcast it to the clients in a status message.
+        """
+        header = create_message_header("status", "", "")
+        content = {"execution_state": execution_state}
+        parts: List[Part] = [b"", pack(header), pack({}), pack({}), pack(content)]
+        message = KernelMessage(parts, {}, "iopub")
+        self.last_activity = {"date": header["date"], "execution_state": execution_state}
+        self.broadcast_iopub(message)
+
+    def update_last_activity(self, message: KernelMessage) -> None:
+        # only status messages are parsed, and they are small:
+        # most messages are discarded without parsing their header
+        if STATUS not in message.parts[1] or message.header["msg_type"] != "status":
+            return
+        content = unpack(message.parts[4])
+        execution_state = content["execution_state"]
+        if self.last_activity["execution_state"] in ("restarting", "autorestarting"):
+            # a restarting kernel is ready when it replies to the server's kernel_info_request,
+            # whatever the status of the old or the new kernel process
+            execution_state = self.last_activity["execution_state"]
+        self.last_activity = {
+            "date": message.header["date"],
+            "execution_state": execution_state,
+        }
+
+    async def _wait_for_ready(self, launched: bool) -> None:
+        async with create_task_group() as tg:
+
+            async def wait_for_kernel() -> None:
+                await wait_for_ready(
+                    self.shell_channel, self.iopub_channel, self.key, self.session_id
+                )
+                tg.cancel_scope.cancel()
+
+            tg.start_soon(wait_for_kernel)
+            if launched:
+                await self.kernel_process.wait()
+                raise RuntimeError(
+                    f"Kernel died while starting (return code {self.kernel_process.returncode})"
+                )
 
     async def send_to_zmq(self, websocket):
         if not websocket.accepted_subprotocol:
@@ -249,7 +698,7 @@ class KernelServer:
                 channel, parts = deserialize_msg_from_ws_v1(msg)
                 # NOTE: we parse the header for message filtering
                 # it is not as bad as parsing the content
-                header = json.loads(parts[0])
+                header = unpack(parts[0])
                 msg_type = header["msg_type"]
                 if (msg_type in self.blocked_messages) or (
                     self.allowed_messages is not None and msg_type not in self.allowed_messages
@@ -262,27 +711,16 @@ class KernelServer:
                 elif channel == "stdin":
                     await send_raw_message(parts, self.stdin_channel, self.key)
 
-    async def send_to_ws(self, websocket, parts, parent_header, channel_name):
+    async def send_to_ws(self, websocket: AcceptedWebSocket, message: KernelMessage):
         if not websocket.accepted_subprotocol:
             # default, "legacy" protocol
-            msg = get_msg_from_parts(parts, parent_header=parent_header)
-            msg["channel"] = channel_name
-            await send_json_or_bytes(websocket.websocket, msg)
-            if channel_name == "iopub":
-                if "content" in msg and "execution_state" in msg["content"]:
-                    self.last_activity = {
-                        "date": msg["header"]["date"],
-                        "execution_state": msg["content"]["execution_state"],
-                    }
+            legacy_msg = message.to_legacy()
+            if isinstance(legacy_msg, str):
+                await websocket.websocket.send_text(legacy_msg)
+            else:
+                await websocket.websocket.send_bytes(legacy_msg)
         elif websocket.accepted_subprotocol == "v1.kernel.websocket.jupyter.org":
-            bin_msg = b"".join(serialize_msg_to_ws_v1(parts, channel_name))
-            try:
-                await websocket.websocket.send_bytes(bin_msg)
-            except BaseException:
-                pass
-            # FIXME: update last_activity
-            # but we don't want to parse the content!
-            # or should we request it from the control channel?
+            await websocket.websocket.send_bytes(message.to_v1())
 
 
 async def receive_json_or_bytes(websocket):
@@ -290,14 +728,6 @@ async def receive_json_or_bytes(websocket):
     message = await websocket.receive()
     websocket._raise_on_disconnect(message)
     if "text" in message:
-        return json.loads(message["text"])
+        return loads(message["text"])
     msg = from_binary(message["bytes"])
     return msg
-
-
-async def send_json_or_bytes(websocket, msg):
-    bmsg = to_binary(msg)
-    if bmsg is None:
-        await websocket.send_json(msg)
-    else:
-        await websocket.send_bytes(bmsg)
@@ -1,15 +1,16 @@
 import json
 import uuid
+from datetime import datetime, timezone
 from functools import partial
 from http import HTTPStatus
 from pathlib import Path
-from typing import Dict, List, Optional, Set, Tuple
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 import structlog
-from anyio import TASK_STATUS_IGNORED, Event, Lock, create_task_group
+from anyio import TASK_STATUS_IGNORED, Event, Lock, create_task_group, sleep
 from anyio.abc import TaskStatus
 from fastapi import HTTPException, Response
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 from starlette.requests import Request
 from watchfiles import Change, awatch
 
@@ -17,13 +18,24 @@ from jupyverse_api.app import App
 from jupyverse_api.auth import Auth, User
 from jupyverse_api.frontend import FrontendConfig
 from jupyverse_api.kernels import Kernels, KernelsConfig
-from jupyverse_api.kernels.models import CreateSession, Execution, Kernel, Notebook, Session
+from jupyverse_api.kernels.models import (
+    BatchExecution,
+    CancelExecution,
+    CreateSession,
+    Execution,
+    ExecutionQueueStatus,
+    Kernel,
+    Notebook,
+    Session,
+)
 from jupyverse_api.main import Lifespan
 from jupyverse_api.yjs import Yjs
 
 from .kernel_driver.driver import KernelDriver
-from .kernel_driver.kernelspec import find_kernelspec, kernelspec_dirs
+from .kernel_driver.forkserver import ForkServer
+from .kernel_driver.kernelspec import KernelspecRegistry
 from .kernel_driver.paths import jupyter_runtime_dir
+from .kernel_server.pool import KernelPool
 from .kernel_server.server import (
     AcceptedWebSocket,
     KernelServer,
@@ -49,17 +61,56 @@ class _Kernels(Kernels):
         self.yjs = yjs
         self.lifespan = lifespan
 
-        self.kernelspecs: dict = {}
+        self.kernelspec_registry = KernelspecRegistry()
         self.kernel_id_to_connection_file: Dict[str, str] = {}
         self.sessions: Dict[str, Session] = {}
         self.kernels = kernels
         self._app = app
         self.stop_event = Event()
         self._stop_lock = Lock()
+        self.kernel_pool: Optional[KernelPool] = None
+        self.fork_server: Optional[ForkServer] = None
+
+    def get_kernel_server_kwargs(self) -> Dict[str, Any]:
+        return {
+            "session_queue_size": self.kernels_config.session_queue_size,
+            "session_queue_overflow": self.kernels_config.session_queue_overflow,
+            "iopub_replay_buffer_size": self.kernels_config.iopub_replay_buffer_size,
+            "iopub_replay_buffer_max_bytes": self.kernels_config.iopub_replay_buffer_max_bytes,
+            "fork_server": self.fork_server,
+            "heartbeat_interval": self.kernels_config.heartbeat_interval,
+            "auto_restart": self.kernels_config.kernel_auto_restart,
+            "restart_limit": self.kernels_config.kernel_restart_limit,
+            "shutdown_timeout": self.kernels_config.kernel_shutdown_timeout,
+            "transport": self.kernels_config.kernel_transport,
+            "iopub_msg_rate_limit": self.kernels_config.iopub_msg_rate_limit,
+            "iopub_data_rate_limit": self.kernels_config.iopub_data_rate_limit,
+            "iopub_rate_limit_window": self.kernels_config.iopub_rate_limit_window,
+        }
+
+    def create_kernel_server(self, kernel_name: str, kernel_cwd: str) -> KernelServer:
+        return KernelServer(
+            kernelspec_path=Path(self.kernelspec_registry.find(kernel_name)).as_posix(),
+            kernel_cwd=kernel_cwd,
+            **self.get_kernel_server_kwargs(),
+        )
 
     async def start(self, *, task_status: TaskStatus[None] = TASK_STATUS_IGNORED) -> None:
         async with create_task_group() as tg:
             self.task_group = tg
+            if self.kernels_config.kernel_launcher == "forkserver":
+                self.fork_server = ForkServer(self.kernels_config.forkserver_preload)
+                await tg.start(self.fork_server.start)
+            if self.kernels_config.kernel_pool_size > 0:
+                pooled_kernels = self.kernels_config.pooled_kernels
+                if pooled_kernels is None:
+                    pooled_kernels = [self.kernels_config.default_kernel]
+                self.kernel_pool = KernelPool(
+                    self.kernels_config.kernel_pool_size,
+                    pooled_kernels,
+                    self.create_kernel_server,
+                )
+                await tg.start(self.kernel_pool.start)
             if self.kernels_config.allow_external_kernels:
                 external_connection_dir = self.kernels_config.external_connection_dir
                 if external_connection_dir is None:
@@ -67,6 +118,9 @@ class _Kernels(Kernels):
                 else:
                     path = Path(external_connection_dir)
                 tg.start_soon(lambda: self.watch_connection_files(path))
+            if self.kernels_config.cull_idle_timeout > 0:
+                tg.start_soon(self.cull_kernels)
+            tg.start_soon(self.kernelspec_registry.watch, self.stop_event)
             tg.start_soon(self.on_shutdown)
             task_status.started()
             await self.stop_event.wait()
@@ -76,15 +130,47 @@ class _Kernels(Kernels):
             if self.stop_event.is_set():
                 return
 
+            if self.kernel_pool is not None:
+                await self.kernel_pool.stop()
             async with create_task_group() as tg:
                 for kernel_id, kernel in self.kernels.items():
                     logger.info("Stopping kernel", kernel_id=kernel_id)
                     tg.start_soon(kernel["server"].stop)
                     if kernel["driver"] is not None:
                         tg.start_soon(kernel["driver"].stop)
+            self.kernels.clear()
+            if self.fork_server is not None:
+                await self.fork_server.stop()
             self.stop_event.set()
             self.task_group.cancel_scope.cancel()
 
+    async def cull_kernels(self) -> None:
+        while True:
+            await sleep(self.kernels_config.cull_interval)
+            for kernel_id in list(kernels):
+                # a kernel can be stopped while another one is culled
+                kernel = kernels.get(kernel_id)
+                if kernel is not None and self.is_idle(kernel_id, kernel):
+                    logger.info("Culling idle kernel", kernel_id=kernel_id)
+                    await self.stop_kernel(kernel_id)
+
+    def is_idle(self, kernel_id: str, kernel: Dict[str, Any]) -> bool:
+        kernel_server = kernel["server"]
+        # external kernels are not owned by this server
+        if kernel_id in self.kernel_id_to_connection_file or kernel_server is None:
+            return False
+        if kernel_server.execution_state in ("starting", "restarting", "autorestarting"):
+            return False
+        if kernel_server.connections and not self.kernels_config.cull_connected:
+            return False
+        if kernel_server.execution_state == "busy" and not self.kernels_config.cull_busy:
+            return False
+        last_activity = datetime.fromisoformat(
+            kernel_server.last_activity["date"].replace("Z", "+00:00")
+        )
+        idle_time = datetime.now(tz=timezone.utc) - last_activity
+        return idle_time.total_seconds() > self.kernels_config.cull_idle_timeout
+
     async def on_shutdown(self):
         await self.lifespan.shutdown_request.wait()
         await self.stop()
@@ -107,20 +193,24 @@ class _Kernels(Kernels):
 
     async def get_kernelspecs(
         self,
+        request: Request,
         user: User,
     ):
-        for search_path in kernelspec_dirs():
-            for path in Path(search_path).glob("*/kernel.json"):
-                with open(path) as f:
-                    spec = json.load(f)
-                name = path.parent.name
-                resources = {
-                    f.stem: f"{self.frontend_config.base_url}kernelspecs/{name}/{f.name}"
-                    for f in path.parent.iterdir()
-                    if f.is_file() and f.name != "kernel.json"
-                }
-                self.kernelspecs[name] = {"name": name, "spec": spec, "resources": resources}
-        return {"default": self.kernels_config.default_kernel, "kernelspecs": self.kernelspecs}
+        # the kernelspecs are polled by clients, and they rarely change
+        etag = self.kernelspec_registry.etag
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=HTTPStatus.NOT_MODIFIED.value, headers={"ETag": etag})
+        kernelspecs = {}
+        for name, kernelspec in self.kernelspec_registry.kernelspecs.items():
+            resources = {
+                Path(f).stem: f"{self.frontend_config.base_url}kernelspecs/{name}/{f}"
+                for f in kernelspec["resources"]
+            }
+            kernelspecs[name] = {"name": name, "spec": kernelspec["spec"], "resources": resources}
+        return JSONResponse(
+            {"default": self.kernels_config.default_kernel, "kernelspecs": kernelspecs},
+            headers={"ETag": etag},
+        )
 
     async def get_kernelspec(
         self,
@@ -128,10 +218,11 @@ class _Kernels(Kernels):
         file_name,
         user: User,
     ):
-        for search_path in kernelspec_dirs():
-            file_path = Path(search_path) / kernel_name / file_name
-            if file_path.exists():
-                return FileResponse(file_path)
+        kernelspec = self.kernelspec_registry.kernelspecs.get(kernel_name)
+        if kernelspec is not None and (
+            file_name in kernelspec["resources"] or file_name == "kernel.json"
+        ):
+            return FileResponse(Path(kernelspec["dir"]) / file_name)
 
         raise HTTPException(
             status_code=404, detail=f"Kernelspec {kernel_name}/{file_name} not found"
@@ -146,7 +237,7 @@ class _Kernels(Kernels):
             if kernel["server"]:
                 connections = kernel["server"].connections
                 last_activity = kernel["server"].last_activity["date"]
-                execution_state = kernel["server"].last_activity["execution_state"]
+                execution_state = kernel["server"].execution_state
             else:
                 connections = 0
                 last_activity = ""
@@ -168,12 +259,9 @@ class _Kernels(Kernels):
         user: User,
     ):
         kernel_id = self.sessions[session_id].kernel.id
-        kernel_server = kernels[kernel_id]["server"]
-        await kernel_server.stop()
-        del kernels[kernel_id]
+        await self.stop_kernel(kernel_id)
         if kernel_id in self.kernel_id_to_connection_file:
             del self.kernel_id_to_connection_file[kernel_id]
-        del self.sessions[session_id]
         return Response(status_code=HTTPStatus.NO_CONTENT.value)
 
     async def rename_session(
@@ -196,7 +284,7 @@ class _Kernels(Kernels):
             if kernel_id in kernels:
                 kernel_server = kernels[kernel_id]["server"]
                 session.kernel.last_activity = kernel_server.last_activity["date"]
-                session.kernel.execution_state = kernel_server.last_activity["execution_state"]
+                session.kernel.execution_state = kernel_server.execution_state
         return list(self.sessions.values())
 
     async def create_session(
@@ -214,14 +302,21 @@ class _Kernels(Kernels):
                 if kernel_cwd.is_dir():
                     break
                 kernel_cwd = kernel_cwd.parent
-            kernel_server = KernelServer(
-                kernelspec_path=Path(find_kernelspec(kernel_name)).as_posix(),
-                kernel_cwd=str(kernel_cwd),
-            )
             kernel_id = str(uuid.uuid4())
-            kernels[kernel_id] = {"name": kernel_name, "server": kernel_server, "driver": None}
-            logger.info("Starting kernel", kernel_id=kernel_id, kernel_name=kernel_name)
-            await self.task_group.start(kernel_server.start)
+            pooled_kernel_server = None
+            if self.kernel_pool is not None:
+                pooled_kernel_server = await self.kernel_pool.checkout(
+                    kernel_name, str(kernel_cwd)
+                )
+            if pooled_kernel_server is None:
+                kernel_server = self.create_kernel_server(kernel_name, str(kernel_cwd))
+                kernels[kernel_id] = {"name": kernel_name, "server": kernel_server, "driver": None}
+                logger.info("Starting kernel", kernel_id=kernel_id, kernel_name=kernel_name)
+                await self.task_group.start(kernel_server.start)
+            else:
+                kernel_server = pooled_kernel_server
+                kernels[kernel_id] = {"name": kernel_name, "server": kernel_server, "driver": None}
+                logger.info("Using pooled kernel", kernel_id=kernel_id, kernel_name=kernel_name)
         elif kernel_id is not None:
             # external or already running kernel
             if kernel_id not in kernels:
@@ -233,6 +328,7 @@ class _Kernels(Kernels):
                 kernel_server = KernelServer(
                     connection_file=self.kernel_id_to_connection_file[kernel_id],
                     write_connection_file=False,
+                    **self.get_kernel_server_kwargs(),
                 )
                 kernels[kernel_id]["server"] = kernel_server
                 await self.task_group.start(partial(kernel_server.start, launch_kernel=False))
@@ -251,7 +347,7 @@ class _Kernels(Kernels):
                 name=kernel_name,
                 connections=kernel_server.connections,
                 last_activity=kernel_server.last_activity["date"],
-                execution_state=kernel_server.last_activity["execution_state"],
+                execution_state=kernel_server.execution_state,
             ),
             notebook=Notebook(
                 path=create_session.path,
@@ -274,7 +370,7 @@ class _Kernels(Kernels):
                 "name": kernel["name"],
                 "connections": kernel["server"].connections,
                 "last_activity": kernel["server"].last_activity["date"],
-                "execution_state": kernel["server"].last_activity["execution_state"],
+                "execution_state": kernel["server"].execution_state,
             }
             return result
 
@@ -285,13 +381,13 @@ class _Kernels(Kernels):
     ):
         if kernel_id in kernels:
             kernel = kernels[kernel_id]
-            await self.task_group.start(kernel["server"].restart)
+            await kernel["server"].restart()
             result = {
                 "id": kernel_id,
                 "name": kernel["name"],
                 "connections": kernel["server"].connections,
                 "last_activity": kernel["server"].last_activity["date"],
-                "execution_state": kernel["server"].last_activity["execution_state"],
+                "execution_state": kernel["server"].execution_state,
             }
             return result
 
@@ -312,21 +408,81 @@ class _Kernels(Kernels):
             if not ycells:
                 return  # FIXME
 
-            ycell = ycells[0]
-            del ycell["outputs"][:]
+            driver = await self.get_kernel_driver(kernel_id)
+            driver.execution_queue.put(execution.document_id, ycells)
 
-            kernel = kernels[kernel_id]
-            if not kernel["driver"]:
-                kernel["driver"] = driver = KernelDriver(
-                    kernelspec_path=Path(find_kernelspec(kernel["name"])).as_posix(),
-                    write_connection_file=False,
-                    connection_file=kernel["server"].connection_file_path,
-                    yjs=self.yjs,
-                )
-                await self.task_group.start(driver.start)
-            driver = kernel["driver"]
+    async def get_execution_queue(
+        self,
+        kernel_id,
+        user: User,
+    ):
+        if kernel_id not in kernels:
+            raise HTTPException(status_code=404, detail=f"Kernel ID not found: {kernel_id}")
+        driver = kernels[kernel_id]["driver"]
+        if driver is None:
+            return ExecutionQueueStatus(running=[], queued=[])
+        return ExecutionQueueStatus.model_validate(driver.execution_queue.status)
+
+    async def execute_cells(
+        self,
+        request: Request,
+        kernel_id,
+        user: User,
+    ):
+        if self.yjs is None:
+            raise RuntimeError("Cannot execute without a Yjs plugin.")
+
+        r = await request.json()
+        execution = BatchExecution(**r)
+        if kernel_id not in kernels:
+            raise HTTPException(status_code=404, detail=f"Kernel ID not found: {kernel_id}")
+        ynotebook = self.yjs.get_document(execution.document_id)
+        ycells = {ycell["id"]: ycell for ycell in ynotebook.ycells}
+        missing_cell_ids = [cell_id for cell_id in execution.cell_ids if cell_id not in ycells]
+        if missing_cell_ids:
+            raise HTTPException(
+                status_code=404, detail=f"Cell IDs not found: {', '.join(missing_cell_ids)}"
+            )
+        driver = await self.get_kernel_driver(kernel_id)
+        driver.execution_queue.put(
+            execution.document_id,
+            [ycells[cell_id] for cell_id in execution.cell_ids],
+            execution.stop_on_error,
+        )
+        return ExecutionQueueStatus.model_validate(driver.execution_queue.status)
 
-            await driver.execute(ycell, wait_for_executed=False)
+    async def cancel_execution(
+        self,
+        request: Request,
+        kernel_id,
+        user: User,
+    ):
+        r = await request.json()
+        cancellation = CancelExecution(**r)
+        if kernel_id not in kernels:
+            raise HTTPException(status_code=404, detail=f"Kernel ID not found: {kernel_id}")
+        driver = kernels[kernel_id]["driver"]
+        if driver is None:
+            return ExecutionQueueStatus(running=[], queued=[])
+        cancelled_cell_ids = driver.execution_queue.cancel(cancellation.cell_ids)
+        logger.info("Cancelled cell execution", kernel_id=kernel_id, cell_ids=cancelled_cell_ids)
+        return ExecutionQueueStatus.model_validate(driver.execution_queue.status)
+
+    async def get_kernel_driver(self, kernel_id: str) -> KernelDriver:
+        kernel = kernels[kernel_id]
+        # a driver is stopped if the kernel server unsubscribed it
+        if not kernel["driver"] or kernel["driver"].stopped_event.is_set():
+            # the output is rate-limited by the kernel server
+            kernel["driver"] = driver = KernelDriver(
+                kernelspec_path=Path(self.kernelspec_registry.find(kernel["name"])).as_posix(),
+                write_connection_file=False,
+                connection_file=kernel["server"].connection_file_path,
+                yjs=self.yjs,
+                execution_pipeline_depth=self.kernels_config.execution_pipeline_depth,
+            )
+            # the driver shares the channels of the kernel server
+            await self.task_group.start(partial(driver.attach, kernel["server"]))
+        return kernel["driver"]
 
     async def get_kernel(
         self,
@@ -340,7 +496,7 @@ class _Kernels(Kernels):
                 "name": kernel["name"],
                 "connections": kernel["server"].connections,
                 "last_activity": kernel["server"].last_activity["date"],
-                "execution_state": kernel["server"].last_activity["execution_state"],
+                "execution_state": kernel["server"].execution_state,
             }
             return result
 
@@ -349,13 +505,19 @@ class _Kernels(Kernels):
         kernel_id,
         user: User,
     ):
+        await self.stop_kernel(kernel_id)
+        return Response(status_code=HTTPStatus.NO_CONTENT.value)
+
+    async def stop_kernel(self, kernel_id: str) -> None:
         logger.info("Stopping kernel", kernel_id=kernel_id)
         if kernel_id in kernels:
-            await kernels[kernel_id]["server"].stop()
-            del kernels[kernel_id]
+            kernel = kernels.pop(kernel_id)
+            if kernel["driver"] is not None:
+                await kernel["driver"].stop()
+            if kernel["server"] is not None:
+                await kernel["server"].stop()
         for session_id in [k for k, v in self.sessions.items() if v.kernel.id == kernel_id]:
             del self.sessions[session_id]
-        return Response(status_code=HTTPStatus.NO_CONTENT.value)
 
     async def kernel_channels(
         self,
@@ -381,6 +543,7 @@ class _Kernels(Kernels):
                 kernel_server = KernelServer(
                     connection_file=self.kernel_id_to_connection_file[kernel_id],
                     write_connection_file=False,
+                    **self.get_kernel_server_kwargs(),
                 )
                 await self.task_group.start(partial(kernel_server.start, launch_kernel=False))
                 kernels[kernel_id]["server"] = kernel_server
@@ -6,7 +6,7 @@ from fps import Module
 
 from jupyverse_api.app import App
 from jupyverse_api.auth import Auth
-from jupyverse_api.terminals import Terminals, TerminalServer
+from jupyverse_api.terminals import Terminals, TerminalsConfig, TerminalServer
 
 from .routes import _Terminals
 
@@ -18,11 +18,17 @@ else:
 
 
 class TerminalsModule(Module):
+    def __init__(self, name: str, **kwargs):
+        super().__init__(name)
+        self.terminals_config = TerminalsConfig(**kwargs)
+
     async def prepare(self) -> None:
+        self.put(self.terminals_config, TerminalsConfig)
+
         app = await self.get(App)
         auth = await self.get(Auth)  # type: ignore[type-abstract]
 
-        self.terminals = _Terminals(app, auth, _TerminalServer)
+        self.terminals = _Terminals(app, auth, self.terminals_config, _TerminalServer)
         self.put(self.terminals, Terminals)
         async with create_task_group() as tg:
             tg.start_soon(self.terminals.start)
@@ -3,12 +3,12 @@ from http import HTTPStatus
 from typing import Any, Dict, Type
 
 import structlog
-from anyio import Event
+from anyio import Event, create_task_group, sleep
 from fastapi import Response
 
 from jupyverse_api.app import App
 from jupyverse_api.auth import Auth, User
-from jupyverse_api.terminals import Terminal, Terminals, TerminalServer
+from jupyverse_api.terminals import Terminal, Terminals, TerminalsConfig, TerminalServer
 
 TERMINALS: Dict[str, Dict[str, Any]] = {}
 
@@ -16,13 +16,39 @@ log = structlog.get_logger()
 
 
 class _Terminals(Terminals):
-    def __init__(self, app: App, auth: Auth, _TerminalServer: Type[TerminalServer]) -> None:
+    def __init__(
+        self,
+        app: App,
+        auth: Auth,
+        terminals_config: TerminalsConfig,
+        _TerminalServer: Type[TerminalServer],
+    ) -> None:
         super().__init__(app=app, auth=auth)
+        self.terminals_config = terminals_config
         self.TerminalServer = _TerminalServer
         self.stop_event = Event()
 
     async def start(self):
-        await self.stop_event.wait()
+        async with create_task_group() as tg:
+            if self.terminals_config.cull_inactive_timeout > 0:
+                tg.start_soon(self.cull_terminals)
+            await self.stop_event.wait()
+            tg.cancel_scope.cancel()
+
+    async def cull_terminals(self) -> None:
+        while True:
+            await sleep(self.terminals_config.cull_interval)
+            for name in list(TERMINALS):
+                if self.is_inactive(name):
+                    log.info("Culling inactive terminal", name=name)
+                    self.close_terminal(name)
+
+    def is_inactive(self, name: str) -> bool:
+        server = TERMINALS[name]["server"]
+        if server.websockets and not self.terminals_config.cull_connected:
+            return False
+        inactive_time = datetime.now(tz=timezone.utc) - server.last_activity
+        return inactive_time.total_seconds() > self.terminals_config.cull_inactive_timeout
 
     async def stop(self):
         for terminal in TERMINALS.values():
@@ -33,6 +59,9 @@ class _Terminals(Terminals):
         self,
         user: User,
     ):
+        for terminal in TERMINALS.values():
+            last_activity = terminal["server"].last_activity
+            terminal["info"].last_activity = last_activity.isoformat().replace("+00:00", "Z")
         return [terminal["info"] for terminal in TERMINALS.values()]
 
     async def create_terminal(
@@ -46,11 +75,11 @@ class _Terminals(Terminals):
             name_int += 1
         name = str(name_int)
         log.info("Creating terminal", name=name)
+        server = self.TerminalServer()
         terminal = Terminal(
             name=name,
-            last_activity=datetime.now(tz=timezone.utc).isoformat().replace("+00:00", "Z"),
+            last_activity=server.last_activity.isoformat().replace("+00:00", "Z"),
         )
-        server = self.TerminalServer()
         TERMINALS[name] = {"info": terminal, "server": server}
         log.info("Terminal created", name=name)
         return terminal
@@ -61,11 +90,14 @@ class _Terminals(Terminals):
         user: User,
     ):
         log.info("Deleting terminal", name=name)
+        self.close_terminal(name)
+        return Response(status_code=HTTPStatus.NO_CONTENT.value)
+
+    def close_terminal(self, name: str) -> None:
         if name in TERMINALS:
-            for websocket in TERMINALS[name]["server"].websockets:
-                TERMINALS[name]["server"].quit(websocket)
+            # disconnect all the clients, which closes the terminal
+            TERMINALS[name]["server"].quit()
             del TERMINALS[name]
-        return Response(status_code=HTTPStatus.NO_CONTENT.value)
 
     async def terminal_websocket(
         self,
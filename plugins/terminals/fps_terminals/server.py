@@ -4,6 +4,7 @@ import pty
 import shlex
 import struct
 import termios
+from datetime import datetime, timezone
 from functools import partial
 
 from anyio import (
@@ -36,6 +37,7 @@ class _TerminalServer(TerminalServer):
         self.websockets = []
         self.task_group = None
         self.lock = Lock()
+        self.last_activity = datetime.now(tz=timezone.utc)
 
     async def serve(self, websocket, permissions) -> None:
         self.permissions = permissions
@@ -62,6 +64,7 @@ class _TerminalServer(TerminalServer):
     async def backend_to_frontend(self):
         while True:
             data = (await self.recv_stream_from_backend.receive(65536)).decode()
+            self.last_activity = datetime.now(tz=timezone.utc)
             for websocket in self.websockets:
                 await websocket.send_json(["stdout", data])
 
@@ -71,6 +74,7 @@ class _TerminalServer(TerminalServer):
         try:
             while True:
                 msg = await websocket.receive_json()
+                self.last_activity = datetime.now(tz=timezone.utc)
                 if can_execute:
                     if msg[0] == "stdin":
                         await self.send_stream_to_backend.send(msg[1].encode())
@@ -95,7 +99,8 @@ class _TerminalServer(TerminalServer):
                 self.p_out.close()
             except Exception:
                 pass
-        self.task_group.cancel_scope.cancel()
+        if self.task_group is not None:
+            self.task_group.cancel_scope.cancel()
 
 
 class ReceiveStream(ByteReceiveStream):
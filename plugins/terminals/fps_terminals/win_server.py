@@ -1,4 +1,5 @@
 import os
+from datetime import datetime, timezone
 from functools import partial
 
 from anyio import create_task_group, to_thread
@@ -19,6 +20,8 @@ class _TerminalServer(TerminalServer):
     def __init__(self):
         self.process = open_terminal()
         self.websockets = []
+        self.task_group = None
+        self.last_activity = datetime.now(tz=timezone.utc)
 
     async def serve(self, websocket, permissions) -> None:
         self.websocket = websocket
@@ -43,6 +46,7 @@ class _TerminalServer(TerminalServer):
                 await self.websocket.send_json(["disconnect", 1])
                 return
             else:
+                self.last_activity = datetime.now(tz=timezone.utc)
                 for websocket in self.websockets:
                     await websocket.send_json(["stdout", data])
 
@@ -51,6 +55,7 @@ class _TerminalServer(TerminalServer):
         try:
             while True:
                 msg = await self.websocket.receive_json()
+                self.last_activity = datetime.now(tz=timezone.utc)
                 if can_execute:
                     if msg[0] == "stdin":
                         self.process.write(msg[1])
@@ -60,8 +65,13 @@ class _TerminalServer(TerminalServer):
             self.quit(self.websocket)
             self.task_group.cancel_scope.cancel()
 
-    def quit(self, websocket):
-        self.websockets.remove(websocket)
+    def quit(self, websocket=None):
+        if websocket is None:
+            self.websockets.clear()
+        elif websocket in self.websockets:
+            self.websockets.remove(websocket)
         if not self.websockets:
-            self.task_group.cancel_scope.cancel()
-            del self.process
+            if self.task_group is not None:
+                self.task_group.cancel_scope.cancel()
+            if hasattr(self, "process"):
+                del self.process
@@ -25,7 +25,7 @@ class YjsModule(Module):
         self.contents = await self.get(Contents)  # type: ignore[type-abstract]
         lifespan = await self.get(Lifespan)
 
-        self.yjs = _Yjs(app, auth, self.contents, lifespan)
+        self.yjs = _Yjs(app, auth, self.contents, lifespan, self.yjs_config)
         self.put(self.yjs, Yjs)
 
         async with create_task_group() as tg:
@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+from typing import Any, Dict, Optional
+
+import anyio
+
+OUTPUT_REF_MIMETYPE = "application/vnd.jupyverse.output-ref+json"
+OUTPUT_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class OutputNotFound(Exception):
+    pass
+
+
+class OutputStore:
+    """A content-addressed store for cell outputs that are too large to live in a shared document.
+
+    An output bigger than the threshold is written once to the store, under the SHA-256 of its
+    JSON serialization, and replaced in the shared document by a lightweight reference output.
+    The full output can be fetched lazily through the REST API, and references are inlined back
+    when the notebook is saved to disk.
+    """
+
+    path: anyio.Path
+    threshold: Optional[int]
+
+    def __init__(self, path: str, threshold: Optional[int] = None) -> None:
+        """
+        Arguments:
+            path: The directory where outputs are stored.
+            threshold: The size in bytes above which an output is stored out-of-band,
+                or None to keep all outputs in the shared document.
+        """
+        self.path = anyio.Path(path)
+        self.threshold = threshold
+
+    @staticmethod
+    def get_output_id(output: Dict[str, Any]) -> Optional[str]:
+        data = output.get("data")
+        if not isinstance(data, dict) or OUTPUT_REF_MIMETYPE not in data:
+            return None
+        return data[OUTPUT_REF_MIMETYPE]["output_id"]
+
+    async def externalize(self, output: Dict[str, Any]) -> Dict[str, Any]:
+        """Store an output out-of-band if it is bigger than the threshold.
+
+        Arguments:
+            output: The output to store.
+
+        Returns:
+            A reference to the stored output, or the output itself if it was not stored.
+        """
+        if self.threshold is None or output.get("output_type") not in (
+            "display_data",
+            "execute_result",
+        ):
+            return output
+        if self.get_output_id(output) is not None:
+            return output
+        output_bytes = json.dumps(output, sort_keys=True).encode()
+        size = len(output_bytes)
+        if size <= self.threshold:
+            return output
+        output_id = hashlib.sha256(output_bytes).hexdigest()
+        output_path = self.path / f"{output_id}.json"
+        if not await output_path.exists():
+            await self.path.mkdir(parents=True, exist_ok=True)
+            # write to a temporary file first, so that a partial output is never visible
+            tmp_path = self.path / f"{output_id}.tmp"
+            await tmp_path.write_bytes(output_bytes)
+            await tmp_path.rename(output_path)
+        reference = {k: v for k, v in output.items() if k not in ("data", "metadata")}
+        reference["data"] = {
+            OUTPUT_REF_MIMETYPE: {"output_id": output_id, "size": size},
+            "text/plain": f"<output stored out-of-band ({size} bytes)>",
+        }
+        reference["metadata"] = {}
+        return reference
+
+    async def get(self, output_id: str) -> Dict[str, Any]:
+        """
+        Arguments:
+            output_id: The ID of the stored output.
+
+        Returns:
+            The stored output.
+        """
+        if not OUTPUT_ID_PATTERN.match(output_id):
+            raise OutputNotFound(output_id)
+        output_path = self.path / f"{output_id}.json"
+        try:
+            output_bytes = await output_path.read_bytes()
+        except FileNotFoundError:
+            raise OutputNotFound(output_id)
+        return json.loads(output_bytes)
+
+    async def inline(self, output: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Arguments:
+            output: An output, possibly a reference to a stored output.
+
+        Returns:
+            The full output.
+        """
+        output_id = self.get_output_id(output)
+        if output_id is None:
+            return output
+        try:
+            return await self.get(output_id)
+        except OutputNotFound:
+            # keep the reference rather than losing the output
+            return output
+
+    async def externalize_notebook(self, nb: Any) -> Any:
+        """Store the large outputs of a notebook out-of-band.
+
+        Arguments:
+            nb: The notebook content, as a dictionary.
+
+        Returns:
+            The notebook with references to the stored outputs.
+        """
+        if self.threshold is None or not isinstance(nb, dict):
+            return nb
+        cells = []
+        for cell in nb.get("cells", []):
+            if cell.get("outputs"):
+                cell = dict(cell)
+                cell["outputs"] = [await self.externalize(output) for output in cell["outputs"]]
+            cells.append(cell)
+        return dict(nb, cells=cells)
+
+    async def inline_notebook(self, nb: Any) -> Any:
+        """Replace references to stored outputs with the full outputs.
+
+        Arguments:
+            nb: The notebook content, as a dictionary.
+
+        Returns:
+            The notebook with all outputs inlined.
+        """
+        if not isinstance(nb, dict):
+            return nb
+        cells = []
+        for cell in nb.get("cells", []):
+            if cell.get("outputs"):
+                cell = dict(cell)
+                cell["outputs"] = [await self.inline(output) for output in cell["outputs"]]
+            cells.append(cell)
+        return dict(nb, cells=cells)
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+from fnmatch import fnmatchcase
+from urllib.parse import urlsplit
+
+import structlog
+from anyio import sleep
+from pycrdt import Doc
+from websockets.asyncio.client import ClientConnection, connect
+
+from .sharding import get_room_url
+from .ywebsocket import WebsocketProvider
+
+logger = structlog.get_logger()
+
+
+class ClientWebsocket:
+    """A wrapper to make a websockets' client connection look like a ywebsocket's WebSocket"""
+
+    def __init__(self, websocket: ClientConnection, path: str):
+        self._websocket = websocket
+        self._path = path
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            message = await self.recv()
+        except Exception:
+            raise StopAsyncIteration()
+        return message
+
+    async def send(self, message: bytes) -> None:
+        await self._websocket.send(message)
+
+    async def recv(self) -> bytes:
+        return await self._websocket.recv(decode=False)
+
+
+def is_replicated(room_id: str, patterns: list[str]) -> bool:
+    """
+    Arguments:
+        room_id: The ID of a room.
+        patterns: The patterns of the IDs of the replicated rooms.
+
+    Returns:
+        True if the room is replicated from a primary instance, False otherwise.
+    """
+    return any(fnmatchcase(room_id, pattern) for pattern in patterns)
+
+
+async def replicate(
+    ydoc: Doc,
+    primary_url: str,
+    room_id: str,
+    min_delay: float = 1,
+    max_delay: float = 60,
+) -> None:
+    """Keep a document in sync with a room of a primary instance, forever.
+
+    When the connection is lost, reconnecting is retried with an exponential backoff, and the
+    document is resynchronized by exchanging state vectors, so that only missing updates are
+    transferred.
+
+    Arguments:
+        ydoc: The document to keep in sync.
+        primary_url: The base URL of the primary instance, with an optional query string
+            (e.g. to pass a token).
+        room_id: The ID of the room to replicate.
+        min_delay: The delay in seconds before the first reconnection attempt.
+        max_delay: The maximum delay in seconds between reconnection attempts.
+    """
+    url = get_room_url(primary_url, room_id, urlsplit(primary_url).query)
+    delay = min_delay
+    while True:
+        try:
+            async with connect(url, max_size=None) as websocket:
+                logger.info("Replicating collaboration room", room_id=room_id, url=primary_url)
+                delay = min_delay
+                async with WebsocketProvider(ydoc, ClientWebsocket(websocket, room_id)):
+                    await websocket.wait_closed()
+            logger.warning("Lost connection to primary", room_id=room_id, url=primary_url)
+        except Exception as e:
+            logger.warning(
+                "Could not connect to primary", room_id=room_id, url=primary_url, exc_info=e
+            )
+        await sleep(delay)
+        delay = min(delay * 2, max_delay)
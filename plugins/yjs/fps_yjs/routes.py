@@ -1,8 +1,10 @@
 from __future__ import annotations
 
+import json
+from base64 import b64decode, b64encode
 from datetime import datetime
 from functools import partial
-from typing import Dict
+from typing import Any, Dict, Hashable, List, Set
 from uuid import uuid4
 
 import structlog
@@ -16,7 +18,7 @@ from fastapi import (
     WebSocketDisconnect,
     status,
 )
-from pycrdt import Doc, YMessageType, YSyncMessageType
+from pycrdt import Array, Doc, YMessageType, YSyncMessageType
 from websockets.exceptions import ConnectionClosedOK
 
 from jupyverse_api import ResourceLock
@@ -24,16 +26,22 @@ from jupyverse_api.app import App
 from jupyverse_api.auth import Auth, User
 from jupyverse_api.contents import Contents
 from jupyverse_api.main import Lifespan
-from jupyverse_api.yjs import Yjs
+from jupyverse_api.yjs import Yjs, YjsConfig
 from jupyverse_api.yjs.models import CreateDocumentSession
 
 from .ydocs import ydocs as YDOCS
+from .output_store import OutputNotFound, OutputStore
+from .replication import is_replicated, replicate
+from .sharding import get_shard_index, is_sharded, proxy_websocket
+from .ydocs.utils import cast_all
 from .ydocs.ybasedoc import YBaseDoc
 from .ywebsocket.websocket_server import WebsocketServer, YRoom
+from .ywebsocket.yroom import ClientLimits
 from .ywebsocket.ystore import SQLiteYStore, YDocNotFound
 from .ywidgets import Widgets
 
 YFILE = YDOCS["file"]
+YNOTEBOOK = YDOCS["notebook"]
 AWARENESS = 1
 SERVER_SESSION = uuid4().hex
 logger = structlog.get_logger()
@@ -50,10 +58,15 @@ class _Yjs(Yjs):
         auth: Auth,
         contents: Contents,
         lifespan: Lifespan,
+        yjs_config: YjsConfig,
     ) -> None:
         super().__init__(app=app, auth=auth)
         self.contents = contents
         self.lifespan = lifespan
+        self.yjs_config = yjs_config
+        self.output_store = OutputStore(
+            yjs_config.output_store_path, yjs_config.output_store_threshold
+        )
         if Widgets is None:
             self.widgets = None
         else:
@@ -61,7 +74,9 @@ class _Yjs(Yjs):
 
     async def start(self, *, task_status: TaskStatus[None] = TASK_STATUS_IGNORED) -> None:
         async with create_task_group() as tg:
-            self.room_manager = RoomManager(self.contents, self.lifespan)
+            self.room_manager = RoomManager(
+                self.contents, self.lifespan, self.output_store, self.yjs_config
+            )
             tg.start_soon(self.room_manager.start)
             task_status.started()
 
@@ -77,6 +92,13 @@ class _Yjs(Yjs):
             return
         websocket, permissions = websocket_permissions
         await websocket.accept()
+        shard_urls = self.yjs_config.shard_urls
+        if shard_urls and is_sharded(path):
+            shard_index = get_shard_index(path, len(shard_urls))
+            if shard_index != self.yjs_config.shard_index:
+                # the room is owned by another instance
+                await proxy_websocket(websocket, shard_urls[shard_index], path)
+                return
         ywebsocket = YWebsocket(websocket, path)
         await self.room_manager.serve(ywebsocket, permissions)
 
@@ -108,6 +130,23 @@ class _Yjs(Yjs):
         res["fileId"] = idx
         return res
 
+    async def get_output(
+        self,
+        output_id: str,
+        user: User,
+    ):
+        try:
+            return await self.output_store.get(output_id)
+        except OutputNotFound:
+            raise HTTPException(status_code=404, detail=f"Output {output_id} not found")
+
+    async def get_room_metrics(
+        self,
+        user: User,
+    ):
+        rooms = self.room_manager.websocket_server.rooms
+        return {room_name: room.metrics for room_name, room in rooms.items()}
+
     def get_document(self, document_id: str) -> YBaseDoc:
         return self.room_manager.documents[document_id]
 
@@ -154,28 +193,69 @@ class YWebsocket:
 class RoomManager:
     contents: Contents
     lifespan: Lifespan
+    output_store: OutputStore
+    yjs_config: YjsConfig
     documents: Dict[str, YBaseDoc]
+    file_documents: Dict[str, Dict[str, YBaseDoc]]
     watchers: Dict[str, Task]
     savers: Dict[str, Task]
+    view_updaters: Dict[str, Task]
+    output_externalizers: Dict[str, Task]
+    pending_outputs: Dict[str, List[Array]]
     cleaners: Dict[YRoom, Task]
+    room_owners: Dict[str, Set[Hashable]]
+    replicators: Dict[str, Task]
+    room_refs: Dict[str, int]
     last_modified: Dict[str, datetime]
     websocket_server: JupyterWebsocketServer
     room_lock: ResourceLock
 
-    def __init__(self, contents: Contents, lifespan: Lifespan):
+    def __init__(
+        self,
+        contents: Contents,
+        lifespan: Lifespan,
+        output_store: OutputStore,
+        yjs_config: YjsConfig,
+    ):
         self.contents = contents
         self.lifespan = lifespan
+        self.output_store = output_store
+        self.yjs_config = yjs_config
         self.documents = {}  # a dictionary of room_name:document
+        # a dictionary of file_id:{room_name:document}, the first document being authoritative
+        # each view of a file has its own document, which is kept in sync with the
+        # authoritative one in memory, but only the authoritative one is stored and saved
+        self.file_documents = {}
         self.watchers = {}  # a dictionary of file_id:task
         self.savers = {}  # a dictionary of file_id:task
+        self.view_updaters = {}  # a dictionary of room_name:task
+        self.output_externalizers = {}  # a dictionary of room_name:task
+        self.pending_outputs = {}  # a dictionary of room_name:outputs_arrays
         self.cleaners = {}  # a dictionary of room:task
+        self.room_owners = {}  # a dictionary of room_name:owners, for transient rooms
+        self.replicators = {}  # a dictionary of room_name:task
+        self.room_refs = {}  # a dictionary of room_name:number of clients being served
         self.last_modified = {}  # a dictionary of file_id:last_modification_date
-        self.websocket_server = JupyterWebsocketServer(rooms_ready=False, auto_clean_rooms=False)
+        self.websocket_server = JupyterWebsocketServer(
+            rooms_ready=False,
+            auto_clean_rooms=False,
+            viewer_interval=yjs_config.viewer_update_interval,
+            client_limits=ClientLimits(
+                max_message_size=yjs_config.client_max_message_size,
+                max_messages_per_second=yjs_config.client_max_messages_per_second,
+                max_bytes_per_second=yjs_config.client_max_bytes_per_second,
+                action=yjs_config.client_limit_action,
+            ),
+        )
         self.room_lock = ResourceLock()
 
     async def start(self):
         async with create_task_group() as self.task_group:
             await self.task_group.start(self.websocket_server.start)
+            if self.yjs_config.replication_url is not None:
+                for room_name in self.yjs_config.replicated_rooms:
+                    if not any(c in room_name for c in "*?["):
+                        await self.get_replica_room(room_name)
             await self.lifespan.shutdown_request.wait()
             await self.websocket_server.stop()
 
@@ -183,19 +263,83 @@ class RoomManager:
         for task in (
             list(self.watchers.values()) +
             list(self.savers.values()) +
+            list(self.view_updaters.values()) +
+            list(self.output_externalizers.values()) +
+            list(self.replicators.values()) +
             list(self.cleaners.values())
         ):
             task.cancel(raise_exception=False)
 
     async def serve(self, websocket: YWebsocket, permissions) -> None:
-        async with self.room_lock(websocket.path):
-            room = await self.websocket_server.get_room(websocket.path)
-            can_write = permissions is None or "write" in permissions.get("yjs", [])
-            room.on_message = partial(self.filter_message, can_write)
-            is_stored_document = websocket.path.count(":") >= 2
+        room_name = websocket.path
+        # the room is in use from the time it is resolved until its client leaves,
+        # so that it is not released in between
+        self.room_refs[room_name] = self.room_refs.get(room_name, 0) + 1
+        try:
+            room, read_only = await self.prepare_room(websocket, permissions)
+            await self.websocket_server.serve(
+                websocket, self.lifespan.shutdown_request, read_only=read_only, room=room
+            )
+        finally:
+            self.room_refs[room_name] -= 1
+            if not self.room_refs[room_name]:
+                del self.room_refs[room_name]
+
+        if self.lifespan.shutdown_request.is_set() or self.is_room_used(room_name):
+            return
+        # no client in this room after we disconnect
+        if self.is_replica(room_name):
+            await self.maybe_release_replica_room(room_name)
+        elif room_name.count(":") >= 2:
+            self.cleaners[room] = create_task(
+                self.maybe_clean_room(room, room_name),
+                self.task_group,
+            )
+        else:
+            self.maybe_delete_transient_room(room_name)
+
+    def is_replica(self, room_name: str) -> bool:
+        return self.yjs_config.replication_url is not None and is_replicated(
+            room_name, self.yjs_config.replicated_rooms
+        )
+
+    def is_room_used(self, room_name: str) -> bool:
+        """
+        Returns:
+            True if the room has clients, or clients joining it.
+        """
+        room = self.websocket_server.rooms.get(room_name)
+        return room_name in self.room_refs or (room is not None and bool(room.clients))
+
+    async def prepare_room(self, websocket: YWebsocket, permissions) -> tuple[YRoom, bool]:
+        """Get the room of a client, and load its document if needed.
+
+        Returns:
+            The room, and whether the client is served read-only.
+        """
+        if self.is_replica(websocket.path):
+            # a replica is kept in sync with the primary and cannot be changed by clients
+            async with self.room_lock(websocket.path):
+                return await self.get_replica_room(websocket.path), True
+
+        is_stored_document = websocket.path.count(":") >= 2
+        # all the views of a file are set up under the same lock
+        lock_id = websocket.path.split(":", 2)[2] if is_stored_document else websocket.path
+        async with self.room_lock(lock_id):
+            primary_room_name = None
             if is_stored_document:
-                assert room.ystore is not None
                 file_format, file_type, file_id = websocket.path.split(":", 2)
+                primary_room_name = self.get_primary_room_name(file_id)
+            # only the authoritative document of a file has a change history
+            is_view = primary_room_name not in (None, websocket.path)
+            room = await self.websocket_server.get_room(websocket.path, with_ystore=not is_view)
+            can_write = permissions is None or "write" in permissions.get("yjs", [])
+            # read-only clients of a document are served as viewers,
+            # whose messages don't reach the room
+            read_only = is_stored_document and not can_write
+            if not read_only:
+                room.on_message = partial(self.filter_message, can_write)
+            if is_stored_document:
                 if room in self.cleaners:
                     # cleaning the room was scheduled because there was no client left
                     # cancel that since there is a new client
@@ -213,10 +357,22 @@ class RoomManager:
                     document = YDOCS.get(file_type, YFILE)(room.ydoc)
                     document.file_id = file_id
                     self.documents[websocket.path] = document
-                    model = await self.contents.read_content(file_path, True, file_format)
-                    assert model.last_modified is not None
-                    self.last_modified[file_id] = to_datetime(model.last_modified)
-                    if not room.ready:
+                    self.file_documents.setdefault(file_id, {})[websocket.path] = document
+                    if is_view:
+                        # the file is already opened in another view, derive this view from
+                        # the authoritative document instead of reading the file again
+                        assert primary_room_name is not None
+                        primary_document = self.documents[primary_room_name]
+                        primary_format = primary_room_name.split(":", 1)[0]
+                        source = await self.get_source(primary_document)
+                        await self.set_source(
+                            document, convert_source(source, primary_format, file_format)
+                        )
+                    else:
+                        assert room.ystore is not None
+                        model = await self.contents.read_content(file_path, True, file_format)
+                        assert model.last_modified is not None
+                        self.last_modified[file_id] = to_datetime(model.last_modified)
                         # try to apply Y updates from the YStore for this document
                         try:
                             await room.ystore.apply_updates(room.ydoc)
@@ -228,39 +384,103 @@ class RoomManager:
                         if not read_from_source:
                             # if YStore updates and source file are out-of-sync, resync updates
                             # with source
-                            if document.source != model.content:
+                            if await self.get_source(document) != model.content:
                                 read_from_source = True
                         if read_from_source:
-                            document.source = model.content
+                            await self.set_source(document, model.content)
                             await room.ystore.encode_state_as_update(room.ydoc)
 
-                        document.dirty = False
-                        room.ready = True
-                        # save the document to file when changed
-                        document.observe(
-                            partial(
-                                self.on_document_change,
-                                file_id,
-                                file_type,
-                                file_format,
-                                document,
-                            )
+                    document.dirty = False
+                    room.ready = True
+                    # save the document to file when changed
+                    document.observe(
+                        partial(
+                            self.on_document_change,
+                            file_id,
+                            file_type,
+                            file_format,
+                            document,
                         )
-                        # update the document when file changes
-                        if file_id not in self.watchers:
-                            self.watchers[file_id] = create_task(
-                                self.watch_file(file_format, file_id, document),
-                                self.task_group,
-                            )
-
-        await self.websocket_server.serve(websocket, self.lifespan.shutdown_request)
-
-        if not self.lifespan.shutdown_request.is_set() and is_stored_document and not room.clients:
-            # no client in this room after we disconnect
-            self.cleaners[room] = create_task(
-                self.maybe_clean_room(room, websocket.path),
+                    )
+                    # update the document when file changes
+                    if file_id not in self.watchers:
+                        self.watchers[file_id] = create_task(
+                            self.watch_file(file_id, document),
+                            self.task_group,
+                        )
+        return room, read_only
+
+    async def get_replica_room(self, room_name: str) -> YRoom:
+        room = await self.websocket_server.get_room(room_name, with_ystore=False)
+        if room_name not in self.replicators:
+            assert self.yjs_config.replication_url is not None
+            # the document is not loaded from a file, it is ready to receive updates
+            room.ready = True
+            self.replicators[room_name] = create_task(
+                replicate(room.ydoc, self.yjs_config.replication_url, room_name),
                 self.task_group,
             )
+        return room
+
+    async def maybe_release_replica_room(self, room_name: str) -> None:
+        """Stop replicating a room that has no client left, unless it is replicated eagerly.
+
+        Arguments:
+            room_name: The name of the replica room.
+        """
+        async with self.room_lock(room_name):
+            room = self.websocket_server.rooms.get(room_name)
+            if (
+                room is None
+                or self.is_room_used(room_name)
+                or room_name in self.yjs_config.replicated_rooms
+            ):
+                return
+            replicator = self.replicators.pop(room_name, None)
+            if replicator is not None:
+                replicator.cancel(raise_exception=False)
+            self.websocket_server.delete_room(room=room)
+            logger.debug("Stopped replicating collaboration room", room_id=room_name)
+
+    async def acquire_room(self, room_name: str, owner: Hashable, ydoc: Doc | None = None) -> YRoom:
+        """Get a transient room (e.g. for a widget), and keep it alive until its owner releases it.
+
+        Arguments:
+            room_name: The name of the room.
+            owner: The object keeping the room alive (e.g. a comm ID).
+            ydoc: The document of the room, if it must be created.
+
+        Returns:
+            The room.
+        """
+        room = await self.websocket_server.get_room(room_name, ydoc=ydoc)
+        self.room_owners.setdefault(room_name, set()).add(owner)
+        return room
+
+    def release_room(self, room_name: str, owner: Hashable) -> None:
+        """Stop keeping a transient room alive, and delete it if it is not used anymore.
+
+        Arguments:
+            room_name: The name of the room.
+            owner: The object that acquired the room.
+        """
+        owners = self.room_owners.get(room_name)
+        if owners is None:
+            return
+        owners.discard(owner)
+        if not owners:
+            del self.room_owners[room_name]
+        self.maybe_delete_transient_room(room_name)
+
+    def maybe_delete_transient_room(self, room_name: str) -> None:
+        if (
+            room_name not in self.websocket_server.rooms
+            or self.is_room_used(room_name)
+            or room_name in self.room_owners
+        ):
+            return
+        self.websocket_server.delete_room(name=room_name)
+        logger.debug("Deleted transient room", room_id=room_name)
 
     async def filter_message(self, can_write: bool, message: bytes) -> bool:
         """
@@ -293,7 +513,25 @@ class RoomManager:
             document.path = file_path
         return file_path
 
-    async def watch_file(self, file_format: str, file_id: str, document: YBaseDoc) -> None:
+    async def get_source(self, document: YBaseDoc) -> Any:
+        return await self.output_store.inline_notebook(document.source)
+
+    async def set_source(self, document: YBaseDoc, content: Any) -> None:
+        if isinstance(document, YNOTEBOOK):
+            content = await self.output_store.externalize_notebook(content)
+        document.source = content
+
+    def get_primary_room_name(self, file_id: str) -> str | None:
+        """
+        Returns:
+            The name of the room holding the authoritative document of a file, if any.
+        """
+        file_documents = self.file_documents.get(file_id)
+        if not file_documents:
+            return None
+        return next(iter(file_documents))
+
+    async def watch_file(self, file_id: str, document: YBaseDoc) -> None:
         file_path = await self.get_file_path(file_id, document)
         assert file_path is not None
         logger.info("Watching file", path=file_path)
@@ -308,22 +546,25 @@ class RoomManager:
                 self.contents.file_id_manager.unwatch(file_path, watcher)
                 file_path = new_file_path
                 # break
-            await self.maybe_load_file(file_format, file_path, file_id)
+            await self.maybe_load_file(file_path, file_id)
         if file_id in self.watchers:
             del self.watchers[file_id]
 
-    async def maybe_load_file(self, file_format: str, file_path: str, file_id: str) -> None:
+    async def maybe_load_file(self, file_path: str, file_id: str) -> None:
+        primary_room_name = self.get_primary_room_name(file_id)
+        if primary_room_name is None:
+            return
         model = await self.contents.read_content(file_path, False)
         # do nothing if the file was saved by us
         assert model.last_modified is not None
         if self.last_modified[file_id] < to_datetime(model.last_modified):
             # the file was not saved by us, update the shared document(s)
+            file_format = primary_room_name.split(":", 1)[0]
             model = await self.contents.read_content(file_path, True, file_format)
             assert model.last_modified is not None
-            documents = [v for k, v in self.documents.items() if k.split(":", 2)[2] == file_id]
-            for document in documents:
-                document.source = model.content
+            await self.set_source(self.documents[primary_room_name], model.content)
             self.last_modified[file_id] = to_datetime(model.last_modified)
+            await self.update_views(file_id)
 
     def on_document_change(
         self, file_id: str, file_type: str, file_format: str, document: YBaseDoc, target, event
@@ -339,6 +580,18 @@ class RoomManager:
         document.observe(
             partial(self.on_document_change, file_id, file_type, file_format, document)
         )
+        room_name = f"{file_format}:{file_type}:{file_id}"
+        if target == "cells" and self.output_store.threshold is not None:
+            self.maybe_externalize_outputs(room_name, event)
+        if room_name != self.get_primary_room_name(file_id):
+            # an alternate view is not saved, it updates the authoritative document instead
+            if room_name in self.view_updaters:
+                self.view_updaters[room_name].cancel(raise_exception=False)
+            self.view_updaters[room_name] = create_task(
+                self.maybe_update_primary(room_name, document),
+                self.task_group,
+            )
+            return
         if file_id in self.savers:
             self.savers[file_id].cancel(raise_exception=False)
         self.savers[file_id] = create_task(
@@ -346,6 +599,87 @@ class RoomManager:
             self.task_group,
         )
 
+    def maybe_externalize_outputs(self, room_name: str, events) -> None:
+        # outputs written into the document, e.g. by a client executing a cell,
+        # are stored out-of-band in the background
+        outputs_arrays = [
+            event.target for event in events if event.path and event.path[-1] == "outputs"
+        ]
+        if not outputs_arrays:
+            return
+        self.pending_outputs.setdefault(room_name, []).extend(outputs_arrays)
+        if room_name not in self.output_externalizers:
+            self.output_externalizers[room_name] = create_task(
+                self.externalize_outputs(room_name),
+                self.task_group,
+            )
+
+    async def externalize_outputs(self, room_name: str) -> None:
+        while room_name in self.pending_outputs:
+            outputs_arrays = self.pending_outputs.pop(room_name)
+            for outputs in outputs_arrays:
+                try:
+                    for index in range(len(outputs)):
+                        output = outputs[index]
+                        if not isinstance(output, dict):
+                            continue
+                        # numbers coming from Yjs are floats
+                        cast_all(output, float, int)
+                        reference = await self.output_store.externalize(output)
+                        # the outputs may have changed while the output was being stored
+                        if (
+                            reference is not output
+                            and index < len(outputs)
+                            and outputs[index] == output
+                        ):
+                            outputs[index] = reference
+                except Exception:
+                    # e.g. the cell was deleted or its outputs were cleared
+                    pass
+        del self.output_externalizers[room_name]
+
+    async def maybe_update_primary(self, room_name: str, document: YBaseDoc) -> None:
+        # update after a period of inactivity, like saving
+        await sleep(self.yjs_config.view_update_delay)
+        file_format, file_type, file_id = room_name.split(":", 2)
+        primary_room_name = self.get_primary_room_name(file_id)
+        if primary_room_name is not None:
+            primary_format = primary_room_name.split(":", 1)[0]
+            try:
+                source = convert_source(document.source, file_format, primary_format)
+            except Exception:
+                # e.g. invalid JSON in a text view of a notebook, wait for the next change
+                source = None
+            if source is not None:
+                primary_document = self.documents[primary_room_name]
+                if source != await self.get_source(primary_document):
+                    await self.set_source(primary_document, source)
+        if room_name in self.view_updaters:
+            del self.view_updaters[room_name]
+
+    async def update_views(self, file_id: str) -> None:
+        """Update the alternate views of a file from its authoritative document."""
+        primary_room_name = self.get_primary_room_name(file_id)
+        if primary_room_name is None:
+            return
+        primary_format = primary_room_name.split(":", 1)[0]
+        source = await self.get_source(self.documents[primary_room_name])
+        for room_name, document in list(self.file_documents[file_id].items())[1:]:
+            if room_name in self.view_updaters:
+                # this view has changes that are not in the authoritative document yet,
+                # it will be updated from it once they are
+                continue
+            file_format = room_name.split(":", 1)[0]
+            try:
+                if convert_source(document.source, file_format, primary_format) == source:
+                    # this view is already up-to-date (e.g. it is the origin of the change)
+                    document.dirty = False
+                    continue
+            except Exception:
+                pass
+            await self.set_source(document, convert_source(source, primary_format, file_format))
+            document.dirty = False
+
     async def maybe_save_document(
         self, file_id: str, file_type: str, file_format: str, document: YBaseDoc
     ) -> None:
@@ -361,15 +695,16 @@ class RoomManager:
         assert model.last_modified is not None
         if self.last_modified[file_id] < to_datetime(model.last_modified):
             # file changed on disk, let's revert
-            document.source = model.content
+            await self.set_source(document, model.content)
             self.last_modified[file_id] = to_datetime(model.last_modified)
+            await self.update_views(file_id)
             return
-        if model.content != document.source:
+        # outputs stored out-of-band are inlined in the saved notebook
+        source = await self.get_source(document)
+        if model.content != source:
             # don't save if not needed
-            # this also prevents the dirty flag from bouncing between windows of
-            # the same document opened as different types (e.g. notebook/text editor)
             content = {
-                "content": document.source,
+                "content": source,
                 "format": file_format,
                 "path": file_path,
                 "type": file_type,
@@ -379,6 +714,7 @@ class RoomManager:
             assert model.last_modified is not None
             self.last_modified[file_id] = to_datetime(model.last_modified)
         document.dirty = False
+        await self.update_views(file_id)
         # we're done saving, remove the saver
         if file_id in self.savers:
             del self.savers[file_id]
@@ -387,35 +723,116 @@ class RoomManager:
         file_id = ws_path.split(":", 2)[2]
         # keep the document for a while in case someone reconnects
         await sleep(60)  # FIXME: pass in config
-        document = self.documents[ws_path]
+        primary_room_name = self.get_primary_room_name(file_id)
+        if ws_path == primary_room_name and len(self.file_documents[file_id]) > 1:
+            # alternate views derive from this document, it will be closed with the last of them
+            if room in self.cleaners:
+                del self.cleaners[room]
+            return
+        await self.close_room(room, ws_path)
+        if ws_path != primary_room_name and len(self.file_documents.get(file_id, {})) == 1:
+            # this was the last alternate view, close the authoritative document if unused
+            assert primary_room_name is not None
+            primary_room = self.websocket_server.rooms.get(primary_room_name)
+            if (
+                primary_room is not None
+                and not self.is_room_used(primary_room_name)
+                and primary_room not in self.cleaners
+            ):
+                await self.close_room(primary_room, primary_room_name)
+        if room in self.cleaners:
+            del self.cleaners[room]
+
+    async def close_room(self, room: YRoom, ws_path: str) -> None:
+        file_id = ws_path.split(":", 2)[2]
+        document = self.documents.pop(ws_path)
         document.unobserve()
-        del self.documents[ws_path]
-        documents = [v for k, v in self.documents.items() if k.split(":", 2)[2] == file_id]
-        if not documents:
+        file_documents = self.file_documents[file_id]
+        del file_documents[ws_path]
+        if ws_path in self.view_updaters:
+            self.view_updaters.pop(ws_path).cancel(raise_exception=False)
+        if ws_path in self.output_externalizers:
+            self.output_externalizers.pop(ws_path).cancel(raise_exception=False)
+            self.pending_outputs.pop(ws_path, None)
+        if not file_documents:
+            del self.file_documents[file_id]
             self.watchers[file_id].cancel(raise_exception=False)
             await self.watchers[file_id].wait()
             if file_id in self.watchers:
                 del self.watchers[file_id]
-        room_name = self.websocket_server.get_room_name(room)
         self.websocket_server.delete_room(room=room)
         file_path = await self.get_file_path(file_id, document)
-        logger.info("Closing collaboration room", room_id=room_name, file_path=file_path)
-        if room in self.cleaners:
-            del self.cleaners[room]
+        logger.info("Closing collaboration room", room_id=ws_path, file_path=file_path)
+
+
+def convert_source(content: Any, from_format: str, to_format: str) -> Any:
+    """Convert the content of a file between the formats of its views.
+
+    Arguments:
+        content: The content to convert.
+        from_format: The format of the content ("json", "text" or "base64").
+        to_format: The format to convert the content to.
+
+    Returns:
+        The converted content.
+    """
+    if from_format == to_format:
+        return content
+    if from_format == "json":
+        # same serialization as when the file is written to disk
+        text = json.dumps(content, indent=2)
+    elif from_format == "base64":
+        # a blob document's source is bytes
+        text = content.decode() if isinstance(content, bytes) else b64decode(content).decode()
+    else:
+        text = content
+    if to_format == "json":
+        return json.loads(text)
+    if to_format == "base64":
+        return b64encode(text.encode()).decode()
+    return text
 
 
 class JupyterWebsocketServer(WebsocketServer):
-    async def get_room(self, ws_path: str, ydoc: Doc | None = None) -> YRoom:
+    viewer_interval: float
+    client_limits: ClientLimits | None
+
+    def __init__(
+        self,
+        *args,
+        viewer_interval: float = 0.1,
+        client_limits: ClientLimits | None = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.viewer_interval = viewer_interval
+        self.client_limits = client_limits
+
+    async def get_room(
+        self, ws_path: str, ydoc: Doc | None = None, with_ystore: bool = True
+    ) -> YRoom:
         if ws_path not in self.rooms:
             if ws_path.count(":") >= 2:
                 # it is a stored document (e.g. a notebook)
                 file_format, file_type, file_id = ws_path.split(":", 2)
-                updates_file_path = f".{file_type}:{file_id}.y"
-                ystore = JupyterSQLiteYStore(path=updates_file_path)  # FIXME: pass in config
-                self.rooms[ws_path] = YRoom(ydoc=ydoc, ready=False, ystore=ystore)
+                ystore = None
+                if with_ystore:
+                    updates_file_path = f".{file_type}:{file_id}.y"
+                    ystore = JupyterSQLiteYStore(path=updates_file_path)  # FIXME: pass in config
+                self.rooms[ws_path] = YRoom(
+                    ydoc=ydoc,
+                    ready=False,
+                    ystore=ystore,
+                    viewer_interval=self.viewer_interval,
+                    client_limits=self.client_limits,
+                )
             else:
                 # it is a transient document (e.g. awareness)
-                self.rooms[ws_path] = YRoom(ydoc=ydoc)
+                self.rooms[ws_path] = YRoom(
+                    ydoc=ydoc,
+                    viewer_interval=self.viewer_interval,
+                    client_limits=self.client_limits,
+                )
         room = self.rooms[ws_path]
         await self.start_room(room)
         return room
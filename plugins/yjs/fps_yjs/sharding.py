@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+from urllib.parse import urlsplit, urlunsplit
+from zlib import crc32
+
+import structlog
+from anyio import create_task_group
+from fastapi import WebSocket, WebSocketDisconnect
+from websockets.asyncio.client import connect
+from websockets.exceptions import ConnectionClosed
+
+logger = structlog.get_logger()
+
+# the request headers that carry the client's credentials
+FORWARDED_HEADERS = ("cookie", "authorization")
+
+
+def is_sharded(room_id: str) -> bool:
+    """
+    Arguments:
+        room_id: The ID of a room.
+
+    Returns:
+        True if the room is assigned to a shard, False if it must be served by the process
+            receiving the connection (e.g. a widget, which lives next to its kernel).
+    """
+    return not room_id.startswith("ywidget:")
+
+
+def get_shard_key(room_id: str) -> str:
+    """
+    Arguments:
+        room_id: The ID of a room.
+
+    Returns:
+        The key used to assign the room to a shard. All the views of a file share the same key,
+            so that they live in the same process as the file's authoritative document.
+    """
+    if room_id.count(":") >= 2:
+        # it is a stored document, shard by file ID
+        return room_id.split(":", 2)[2]
+    return room_id
+
+
+def get_shard_index(room_id: str, shard_number: int) -> int:
+    """
+    Arguments:
+        room_id: The ID of a room.
+        shard_number: The number of shards.
+
+    Returns:
+        The index of the shard owning the room, which is stable across processes and restarts.
+    """
+    return crc32(get_shard_key(room_id).encode()) % shard_number
+
+
+def get_room_url(shard_url: str, room_id: str, query: str) -> str:
+    scheme, netloc, path, _, _ = urlsplit(shard_url)
+    scheme = {"http": "ws", "https": "wss"}.get(scheme, scheme)
+    path = f"{path.rstrip('/')}/api/collaboration/room/{room_id}"
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+
+async def proxy_websocket(websocket: WebSocket, shard_url: str, room_id: str) -> None:
+    """Forward messages between a client and the shard owning its room.
+
+    The client's credentials are forwarded, so that the owning shard authenticates the client
+    the same way.
+
+    Arguments:
+        websocket: The accepted WebSocket of the client.
+        shard_url: The base URL of the shard owning the room.
+        room_id: The ID of the room.
+    """
+    url = get_room_url(shard_url, room_id, websocket.url.query)
+    headers = {
+        name: value for name, value in websocket.headers.items() if name in FORWARDED_HEADERS
+    }
+    logger.debug("Proxying collaboration room", room_id=room_id, url=url)
+    try:
+        async with connect(url, additional_headers=headers, max_size=None) as upstream:
+            async with create_task_group() as tg:
+
+                async def forward_to_shard():
+                    try:
+                        while True:
+                            await upstream.send(await websocket.receive_bytes())
+                    except (WebSocketDisconnect, ConnectionClosed):
+                        pass
+                    tg.cancel_scope.cancel()
+
+                async def forward_to_client():
+                    try:
+                        async for message in upstream:
+                            await websocket.send_bytes(message)  # type: ignore[arg-type]
+                    except (WebSocketDisconnect, ConnectionClosed):
+                        pass
+                    tg.cancel_scope.cancel()
+
+                tg.start_soon(forward_to_shard)
+                tg.start_soon(forward_to_client)
+    except Exception as e:
+        logger.warning("Could not proxy collaboration room", room_id=room_id, url=url, exc_info=e)
+    try:
+        await websocket.close()
+    except Exception:
+        pass
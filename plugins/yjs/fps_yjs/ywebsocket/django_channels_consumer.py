@@ -1,15 +1,41 @@
 from __future__ import annotations
 
+import asyncio
 from typing import TypedDict
+from uuid import uuid4
 
 from channels.generic.websocket import AsyncWebsocketConsumer  # type: ignore
-from pycrdt import Doc, YMessageType, YSyncMessageType, create_sync_message, handle_sync_message
+from pycrdt import (
+    Doc,
+    YMessageType,
+    YSyncMessageType,
+    create_sync_message,
+    create_update_message,
+    handle_sync_message,
+    merge_updates,
+    read_message,
+)
 from structlog import get_logger
 
 from .websocket import Websocket
 
 logger = get_logger()
 
+# identifies this process in the messages sent through the channel layer
+PROCESS_ID = uuid4().hex
+EMPTY_UPDATE = b"\x00\x00"
+
+
+class _SharedRoom:
+    """A document shared by all the consumers of a room in this process."""
+
+    def __init__(self, ydoc: Doc) -> None:
+        self.ydoc = ydoc
+        self.consumer_nb = 0
+
+
+_rooms: dict[str, _SharedRoom] = {}
+
 
 class _WebsocketShim(Websocket):
     def __init__(self, path, send_func) -> None:
@@ -70,10 +96,13 @@ class YjsConsumer(AsyncWebsocketConsumer):
 
     - Override `make_room_name` to customize the room name.
     - Override `make_ydoc` to initialize the YDoc. This is useful to initialize it with data
-      from your database, or to add observers to it).
+      from your database, or to add observers to it). The YDoc is shared by all the consumers
+      of a room in the same process, so it is only made by the first one.
     - Override `connect` to do custom validation (like auth) on connect,
       but be sure to call `await super().connect()` in the end.
     - Call `group_send_message` to send a message to an entire group/room.
+    - Set `batch_interval` to change how long document updates from a client are batched
+      before being sent through the channel layer.
     - Call `send_message` to send a message to a single client, although this is not recommended.
 
     A full example of a custom consumer showcasing all of these options is:
@@ -120,11 +149,16 @@ class YjsConsumer(AsyncWebsocketConsumer):
 
     """
 
+    batch_interval: float = 0.05
+
     def __init__(self):
         super().__init__()
         self.room_name = None
         self.ydoc = None
         self._websocket_shim = None
+        self._updates: list[bytes] = []
+        self._flush_task: asyncio.Task | None = None
+        self._created_room = False
 
     def make_room_name(self) -> str:
         """Make the room name for a new channel.
@@ -137,13 +171,13 @@ class YjsConsumer(AsyncWebsocketConsumer):
         return self.scope["url_route"]["kwargs"]["room"]
 
     async def make_ydoc(self) -> Doc:
-        """Make the YDoc for a new channel.
+        """Make the YDoc for a new room.
 
-        Override to customize the YDoc when a channel is created
+        Override to customize the YDoc when a room is created in this process
         (useful to initialize it with data from your database, or to add observers to it).
 
         Returns:
-            The YDoc for a new channel. Defaults to a new empty YDoc.
+            The YDoc for a new room. Defaults to a new empty YDoc.
         """
         return Doc()
 
@@ -152,7 +186,14 @@ class YjsConsumer(AsyncWebsocketConsumer):
 
     async def connect(self) -> None:
         self.room_name = self.make_room_name()
-        self.ydoc = await self.make_ydoc()
+        room = _rooms.get(self.room_name)
+        if room is None:
+            new_room = _SharedRoom(await self.make_ydoc())
+            # another consumer may have created the room in the meantime
+            room = _rooms.setdefault(self.room_name, new_room)
+            self._created_room = room is new_room
+        room.consumer_nb += 1
+        self.ydoc = room.ydoc
         self._websocket_shim = self._make_websocket_shim(self.scope["path"])
 
         await self.channel_layer.group_add(self.room_name, self.channel_name)
@@ -164,30 +205,72 @@ class YjsConsumer(AsyncWebsocketConsumer):
             name=YSyncMessageType.SYNC_STEP1.name,
             endpoint=self._websocket_shim.path,
         )
-        await self._websocket_shim.send(sync_message)
+        await self.send(bytes_data=sync_message)
 
     async def disconnect(self, code) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+            await self._flush_updates()
         await self.channel_layer.group_discard(self.room_name, self.channel_name)
+        room = _rooms.get(self.room_name)
+        if room is not None:
+            room.consumer_nb -= 1
+            if room.consumer_nb == 0:
+                del _rooms[self.room_name]
 
     async def receive(self, text_data=None, bytes_data=None):
         if bytes_data is None:
             return
-        await self.group_send_message(bytes_data)
         if bytes_data[0] != YMessageType.SYNC:
+            # e.g. awareness, forward to the other clients
+            await self.group_send_message(bytes_data, exclude_self=True)
             return
-        reply = handle_sync_message(bytes_data[1:], self.ydoc)
-        if reply is not None:
+        if bytes_data[1] == YSyncMessageType.SYNC_STEP1:
+            # the client gets what it misses from the shared document,
+            # no need to involve the other clients
+            reply = handle_sync_message(bytes_data[1:], self.ydoc)
             logger.debug(
                 "Sending message",
                 name=YSyncMessageType.SYNC_STEP2.name,
                 endpoint=self._websocket_shim.path,
             )
-            await self._websocket_shim.send(reply)
+            await self.send(bytes_data=reply)
+            if self._created_room:
+                # the shared document was just created in this process, clients in other
+                # processes may have state that it doesn't have: ask them for it
+                self._created_room = False
+                await self.group_send_message(bytes_data, exclude_self=True)
+            return
+        # an update from the client, apply it to the shared document
+        # and send it to the other clients in batches
+        handle_sync_message(bytes_data[1:], self.ydoc)
+        update = read_message(bytes_data[2:])
+        if update == EMPTY_UPDATE:
+            return
+        self._updates.append(update)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_updates_later())
 
-    class WrappedMessage(TypedDict):
+    async def _flush_updates_later(self) -> None:
+        await asyncio.sleep(self.batch_interval)
+        self._flush_task = None
+        await self._flush_updates()
+
+    async def _flush_updates(self) -> None:
+        if not self._updates:
+            return
+        updates = self._updates
+        self._updates = []
+        update = updates[0] if len(updates) == 1 else merge_updates(*updates)
+        await self.group_send_message(create_update_message(update), exclude_self=True)
+
+    class WrappedMessage(TypedDict, total=False):
         """A wrapped message to send to the client."""
 
         message: bytes
+        sender: str | None
+        process: str
 
     async def send_message(self, message_wrapper: WrappedMessage) -> None:
         """Send a message to the client.
@@ -195,14 +278,35 @@ class YjsConsumer(AsyncWebsocketConsumer):
         Arguments:
             message_wrapper: The message to send, wrapped.
         """
-        await self.send(bytes_data=message_wrapper["message"])
-
-    async def group_send_message(self, message: bytes) -> None:
+        if message_wrapper.get("sender") == self.channel_name:
+            # don't echo messages back to their sender
+            return
+        message = message_wrapper["message"]
+        process = message_wrapper.get("process")
+        if (
+            process is not None
+            and process != PROCESS_ID
+            and message[0] == YMessageType.SYNC
+            and message[1] != YSyncMessageType.SYNC_STEP1
+        ):
+            # an update from another process, which the shared document of this process
+            # doesn't have yet (applying it more than once has no effect)
+            handle_sync_message(message[1:], self.ydoc)
+        await self.send(bytes_data=message)
+
+    async def group_send_message(self, message: bytes, exclude_self: bool = False) -> None:
         """Send a message to the group.
 
         Arguments:
             message: The message to send.
+            exclude_self: Whether to not send the message to this consumer's client.
         """
         await self.channel_layer.group_send(
-            self.room_name, {"type": "send_message", "message": message}
+            self.room_name,
+            {
+                "type": "send_message",
+                "message": message,
+                "sender": self.channel_name if exclude_self else None,
+                "process": PROCESS_ID,
+            },
         )
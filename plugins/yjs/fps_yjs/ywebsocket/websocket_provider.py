@@ -43,7 +43,7 @@ class WebsocketProvider:
         self._started = None
         self._starting = False
         self._task_group = None
-        ydoc.observe(partial(put_updates, self._update_send_stream))
+        self._subscription = ydoc.observe(partial(put_updates, self._update_send_stream))
 
     @property
     def started(self) -> Event:
@@ -70,6 +70,7 @@ class WebsocketProvider:
 
         self._task_group.cancel_scope.cancel()
         self._task_group = None
+        self._ydoc.unobserve(self._subscription)
         return await self._exit_stack.__aexit__(exc_type, exc_value, exc_tb)
 
     async def _run(self):
@@ -127,3 +128,4 @@ class WebsocketProvider:
 
         self._task_group.cancel_scope.cancel()
         self._task_group = None
+        self._ydoc.unobserve(self._subscription)
@@ -58,9 +58,24 @@ class WebsocketServer:
         room = self.rooms.pop(name)
         room.stop()
 
-    async def serve(self, websocket: Websocket, stop_event: Event | None = None) -> None:
+    async def serve(
+        self,
+        websocket: Websocket,
+        stop_event: Event | None = None,
+        read_only: bool = False,
+        room: YRoom | None = None,
+    ) -> None:
+        """Serve a client.
+
+        Arguments:
+            websocket: The WebSocket through which to serve the client.
+            stop_event: An optional event to stop serving the client.
+            read_only: Whether the client is only allowed to view the document.
+            room: The room of the client, if already resolved. Defaults to the room named
+                after the WebSocket path.
+        """
         async with create_task_group() as tg:
-            tg.start_soon(self._serve, websocket, tg)
+            tg.start_soon(self._serve, websocket, tg, read_only, room)
             if stop_event is not None:
                 tg.start_soon(self._watch_stop, tg, stop_event)
 
@@ -68,10 +83,17 @@ class WebsocketServer:
         await stop_event.wait()
         tg.cancel_scope.cancel()
 
-    async def _serve(self, websocket: Websocket, tg: TaskGroup):
-        room = await self.get_room(websocket.path)
+    async def _serve(
+        self,
+        websocket: Websocket,
+        tg: TaskGroup,
+        read_only: bool = False,
+        room: YRoom | None = None,
+    ):
+        if room is None:
+            room = await self.get_room(websocket.path)
         await self.start_room(room)
-        await room.serve(websocket)
+        await room.serve(websocket, read_only)
 
         if self.auto_clean_rooms and not room.clients:
             self.delete_room(room=room)
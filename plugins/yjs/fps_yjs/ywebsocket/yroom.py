@@ -1,25 +1,32 @@
 from __future__ import annotations
 
 from contextlib import AsyncExitStack
+from dataclasses import dataclass
 from functools import partial
 from inspect import isawaitable
-from typing import Awaitable, Callable
+from time import monotonic
+from typing import Awaitable, Callable, Literal
 
 from anyio import (
     TASK_STATUS_IGNORED,
     Event,
     create_memory_object_stream,
     create_task_group,
+    sleep,
 )
 from anyio.abc import TaskGroup, TaskStatus
 from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
 from pycrdt import (
     Doc,
+    TransactionEvent,
     YMessageType,
     YSyncMessageType,
     create_sync_message,
     create_update_message,
     handle_sync_message,
+    merge_updates,
+    read_message,
+    write_message,
 )
 from structlog import BoundLogger, get_logger
 
@@ -28,9 +35,82 @@ from .websocket import Websocket
 from .ystore import BaseYStore
 from .yutils import put_updates
 
+# the encoded state vector of an empty document
+EMPTY_STATE = b"\x00"
+
+
+class ClientLimitExceeded(Exception):
+    pass
+
+
+@dataclass
+class ClientLimits:
+    """Limits enforced on the messages received from each client of a room.
+
+    Attributes:
+        max_message_size: The maximum size of a message in bytes, or None for no limit.
+        max_messages_per_second: The maximum sustained rate of messages, or None for no limit.
+        max_bytes_per_second: The maximum sustained rate of bytes, or None for no limit.
+        action: What to do with a client exceeding a limit: "drop" its message,
+            or "disconnect" it.
+    """
+
+    max_message_size: int | None = None
+    max_messages_per_second: float | None = None
+    max_bytes_per_second: float | None = None
+    action: Literal["drop", "disconnect"] = "drop"
+
+
+class _TokenBucket:
+    """A token bucket refilled at a given rate, allowing bursts of up to one second's worth."""
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.tokens = rate
+        self.last_time = monotonic()
+
+    def consume(self, amount: float) -> bool:
+        now = monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+        # an amount bigger than the rate passes when the bucket is full, and is paid back later
+        if self.tokens < min(amount, self.rate):
+            return False
+        self.tokens -= amount
+        return True
+
+
+class _ClientLimiter:
+    def __init__(self, limits: ClientLimits) -> None:
+        self.limits = limits
+        self.messages: _TokenBucket | None = None
+        self.bytes: _TokenBucket | None = None
+        if limits.max_messages_per_second is not None:
+            self.messages = _TokenBucket(limits.max_messages_per_second)
+        if limits.max_bytes_per_second is not None:
+            self.bytes = _TokenBucket(limits.max_bytes_per_second)
+
+    def check(self, message: bytes) -> str | None:
+        """
+        Returns:
+            The name of the exceeded limit, if any.
+        """
+        max_message_size = self.limits.max_message_size
+        if max_message_size is not None and len(message) > max_message_size:
+            return "max_message_size"
+        if self.messages is not None and not self.messages.consume(1):
+            return "max_messages_per_second"
+        if self.bytes is not None and not self.bytes.consume(len(message)):
+            return "max_bytes_per_second"
+        return None
+
 
 class YRoom:
     clients: list
+    viewers: set
+    viewer_interval: float
+    client_limits: ClientLimits | None
+    metrics: dict[str, int]
     ydoc: Doc
     ystore: BaseYStore | None
     _on_message: Callable[[bytes], Awaitable[bool] | bool] | None
@@ -40,6 +120,10 @@ class YRoom:
     _task_group: TaskGroup | None
     _started: Event | None
     _starting: bool
+    _sync_step1_message: bytes | None
+    _sync_step2_message: bytes | None
+    _viewer_updates: list[bytes]
+    _viewer_updates_event: Event
 
     def __init__(
         self,
@@ -47,6 +131,8 @@ class YRoom:
         ready: bool = True,
         ystore: BaseYStore | None = None,
         log: BoundLogger | None = None,
+        viewer_interval: float = 0.1,
+        client_limits: ClientLimits | None = None,
     ):
         """Initialize the object.
 
@@ -67,6 +153,9 @@ class YRoom:
             ready: Whether the internal YDoc is ready to be synchronized right away.
             ystore: An optional store in which to persist document updates.
             log: An optional logger.
+            viewer_interval: The interval in seconds at which updates are batched and sent to
+                read-only clients.
+            client_limits: Optional limits on the messages received from each client.
         """
         self.ydoc = Doc() if ydoc is None else ydoc
         self.awareness = Awareness(self.ydoc)
@@ -78,10 +167,26 @@ class YRoom:
         self.ystore = ystore
         self.log = log or get_logger()
         self.clients = []
+        # read-only clients, which are also in the list of clients
+        self.viewers = set()
+        self.viewer_interval = viewer_interval
+        self._viewer_updates = []
+        self._viewer_updates_event = Event()
+        self.client_limits = client_limits
+        self.metrics = {
+            "messages_received": 0,
+            "bytes_received": 0,
+            "messages_dropped": 0,
+            "clients_disconnected": 0,
+        }
         self._on_message = None
         self._started = None
         self._starting = False
         self._task_group = None
+        # encoded messages that are the same for all joining clients, until the document changes
+        self._sync_step1_message = None
+        self._sync_step2_message = None
+        self.ydoc.observe(self._clear_sync_messages)
 
     @property
     def started(self):
@@ -124,6 +229,33 @@ class YRoom:
         """
         self._on_message = value
 
+    def _clear_sync_messages(self, event: TransactionEvent) -> None:
+        self._sync_step1_message = None
+        self._sync_step2_message = None
+
+    def get_sync_step1_message(self) -> bytes:
+        """
+        Returns:
+            The [SYNC_STEP1][pycrdt.YSyncMessageType] message containing the state of the
+                internal YDoc.
+        """
+        if self._sync_step1_message is None:
+            self._sync_step1_message = create_sync_message(self.ydoc)
+        return self._sync_step1_message
+
+    def get_sync_step2_message(self) -> bytes:
+        """
+        Returns:
+            The [SYNC_STEP2][pycrdt.YSyncMessageType] message containing the full state of the
+                internal YDoc, in reply to a client with an empty document.
+        """
+        if self._sync_step2_message is None:
+            update = self.ydoc.get_update()
+            self._sync_step2_message = (
+                bytes([YMessageType.SYNC, YSyncMessageType.SYNC_STEP2]) + write_message(update)
+            )
+        return self._sync_step2_message
+
     async def _broadcast_updates(self):
         if self.ystore is not None and not self.ystore.started.is_set():
             self._task_group.start_soon(self.ystore.start)
@@ -134,17 +266,38 @@ class YRoom:
                     return
                 # broadcast internal ydoc's update to all clients, that includes changes from the
                 # clients and changes from the backend (out-of-band changes)
+                message = create_update_message(update)
+                if self.viewers:
+                    # updates are sent to read-only clients in batches
+                    self._viewer_updates.append(update)
+                    self._viewer_updates_event.set()
                 for client in self.clients:
+                    if client in self.viewers:
+                        continue
                     self.log.debug(
                         "Sending Y update to client",
                         endpoint=client.path,
                     )
-                    message = create_update_message(update)
                     self._task_group.start_soon(client.send, message)
                 if self.ystore:
                     self.log.debug("Writing Y update to YStore")
                     self._task_group.start_soon(self.ystore.write, update)
 
+    async def _broadcast_viewer_updates(self):
+        while True:
+            await self._viewer_updates_event.wait()
+            # let updates accumulate, trading latency for throughput
+            await sleep(self.viewer_interval)
+            updates = self._viewer_updates
+            self._viewer_updates = []
+            self._viewer_updates_event = Event()
+            update = updates[0] if len(updates) == 1 else merge_updates(*updates)
+            # all read-only clients share the same encoded message
+            message = create_update_message(update)
+            for viewer in self.viewers:
+                self.log.debug("Sending Y updates to viewer", endpoint=viewer.path)
+                self._task_group.start_soon(viewer.send, message)
+
     async def __aenter__(self) -> YRoom:
         if self._task_group is not None:
             raise RuntimeError("YRoom already running")
@@ -154,6 +307,7 @@ class YRoom:
             self._task_group = await exit_stack.enter_async_context(tg)
             self._exit_stack = exit_stack.pop_all()
             tg.start_soon(self._broadcast_updates)
+            tg.start_soon(self._broadcast_viewer_updates)
             self.started.set()
 
         return self
@@ -182,6 +336,7 @@ class YRoom:
 
         async with create_task_group() as self._task_group:
             self._task_group.start_soon(self._broadcast_updates)
+            self._task_group.start_soon(self._broadcast_viewer_updates)
             self.started.set()
             self._starting = False
             task_status.started()
@@ -194,10 +349,59 @@ class YRoom:
         self._task_group.cancel_scope.cancel()
         self._task_group = None
 
-    async def serve(self, websocket: Websocket):
+    def _accept_message(
+        self, limiter: _ClientLimiter | None, websocket: Websocket, message: bytes
+    ) -> bool:
+        """Enforce the client limits before a message is processed.
+
+        Returns:
+            True if the message can be processed, False if it must be dropped.
+
+        Raises:
+            ClientLimitExceeded: If the client must be disconnected.
+        """
+        self.metrics["messages_received"] += 1
+        self.metrics["bytes_received"] += len(message)
+        if limiter is None:
+            return True
+        exceeded_limit = limiter.check(message)
+        if exceeded_limit is None:
+            return True
+        if limiter.limits.action == "disconnect":
+            self.metrics["clients_disconnected"] += 1
+            self.log.warning(
+                "Disconnecting client exceeding limit",
+                endpoint=websocket.path,
+                limit=exceeded_limit,
+            )
+            raise ClientLimitExceeded(exceeded_limit)
+        self.metrics["messages_dropped"] += 1
+        self.log.debug(
+            "Dropping message exceeding limit",
+            endpoint=websocket.path,
+            limit=exceeded_limit,
+            size=len(message),
+        )
+        return False
+
+    async def serve(self, websocket: Websocket, read_only: bool = False):
+        """Serve a client.
+
+        Arguments:
+            websocket: The WebSocket through which to serve the client.
+            read_only: Whether the client is only allowed to view the document, in which case
+                it is served as a viewer: it receives a snapshot of the document and then
+                batched updates, and its synchronization messages are ignored. Its awareness
+                messages are forwarded to all clients, like those of other clients.
+        """
+        if read_only:
+            await self._serve_viewer(websocket)
+            return
+
         async with create_task_group() as tg:
             self.clients.append(websocket)
-            sync_message = create_sync_message(self.ydoc)
+            limiter = None if self.client_limits is None else _ClientLimiter(self.client_limits)
+            sync_message = self.get_sync_step1_message()
             self.log.debug(
                 "Sending message",
                 name=YSyncMessageType.SYNC_STEP1.name,
@@ -206,6 +410,8 @@ class YRoom:
             await websocket.send(sync_message)
             try:
                 async for message in websocket:
+                    if not self._accept_message(limiter, websocket, message):
+                        continue
                     # filter messages (e.g. awareness)
                     skip = False
                     if self.on_message:
@@ -215,10 +421,19 @@ class YRoom:
                         continue
                     message_type = message[0]
                     if message_type == YMessageType.SYNC:
-                        # update our internal state in the background
-                        # changes to the internal state are then forwarded to all clients
-                        # and stored in the YStore (if any)
-                        reply = handle_sync_message(message[1:], self.ydoc)
+                        reply: bytes | None
+                        if (
+                            message[1] == YSyncMessageType.SYNC_STEP1
+                            and read_message(message[2:]) == EMPTY_STATE
+                        ):
+                            # a client joining with an empty document gets the full state,
+                            # which is shared by all such clients until the document changes
+                            reply = self.get_sync_step2_message()
+                        else:
+                            # update our internal state in the background
+                            # changes to the internal state are then forwarded to all clients
+                            # and stored in the YStore (if any)
+                            reply = handle_sync_message(message[1:], self.ydoc)
                         if reply is not None:
                             self.log.debug(
                                 "Sending message",
@@ -250,3 +465,46 @@ class YRoom:
 
             # remove this client
             self.clients = [c for c in self.clients if c != websocket]
+
+    async def _serve_viewer(self, websocket: Websocket):
+        async with create_task_group() as tg:
+            self.clients.append(websocket)
+            limiter = None if self.client_limits is None else _ClientLimiter(self.client_limits)
+            self.viewers.add(websocket)
+            # the initial snapshot is shared by all joining clients
+            self.log.debug(
+                "Sending message",
+                name=YSyncMessageType.SYNC_STEP2.name,
+                endpoint=websocket.path,
+            )
+            await websocket.send(self.get_sync_step2_message())
+            try:
+                async for message in websocket:
+                    if not self._accept_message(limiter, websocket, message):
+                        continue
+                    if message[0] == YMessageType.AWARENESS:
+                        # forward awareness messages from this viewer to all clients,
+                        # including itself, so that collaborators see it and the connection
+                        # is kept alive
+                        self.log.debug(
+                            "Received message",
+                            name=YMessageType.AWARENESS.name,
+                            endpoint=websocket.path,
+                        )
+                        for client in self.clients:
+                            self.log.debug(
+                                "Sending Y awareness",
+                                from_endpoint=websocket.path,
+                                to_endpoint=client.path,
+                            )
+                            tg.start_soon(client.send, message)
+            except Exception as e:
+                self.log.debug(
+                    "Error serving",
+                    endpoint=websocket.path,
+                    exc_info=e,
+                )
+
+            # remove this client
+            self.viewers.discard(websocket)
+            self.clients = [c for c in self.clients if c != websocket]
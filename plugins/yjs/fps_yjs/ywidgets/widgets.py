@@ -1,5 +1,6 @@
 import sys
-from typing import Any
+from functools import partial
+from typing import Any, Optional
 
 try:
     import ypywidgets  # noqa: F401
@@ -38,7 +39,6 @@ if ypywidgets_installed:
 
             name = msg["metadata"]["ymodel_name"]
             comm_id = msg["content"]["comm_id"]
-            self.comm = comm
             model = self.ydocs[f"{name}Model"]()
             self.widgets[comm_id] = {"model": model, "comm": comm}
             msg = create_sync_message(model.ydoc)
@@ -56,13 +56,25 @@ if ypywidgets_installed:
                 if reply:
                     self.widgets[comm_id]["comm"].send(buffers=[reply])
                 if message[1] == YSyncMessageType.SYNC_STEP2:
-                    ydoc.observe(self._send)
+                    self.widgets[comm_id]["subscription"] = ydoc.observe(
+                        partial(self._send, self.widgets[comm_id]["comm"])
+                    )
 
-        def _send(self, event: TransactionEvent):
+        def comm_close(self, msg) -> Optional[str]:
+            comm_id = msg["content"]["comm_id"]
+            widget = self.widgets.pop(comm_id, None)
+            if widget is None:
+                return None
+            ydoc = widget["model"].ydoc
+            if "subscription" in widget:
+                ydoc.unobserve(widget["subscription"])
+            return ydoc.guid
+
+        def _send(self, comm, event: TransactionEvent):
             update = event.update  # type: ignore
             message = create_update_message(update)
             try:
-                self.comm.send(buffers=[message])
+                comm.send(buffers=[message])
             except Exception:
                 pass
 else:
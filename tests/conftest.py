@@ -28,6 +28,16 @@ def unused_tcp_port() -> int:
         return sock.getsockname()[1]
 
 
+@pytest.fixture()
+def unused_tcp_port_factory():
+    def factory() -> int:
+        with socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    return factory
+
+
 @pytest.fixture()
 def start_jupyverse(auth_mode, clear_users, cwd, unused_tcp_port):
     os.chdir(cwd)
@@ -0,0 +1,160 @@
+import pytest
+
+pytest.importorskip("channels")
+
+from channels.layers import get_channel_layer  # noqa: E402
+from channels.routing import URLRouter  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.urls import path  # noqa: E402
+from fps_yjs.ywebsocket.django_channels_consumer import (  # noqa: E402
+    PROCESS_ID,
+    YjsConsumer,
+    _rooms,
+)
+from pycrdt import (  # noqa: E402
+    Doc,
+    Text,
+    YMessageType,
+    YSyncMessageType,
+    create_sync_message,
+    create_update_message,
+    handle_sync_message,
+)
+
+if not settings.configured:
+    settings.configure(
+        CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+    )
+
+
+class BatchingConsumer(YjsConsumer):
+    batch_interval = 0.3
+
+
+application = URLRouter(
+    [
+        path("ws/<str:room>", YjsConsumer.as_asgi()),
+        path("batch/<str:room>", BatchingConsumer.as_asgi()),
+    ]
+)
+
+
+class Client:
+    def __init__(self, path: str) -> None:
+        self.communicator = WebsocketCommunicator(application, path)
+        self.ydoc = Doc()
+        self.text = self.ydoc["text"] = Text()
+
+    async def connect(self) -> None:
+        connected, _ = await self.communicator.connect()
+        assert connected
+        # the consumer sends its SYNC_STEP1 first
+        message = await self.communicator.receive_from()
+        assert message[:2] == bytes([YMessageType.SYNC, YSyncMessageType.SYNC_STEP1])
+        await self.communicator.send_to(bytes_data=create_sync_message(self.ydoc))
+        message = await self.communicator.receive_from()
+        assert message[:2] == bytes([YMessageType.SYNC, YSyncMessageType.SYNC_STEP2])
+        handle_sync_message(message[1:], self.ydoc)
+
+    async def send_update(self, update: bytes) -> None:
+        await self.communicator.send_to(bytes_data=create_update_message(update))
+
+    async def receive_update(self) -> None:
+        message = await self.communicator.receive_from()
+        assert message[:2] == bytes([YMessageType.SYNC, YSyncMessageType.SYNC_UPDATE])
+        handle_sync_message(message[1:], self.ydoc)
+
+
+@pytest.mark.anyio
+async def test_shared_room():
+    client0 = Client("/ws/shared-room")
+    client1 = Client("/ws/shared-room")
+    await client0.connect()
+    await client1.connect()
+    # the consumers of a room in this process share one document
+    room = _rooms["shared-room"]
+    assert room.consumer_nb == 2
+
+    client0.text += "Hello"
+    await client0.send_update(client0.ydoc.get_update())
+    await client1.receive_update()
+    assert str(client1.text) == "Hello"
+    assert str(room.ydoc.get("text", type=Text)) == "Hello"
+    # an update is not sent back to its sender
+    assert await client0.communicator.receive_nothing()
+
+    # a client joining later gets the document from the shared room
+    client2 = Client("/ws/shared-room")
+    await client2.connect()
+    assert str(client2.text) == "Hello"
+    assert room.consumer_nb == 3
+
+    for client in (client0, client1, client2):
+        await client.communicator.disconnect()
+    assert "shared-room" not in _rooms
+
+
+@pytest.mark.anyio
+async def test_process_echo():
+    client = Client("/ws/echo-room")
+    await client.connect()
+    room = _rooms["echo-room"]
+    channel_layer = get_channel_layer()
+
+    # an update sent to the group by this process is already in the shared document,
+    # it is only forwarded to the client
+    ydoc = Doc()
+    ydoc["text"] = Text("Hello")
+    await channel_layer.group_send(
+        "echo-room",
+        {
+            "type": "send_message",
+            "message": create_update_message(ydoc.get_update()),
+            "sender": None,
+            "process": PROCESS_ID,
+        },
+    )
+    await client.receive_update()
+    assert str(client.text) == "Hello"
+    assert str(room.ydoc.get("text", type=Text)) == ""
+
+    # an update from another process is applied to the shared document
+    ydoc = Doc()
+    ydoc["text"] = Text("Bye")
+    await channel_layer.group_send(
+        "echo-room",
+        {
+            "type": "send_message",
+            "message": create_update_message(ydoc.get_update()),
+            "sender": None,
+            "process": "other-process",
+        },
+    )
+    await client.receive_update()
+    assert "Bye" in str(room.ydoc.get("text", type=Text))
+
+    await client.communicator.disconnect()
+
+
+@pytest.mark.anyio
+async def test_batch_interval():
+    client0 = Client("/batch/batch-room")
+    client1 = Client("/batch/batch-room")
+    await client0.connect()
+    await client1.connect()
+
+    # the updates received during the batch interval are sent as one update
+    state = client0.ydoc.get_state()
+    client0.text += "Hello"
+    await client0.send_update(client0.ydoc.get_update(state))
+    state = client0.ydoc.get_state()
+    client0.text += ", World!"
+    await client0.send_update(client0.ydoc.get_update(state))
+    assert await client1.communicator.receive_nothing(timeout=0.1)
+    await client1.receive_update()
+    assert str(client1.text) == "Hello, World!"
+    assert await client1.communicator.receive_nothing(timeout=0.5)
+
+    await client0.communicator.disconnect()
+    await client1.communicator.disconnect()
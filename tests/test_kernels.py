@@ -1,14 +1,32 @@
+import json
+import math
 import os
+import signal
 import sys
 from pathlib import Path
 from time import sleep
 
+import anyio
 import pytest
-from anyio import create_task_group
+from anyio import create_memory_object_stream, create_task_group
 from fps import get_root_module, merge_config
+from fps_kernels.kernel_driver.connect import channels, get_ipc_path, write_connection_file
+from fps_kernels.kernel_driver.driver import KernelDriver
+from fps_kernels.kernel_driver.forkserver import ForkedProcess
+from fps_kernels.kernel_driver.iopub import IOPubRateLimiter, coalesce_stream_parts
+from fps_kernels.kernel_driver.kernelspec import KernelspecRegistry, find_kernelspec
+from fps_kernels.kernel_driver.message import create_message, pack, send_message, unpack
+from fps_kernels.kernel_server.message import (
+    KernelMessage,
+    deserialize_msg_from_ws_v1,
+    from_binary,
+    get_msg_from_parts,
+    to_binary,
+)
 from fps_kernels.kernel_server.server import KernelServer, kernels
 from httpx import AsyncClient
 from httpx_ws import aconnect_ws
+from pycrdt import Array, Doc, Map, Text
 
 os.environ["PYDEVD_DISABLE_FILE_VALIDATION"] = "1"
 
@@ -134,3 +152,921 @@ async def test_kernel_messages(auth_mode, capfd, unused_tcp_port):
             assert err.count("[IPKernelApp] WARNING | Unknown message type: 'msg_type_0'") >= 1
 
             tg.start_soon(kernel_server.stop)
+        del kernels[kernel_id]
+
+
+@pytest.mark.parametrize("buffers", ([], [b"buffer0", b"buffer1"]))
+def test_legacy_serialization(buffers):
+    header = {"msg_id": "msg_id_0", "msg_type": "display_data", "date": "2024-01-01T00:00:00Z"}
+    content = {"data": {"text/plain": "Hello \u00e9"}, "metadata": {}}
+    parts = [b"signature", pack(header), pack({"msg_id": "parent"}), pack({}), pack(content)]
+    parts += buffers
+    message = KernelMessage(parts, {"msg_id": "parent"}, "iopub")
+
+    # same message as when it is decoded and re-encoded
+    msg = get_msg_from_parts(parts)
+    msg["channel"] = "iopub"
+    legacy_msg = message.to_legacy()
+    assert message.to_legacy() is legacy_msg
+    if buffers:
+        expected_msg = from_binary(to_binary(msg))  # type: ignore[arg-type]
+        msg = from_binary(legacy_msg)  # type: ignore[arg-type]
+        assert [bytes(b) for b in msg.pop("buffers")] == buffers
+        expected_msg.pop("buffers")
+        assert msg == expected_msg
+    else:
+        assert json.loads(legacy_msg) == msg
+
+
+def test_update_last_activity():
+    kernel_server = KernelServer()
+    header = {"msg_id": "msg_id_0", "msg_type": "status", "date": "2024-01-01T00:00:00Z"}
+    parts = [b"signature", pack(header), pack({}), pack({}), pack({"execution_state": "busy"})]
+    kernel_server.update_last_activity(KernelMessage(parts, {}, "iopub"))
+    assert kernel_server.last_activity == {
+        "date": "2024-01-01T00:00:00Z",
+        "execution_state": "busy",
+    }
+
+    # the header of other messages is not parsed
+    header = {"msg_id": "msg_id_1", "msg_type": "stream", "date": "2024-01-01T00:00:01Z"}
+    parts = [b"signature", pack(header), pack({}), pack({}), pack({"text": "status"})]
+    message = KernelMessage(parts, {}, "iopub")
+    kernel_server.update_last_activity(message)
+    assert message._header is None
+    assert kernel_server.last_activity["execution_state"] == "busy"
+
+
+def test_coalesce_stream_parts():
+    def stream(name, text, parent_id="parent_0"):
+        header = {"msg_id": text, "msg_type": "stream"}
+        content = {"name": name, "text": text}
+        return [b"signature", pack(header), pack({"msg_id": parent_id}), pack({}), pack(content)]
+
+    status = [b"signature", pack({"msg_type": "status"}), pack({}), pack({}), pack({})]
+    batch = [
+        stream("stdout", "0"),
+        stream("stdout", "1"),
+        stream("stderr", "2"),
+        stream("stderr", "3", parent_id="parent_1"),
+        status,
+        stream("stdout", "4"),
+        stream("stdout", "5"),
+    ]
+    coalesced = coalesce_stream_parts(batch)
+    assert [unpack(parts[4]).get("text") for parts in coalesced] == ["01", "2", "3", None, "45"]
+    # a merged message keeps the header of the first message
+    assert unpack(coalesced[0][1])["msg_id"] == "0"
+    assert coalesced[1] is batch[2]
+
+
+def test_iopub_rate_limiter():
+    rate_limiter = IOPubRateLimiter(msg_rate_limit=2, window=1)
+    assert [rate_limiter.limit(1) for _ in range(4)] == ["forward", "forward", "notify", "drop"]
+    assert rate_limiter.throttled
+    assert "iopub_msg_rate_limit=2" in rate_limiter.notice
+
+    rate_limiter = IOPubRateLimiter(data_rate_limit=10, window=1)
+    assert [rate_limiter.limit(6) for _ in range(2)] == ["forward", "notify"]
+
+    rate_limiter = IOPubRateLimiter()
+    assert not rate_limiter.enabled
+    assert rate_limiter.limit(10**9) == "forward"
+
+
+def test_iopub_replay():
+    def iopub_message(text):
+        header = {"msg_id": text, "msg_type": "stream"}
+        content = {"name": "stdout", "text": text}
+        parts = [b"signature", pack(header), pack({}), pack({}), pack(content)]
+        return KernelMessage(parts, {}, "iopub")
+
+    kernel_server = KernelServer(iopub_replay_buffer_size=2)
+    send_stream, receive_stream = create_memory_object_stream(10)
+    kernel_server.broadcast_iopub(iopub_message("0"))
+
+    # a new session doesn't get past messages
+    kernel_server.replay_iopub("session_id_0", send_stream)
+    assert receive_stream.statistics().current_buffer_used == 0
+
+    # a reconnecting session gets the messages it missed, as far as they are buffered
+    for text in ("1", "2", "3"):
+        kernel_server.broadcast_iopub(iopub_message(text))
+    kernel_server.replay_iopub("session_id_0", send_stream)
+    assert receive_stream.statistics().current_buffer_used == 2
+    replayed = [unpack(receive_stream.receive_nowait().parts[4])["text"] for _ in range(2)]
+    assert replayed == ["2", "3"]
+
+    # the buffer is also bounded by the size of the messages, which are buffered without their
+    # wire representations
+    message = iopub_message("4")
+    kernel_server = KernelServer(iopub_replay_buffer_max_bytes=message.size * 2)
+    message.to_v1()
+    kernel_server.broadcast_iopub(message)
+    assert kernel_server.iopub_buffer[0]._v1 is None
+    for text in ("5", "6"):
+        kernel_server.broadcast_iopub(iopub_message(text))
+    assert [buffered.seq for buffered in kernel_server.iopub_buffer] == [2, 3]
+    assert kernel_server.iopub_buffer_bytes == message.size * 2
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("overflow", ("drop", "disconnect"))
+async def test_session_queue_overflow(overflow):
+    def make_message(msg_id, msg_type, channel_name):
+        header = {"msg_id": msg_id, "msg_type": msg_type}
+        parts = [b"signature", pack(header), pack({}), pack({}), pack({})]
+        return KernelMessage(parts, {}, channel_name)
+
+    kernel_server = KernelServer(session_queue_size=2, session_queue_overflow=overflow)
+    send_stream, receive_stream = create_memory_object_stream(2)
+    cancel_scope = anyio.CancelScope()
+    kernel_server.session_queues["session_id_0"] = send_stream
+    kernel_server.session_cancel_scopes["session_id_0"] = cancel_scope
+    for msg_id in ("0", "1", "2"):
+        kernel_server.queue_message("session_id_0", make_message(msg_id, "stream", "iopub"))
+
+    # the messages that fit in the queue are kept
+    assert [receive_stream.receive_nowait().header["msg_id"] for _ in range(2)] == ["0", "1"]
+    # a slow session misses the next IOPub messages, or is disconnected to reconnect
+    assert cancel_scope.cancel_called == (overflow == "disconnect")
+
+    # a slow session that cannot receive a reply is always disconnected
+    for msg_id in ("3", "4", "5"):
+        kernel_server.queue_message(
+            "session_id_0", make_message(msg_id, "execute_reply", "shell")
+        )
+    assert cancel_scope.cancel_called
+
+    # a message queued to a session whose websocket was just closed is ignored
+    receive_stream.close()
+    kernel_server.queue_message("session_id_0", make_message("6", "execute_reply", "shell"))
+
+
+def test_v1_serialization():
+    header = {"msg_id": "msg_id_0", "msg_type": "display_data"}
+    parts = [b"signature", pack(header), pack({}), pack({}), pack({}), b"buffer0", b"buffer1"]
+    message = KernelMessage(parts, {}, "iopub")
+    channel, msg_list = deserialize_msg_from_ws_v1(message.to_v1())
+    assert channel == "iopub"
+    assert msg_list == parts[1:]
+    # the parts are not copied from the websocket message
+    assert all(isinstance(part, memoryview) for part in msg_list)
+
+    msg = {"header": header, "content": {}, "buffers": [b"buffer0"]}
+    msg = from_binary(to_binary(msg))  # type: ignore[arg-type]
+    assert msg["header"] == header
+    assert msg["buffers"] == [b"buffer0"]
+
+
+def test_codec():
+    msg = {"header": {"msg_id": "msg_id_0", "date": "2024-01-01T00:00:00Z"}, "text": "é"}
+    assert unpack(pack(msg)) == msg
+    assert unpack(memoryview(pack(msg))) == msg
+    # what orjson doesn't support falls back to the standard library
+    assert unpack(pack({"value": 2**70})) == {"value": 2**70}
+    assert math.isnan(unpack(b'{"value": NaN}')["value"])
+
+
+@pytest.mark.anyio
+async def test_kernel_pool(tmp_path, unused_tcp_port):
+    prev_dir = os.getcwd()
+    os.chdir(tmp_path)
+    (tmp_path / "subdir").mkdir()
+    url = f"http://127.0.0.1:{unused_tcp_port}"
+    config = merge_config(
+        CONFIG,
+        {
+            "jupyverse": {
+                "config": {"port": unused_tcp_port},
+                "modules": {
+                    "auth": {"config": {"mode": "noauth"}},
+                    "kernels": {"config": {"kernel_pool_size": 1}},
+                },
+            }
+        },
+    )
+    try:
+        async with get_root_module(config) as root_module, AsyncClient() as http:
+            kernel_pool = root_module.modules["kernels"].kernels.kernel_pool
+            with anyio.fail_after(30):
+                while not kernel_pool.ready_kernels("python3"):
+                    await anyio.sleep(0.1)
+            pooled_kernel_server = kernel_pool._ready_kernels["python3"][0]
+
+            response = await http.post(
+                f"{url}/api/sessions",
+                json={
+                    "kernel": {"name": "python3"},
+                    "name": "notebook.ipynb",
+                    "path": "subdir/notebook.ipynb",
+                    "type": "notebook",
+                },
+            )
+            kernel_id = response.json()["kernel"]["id"]
+            # the session attaches to the pooled kernel
+            assert kernels[kernel_id]["server"] is pooled_kernel_server
+
+            # the kernel runs in the notebook's directory
+            msg = {
+                "channel": "shell",
+                "parent_header": {},
+                "metadata": {},
+                "content": {"code": "import os; print(os.getcwd())", "silent": False},
+                "header": {
+                    "msg_type": "execute_request",
+                    "msg_id": "msg_id_0",
+                    "session": "session_id_0",
+                    "username": "",
+                    "version": "5.3",
+                },
+                "buffers": [],
+            }
+            async with aconnect_ws(
+                f"{url}/api/kernels/{kernel_id}/channels?session_id=session_id_0"
+            ) as websocket:
+                await websocket.send_json(msg)
+                with anyio.fail_after(10):
+                    while True:
+                        msg = await websocket.receive_json()
+                        if msg["msg_type"] == "stream":
+                            break
+            assert msg["content"]["text"].strip() == str(tmp_path / "subdir")
+
+            # the pool is refilled
+            with anyio.fail_after(30):
+                while not kernel_pool.ready_kernels("python3"):
+                    await anyio.sleep(0.1)
+    finally:
+        os.chdir(prev_dir)
+
+
+@pytest.mark.anyio
+async def test_kernel_forkserver(tmp_path, unused_tcp_port):
+    prev_dir = os.getcwd()
+    os.chdir(tmp_path)
+    (tmp_path / "subdir").mkdir()
+    url = f"http://127.0.0.1:{unused_tcp_port}"
+    config = merge_config(
+        CONFIG,
+        {
+            "jupyverse": {
+                "config": {"port": unused_tcp_port},
+                "modules": {
+                    "auth": {"config": {"mode": "noauth"}},
+                    # no module is preloaded, so that the template process doesn't compete
+                    # with the server's startup for the CPU
+                    "kernels": {
+                        "config": {"kernel_launcher": "forkserver", "forkserver_preload": []}
+                    },
+                },
+            }
+        },
+    )
+    try:
+        async with get_root_module(config) as root_module, AsyncClient() as http:
+            fork_server = root_module.modules["kernels"].kernels.fork_server
+            response = await http.post(
+                f"{url}/api/sessions",
+                json={
+                    "kernel": {"name": "python3"},
+                    "name": "notebook.ipynb",
+                    "path": "subdir/notebook.ipynb",
+                    "type": "notebook",
+                },
+            )
+            kernel_id = response.json()["kernel"]["id"]
+            kernel_process = kernels[kernel_id]["server"].kernel_process
+            assert isinstance(kernel_process, ForkedProcess)
+
+            # the kernel is a child of the template process, and runs in the notebook's directory
+            msg = {
+                "channel": "shell",
+                "parent_header": {},
+                "metadata": {},
+                "content": {
+                    "code": "import os; print(os.getppid(), os.getcwd())",
+                    "silent": False,
+                },
+                "header": {
+                    "msg_type": "execute_request",
+                    "msg_id": "msg_id_0",
+                    "session": "session_id_0",
+                    "username": "",
+                    "version": "5.3",
+                },
+                "buffers": [],
+            }
+            async with aconnect_ws(
+                f"{url}/api/kernels/{kernel_id}/channels?session_id=session_id_0"
+            ) as websocket:
+                await websocket.send_json(msg)
+                with anyio.fail_after(10):
+                    while True:
+                        msg = await websocket.receive_json()
+                        if msg["msg_type"] == "stream":
+                            break
+            ppid, cwd = msg["content"]["text"].split()
+            assert int(ppid) == fork_server._process.pid
+            assert cwd == str(tmp_path / "subdir")
+
+            # the kernel's exit is reported by the template process
+            response = await http.delete(f"{url}/api/kernels/{kernel_id}")
+            assert response.status_code == 204
+            assert kernel_process.returncode == -signal.SIGTERM
+    finally:
+        os.chdir(prev_dir)
+
+
+def test_ipc_connection_file(tmp_path, monkeypatch):
+    monkeypatch.setenv("JUPYTER_RUNTIME_DIR", str(tmp_path / "runtime"))
+    connection_file_path, cfg = write_connection_file(
+        str(tmp_path / "kernel.json"), transport="ipc"
+    )
+    assert json.loads(Path(connection_file_path).read_text()) == cfg
+    assert cfg["transport"] == "ipc"
+    # the sockets are files in the runtime directory, no port is allocated
+    assert Path(cfg["ip"]).parent == tmp_path / "runtime"
+    assert sorted(cfg[f"{channel}_port"] for channel in channels) == [1, 2, 3, 4, 5]
+
+    # the paths of existing sockets are not reused
+    Path(get_ipc_path(cfg["ip"], 1)).touch()
+    _, cfg = write_connection_file(str(tmp_path / "kernel.json"), ip=cfg["ip"], transport="ipc")
+    assert sorted(cfg[f"{channel}_port"] for channel in channels) == [2, 3, 4, 5, 6]
+
+
+@pytest.mark.anyio
+async def test_kernel_ipc(tmp_path, monkeypatch, unused_tcp_port):
+    monkeypatch.setenv("JUPYTER_RUNTIME_DIR", str(tmp_path))
+    url = f"http://127.0.0.1:{unused_tcp_port}"
+    config = merge_config(
+        CONFIG,
+        {
+            "jupyverse": {
+                "config": {"port": unused_tcp_port},
+                "modules": {
+                    "auth": {"config": {"mode": "noauth"}},
+                    "kernels": {"config": {"kernel_transport": "ipc"}},
+                },
+            }
+        },
+    )
+    async with get_root_module(config), AsyncClient() as http:
+        response = await http.post(
+            f"{url}/api/sessions",
+            json={
+                "kernel": {"name": "python3"},
+                "name": "notebook.ipynb",
+                "path": "notebook.ipynb",
+                "type": "notebook",
+            },
+        )
+        kernel_id = response.json()["kernel"]["id"]
+        cfg = kernels[kernel_id]["server"].connection_cfg
+        assert cfg["transport"] == "ipc"
+        ipc_paths = [Path(get_ipc_path(cfg["ip"], cfg[f"{c}_port"])) for c in channels]
+        assert all(path.is_socket() for path in ipc_paths)
+
+        msg = {
+            "channel": "shell",
+            "parent_header": {},
+            "metadata": {},
+            "content": {"code": "print(1 + 1)", "silent": False},
+            "header": {
+                "msg_type": "execute_request",
+                "msg_id": "msg_id_0",
+                "session": "session_id_0",
+                "username": "",
+                "version": "5.3",
+            },
+            "buffers": [],
+        }
+        async with aconnect_ws(
+            f"{url}/api/kernels/{kernel_id}/channels?session_id=session_id_0"
+        ) as websocket:
+            await websocket.send_json(msg)
+            with anyio.fail_after(10):
+                while True:
+                    msg = await websocket.receive_json()
+                    if msg["msg_type"] == "stream":
+                        break
+        assert msg["content"]["text"].strip() == "2"
+
+        response = await http.delete(f"{url}/api/kernels/{kernel_id}")
+        assert response.status_code == 204
+        assert not any(path.exists() for path in ipc_paths)
+
+
+@pytest.mark.anyio
+async def test_kernel_server_subscribe():
+    kernel_server = KernelServer(kernelspec_path=find_kernelspec("python3"))
+    async with create_task_group() as tg:
+        await tg.start(kernel_server.start)
+        messages = kernel_server.subscribe("subscriber", comm_messages=True)
+        msg = create_message(
+            "execute_request",
+            content={"code": "print('hello')", "silent": False},
+            session_id="subscriber",
+        )
+        await send_message(msg, kernel_server.shell_channel, kernel_server.key)
+        # the replies and the outputs of the subscriber's requests are dispatched to it
+        received = {}
+        with anyio.fail_after(10):
+            async for message in messages:
+                received[(message.channel_name, message.header["msg_type"])] = message
+                if ("shell", "execute_reply") in received and ("iopub", "stream") in received:
+                    break
+        stream_msg = received[("iopub", "stream")]
+        assert stream_msg.parent_header["msg_id"] == msg["header"]["msg_id"]
+        assert unpack(stream_msg.parts[4])["text"] == "hello\n"
+
+        # comm messages are dispatched whatever their parent
+        msg = create_message(
+            "comm_open",
+            content={"comm_id": "comm_id_0", "target_name": "unknown", "data": {}},
+            session_id="other",
+        )
+        await send_message(msg, kernel_server.shell_channel, kernel_server.key)
+        with anyio.fail_after(10):
+            async for message in messages:
+                if message.header["msg_type"] == "comm_close":
+                    break
+        assert message.parent_header["session"] == "other"
+
+        kernel_server.unsubscribe("subscriber")
+        assert not kernel_server.subscribers
+        await kernel_server.stop()
+
+
+@pytest.mark.anyio
+async def test_kernel_server_subscriber_overflow(monkeypatch):
+    monkeypatch.setattr("fps_kernels.kernel_server.server.SUBSCRIBER_TIMEOUT", 0.2)
+
+    def shell_message(msg_id, session):
+        header = {"msg_id": msg_id, "msg_type": "execute_reply"}
+        parts = [b"signature", pack(header), pack({}), pack({}), pack({})]
+        return KernelMessage(parts, {"session": session}, "shell")
+
+    kernel_server = KernelServer(session_queue_size=1)
+
+    # a subscriber which is behind slows down the messages, without missing any
+    messages = kernel_server.subscribe("subscriber")
+    await kernel_server.dispatch_to_subscribers(shell_message("0", "subscriber"))
+    async with create_task_group() as tg:
+        tg.start_soon(kernel_server.dispatch_to_subscribers, shell_message("1", "subscriber"))
+        await anyio.sleep(0.1)
+        assert (await messages.receive()).header["msg_id"] == "0"
+    assert messages.receive_nowait().header["msg_id"] == "1"
+    assert "subscriber" in kernel_server.subscribers
+
+    # a subscriber which doesn't receive its messages is unsubscribed
+    for msg_id in ("2", "3"):
+        await kernel_server.dispatch_to_subscribers(shell_message(msg_id, "subscriber"))
+    assert "subscriber" not in kernel_server.subscribers
+    assert messages.receive_nowait().header["msg_id"] == "2"
+    with pytest.raises(anyio.EndOfStream):
+        messages.receive_nowait()
+
+    # so is a subscriber which is gone
+    messages = kernel_server.subscribe("subscriber")
+    messages.close()
+    await kernel_server.dispatch_to_subscribers(shell_message("4", "subscriber"))
+    assert "subscriber" not in kernel_server.subscribers
+
+
+@pytest.mark.anyio
+async def test_kernel_driver_unsubscribed():
+    kernel_server = KernelServer(kernelspec_path=find_kernelspec("python3"))
+    async with create_task_group() as tg:
+        await tg.start(kernel_server.start)
+        driver = KernelDriver(
+            kernelspec_path=kernel_server.kernelspec_path,
+            write_connection_file=False,
+            connection_file=kernel_server.connection_file_path,
+        )
+        await tg.start(driver.attach, kernel_server)
+        # without collaborative widgets, the driver doesn't get the comm messages
+        assert driver.session_id in kernel_server.subscribers
+        assert driver.session_id not in kernel_server.comm_subscribers
+
+        ydoc = Doc()
+        ydoc["cell"] = ycell = Map(
+            {"cell_type": "code", "source": Text("print('hello')"), "outputs": Array()}
+        )
+        await driver.execute(ycell, timeout=10)
+        assert ycell["outputs"][0]["text"][0] == "hello\n"
+
+        # a driver which is unsubscribed by the kernel server is stopped
+        kernel_server.unsubscribe(driver.session_id)
+        with anyio.fail_after(5):
+            await driver.stopped_event.wait()
+        await kernel_server.stop()
+
+
+@pytest.mark.anyio
+async def test_kernel_forkserver_template_death(unused_tcp_port):
+    url = f"http://127.0.0.1:{unused_tcp_port}"
+    config = merge_config(
+        CONFIG,
+        {
+            "jupyverse": {
+                "config": {"port": unused_tcp_port},
+                "modules": {
+                    "auth": {"config": {"mode": "noauth"}},
+                    "kernels": {
+                        "config": {
+                            "kernel_launcher": "forkserver",
+                            "forkserver_preload": [],
+                            "kernel_auto_restart": True,
+                        }
+                    },
+                },
+            }
+        },
+    )
+    async with get_root_module(config) as root_module, AsyncClient() as http:
+        fork_server = root_module.modules["kernels"].kernels.fork_server
+        response = await http.post(
+            f"{url}/api/sessions",
+            json={
+                "kernel": {"name": "python3"},
+                "name": "notebook.ipynb",
+                "path": "notebook.ipynb",
+                "type": "notebook",
+            },
+        )
+        kernel_id = response.json()["kernel"]["id"]
+        kernel_server = kernels[kernel_id]["server"]
+        kernel_process = kernel_server.kernel_process
+        assert isinstance(kernel_process, ForkedProcess)
+        await wait_for_execution_state(http, url, kernel_id, "idle")
+
+        # the kernel keeps running without the template process, and is not restarted
+        os.kill(fork_server._process.pid, signal.SIGKILL)
+        with anyio.fail_after(10):
+            while fork_server.can_fork([sys.executable, "-m", "ipykernel_launcher"]):
+                await anyio.sleep(0.1)
+        await anyio.sleep(2)
+        assert kernel_process.returncode is None
+        assert kernel_server.kernel_process is kernel_process
+        response = await http.get(f"{url}/api/kernels/{kernel_id}")
+        assert response.json()["execution_state"] == "idle"
+
+        # it can still be signalled
+        response = await http.delete(f"{url}/api/kernels/{kernel_id}")
+        assert response.status_code == 204
+        assert kernel_process.returncode is not None
+        with pytest.raises(ProcessLookupError):
+            kernel_process.terminate()
+
+
+async def wait_for_execution_state(http, url, kernel_id, execution_state):
+    with anyio.fail_after(30):
+        while True:
+            response = await http.get(f"{url}/api/kernels/{kernel_id}")
+            if response.json()["execution_state"] == execution_state:
+                return
+            await anyio.sleep(0.1)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("auto_restart", (True, False))
+async def test_kernel_auto_restart(auto_restart, unused_tcp_port):
+    url = f"http://127.0.0.1:{unused_tcp_port}"
+    config = merge_config(
+        CONFIG,
+        {
+            "jupyverse": {
+                "config": {"port": unused_tcp_port},
+                "modules": {
+                    "auth": {"config": {"mode": "noauth"}},
+                    "kernels": {"config": {"kernel_auto_restart": auto_restart}},
+                },
+            }
+        },
+    )
+    async with get_root_module(config), AsyncClient() as http:
+        response = await http.post(
+            f"{url}/api/sessions",
+            json={
+                "kernel": {"name": "python3"},
+                "name": "notebook.ipynb",
+                "path": "notebook.ipynb",
+                "type": "notebook",
+            },
+        )
+        kernel_id = response.json()["kernel"]["id"]
+        kernel_server = kernels[kernel_id]["server"]
+        pid = kernel_server.kernel_process.pid
+        os.kill(pid, signal.SIGKILL)
+        if auto_restart:
+            # the kernel is restarted with the same connection file
+            with anyio.fail_after(30):
+                while kernel_server.kernel_process.pid == pid:
+                    await anyio.sleep(0.1)
+            await wait_for_execution_state(http, url, kernel_id, "idle")
+        else:
+            await wait_for_execution_state(http, url, kernel_id, "dead")
+
+
+@pytest.mark.anyio
+async def test_kernel_restart(unused_tcp_port):
+    url = f"http://127.0.0.1:{unused_tcp_port}"
+    config = merge_config(
+        CONFIG,
+        {
+            "jupyverse": {
+                "config": {"port": unused_tcp_port},
+                "modules": {"auth": {"config": {"mode": "noauth"}}},
+            }
+        },
+    )
+
+    def execute_request(code, msg_id):
+        return {
+            "channel": "shell",
+            "parent_header": {},
+            "metadata": {},
+            "content": {"code": code, "silent": False},
+            "header": {
+                "msg_type": "execute_request",
+                "msg_id": msg_id,
+                "session": "session_id_0",
+                "username": "",
+                "version": "5.3",
+            },
+            "buffers": [],
+        }
+
+    async def get_stream_text(websocket):
+        with anyio.fail_after(10):
+            while True:
+                msg = await websocket.receive_json()
+                if msg["msg_type"] in ("stream", "error"):
+                    return msg["content"].get("text", msg["content"].get("ename"))
+
+    async with get_root_module(config), AsyncClient() as http:
+        response = await http.post(
+            f"{url}/api/sessions",
+            json={
+                "kernel": {"name": "python3"},
+                "name": "notebook.ipynb",
+                "path": "notebook.ipynb",
+                "type": "notebook",
+            },
+        )
+        kernel_id = response.json()["kernel"]["id"]
+        kernel_server = kernels[kernel_id]["server"]
+        pid = kernel_server.kernel_process.pid
+        connection_cfg = dict(kernel_server.connection_cfg)
+        async with aconnect_ws(
+            f"{url}/api/kernels/{kernel_id}/channels?session_id=session_id_0"
+        ) as websocket:
+            await websocket.send_json(execute_request("a = 1; print(a)", "msg_id_0"))
+            assert (await get_stream_text(websocket)).strip() == "1"
+
+            response = await http.post(f"{url}/api/kernels/{kernel_id}/restart", timeout=30)
+            assert response.json()["execution_state"] == "idle"
+            # the kernel is relaunched with the same connection configuration
+            assert kernel_server.kernel_process.pid != pid
+            assert kernel_server.connection_cfg == connection_cfg
+
+            # the websocket is still connected, to the new kernel
+            await websocket.send_json(execute_request("print(a)", "msg_id_1"))
+            assert await get_stream_text(websocket) == "NameError"
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("stop_while", ("shutting_down", "starting"))
+async def test_kernel_stop_while_restarting(stop_while, unused_tcp_port):
+    url = f"http://127.0.0.1:{unused_tcp_port}"
+    config = merge_config(
+        CONFIG,
+        {
+            "jupyverse": {
+                "config": {"port": unused_tcp_port},
+                "modules": {"auth": {"config": {"mode": "noauth"}}},
+            }
+        },
+    )
+    async with get_root_module(config), AsyncClient() as http:
+        response = await http.post(
+            f"{url}/api/sessions",
+            json={
+                "kernel": {"name": "python3"},
+                "name": "notebook.ipynb",
+                "path": "notebook.ipynb",
+                "type": "notebook",
+            },
+        )
+        kernel_id = response.json()["kernel"]["id"]
+        kernel_server = kernels[kernel_id]["server"]
+        await wait_for_execution_state(http, url, kernel_id, "idle")
+        pid = kernel_server.kernel_process.pid
+        responses = []
+
+        async def restart():
+            response = await http.post(f"{url}/api/kernels/{kernel_id}/restart", timeout=30)
+            responses.append(response)
+
+        async with create_task_group() as tg:
+            tg.start_soon(restart)
+            await wait_for_execution_state(http, url, kernel_id, "restarting")
+            if stop_while == "starting":
+                with anyio.fail_after(10):
+                    while kernel_server.kernel_process.pid == pid:
+                        await anyio.sleep(0.01)
+            response = await http.delete(f"{url}/api/kernels/{kernel_id}")
+            assert response.status_code == 204
+            # the restart request doesn't hang, and no kernel is left running
+            with anyio.fail_after(10):
+                while not responses:
+                    await anyio.sleep(0.1)
+        assert kernel_server.kernel_process.returncode is not None
+        assert kernel_id not in kernels
+
+
+@pytest.mark.anyio
+async def test_kernel_heartbeat(unused_tcp_port):
+    url = f"http://127.0.0.1:{unused_tcp_port}"
+    config = merge_config(
+        CONFIG,
+        {
+            "jupyverse": {
+                "config": {"port": unused_tcp_port},
+                "modules": {
+                    "auth": {"config": {"mode": "noauth"}},
+                    "kernels": {"config": {"heartbeat_interval": 0.2}},
+                },
+            }
+        },
+    )
+    async with get_root_module(config), AsyncClient() as http:
+        response = await http.post(
+            f"{url}/api/sessions",
+            json={
+                "kernel": {"name": "python3"},
+                "name": "notebook.ipynb",
+                "path": "notebook.ipynb",
+                "type": "notebook",
+            },
+        )
+        kernel_id = response.json()["kernel"]["id"]
+        pid = kernels[kernel_id]["server"].kernel_process.pid
+        # a hung kernel doesn't reply to heartbeats
+        os.kill(pid, signal.SIGSTOP)
+        try:
+            await wait_for_execution_state(http, url, kernel_id, "unknown")
+        finally:
+            os.kill(pid, signal.SIGCONT)
+        await wait_for_execution_state(http, url, kernel_id, "idle")
+
+
+@pytest.mark.anyio
+async def test_kernel_culling(unused_tcp_port):
+    url = f"http://127.0.0.1:{unused_tcp_port}"
+    config = merge_config(
+        CONFIG,
+        {
+            "jupyverse": {
+                "config": {"port": unused_tcp_port},
+                "modules": {
+                    "auth": {"config": {"mode": "noauth"}},
+                    "kernels": {"config": {"cull_idle_timeout": 1, "cull_interval": 0.2}},
+                },
+            }
+        },
+    )
+    async with get_root_module(config), AsyncClient() as http:
+        response = await http.post(
+            f"{url}/api/sessions",
+            json={
+                "kernel": {"name": "python3"},
+                "name": "notebook.ipynb",
+                "path": "notebook.ipynb",
+                "type": "notebook",
+            },
+        )
+        kernel_id = response.json()["kernel"]["id"]
+
+        # a connected kernel is not culled
+        async with aconnect_ws(f"{url}/api/kernels/{kernel_id}/channels?session_id=session_id_0"):
+            await anyio.sleep(1.5)
+            response = await http.get(f"{url}/api/kernels")
+            assert [kernel["id"] for kernel in response.json()] == [kernel_id]
+
+        # an idle kernel without connections is culled, with its session
+        with anyio.fail_after(10):
+            while (await http.get(f"{url}/api/kernels")).json():
+                await anyio.sleep(0.1)
+        assert (await http.get(f"{url}/api/sessions")).json() == []
+
+
+@pytest.mark.anyio
+async def test_kernel_culling_deleted_kernel(unused_tcp_port):
+    url = f"http://127.0.0.1:{unused_tcp_port}"
+    config = merge_config(
+        CONFIG,
+        {
+            "jupyverse": {
+                "config": {"port": unused_tcp_port},
+                "modules": {
+                    "auth": {"config": {"mode": "noauth"}},
+                    "kernels": {"config": {"cull_idle_timeout": 1, "cull_interval": 0.2}},
+                },
+            }
+        },
+    )
+    async with get_root_module(config) as root_module, AsyncClient() as http:
+        sessions = []
+        for i in range(2):
+            response = await http.post(
+                f"{url}/api/sessions",
+                json={
+                    "kernel": {"name": "python3"},
+                    "name": f"notebook{i}.ipynb",
+                    "path": f"notebook{i}.ipynb",
+                    "type": "notebook",
+                },
+            )
+            sessions.append(response.json())
+        kernels_plugin = root_module.modules["kernels"].kernels
+        stop_kernel = kernels_plugin.stop_kernel
+
+        async def stop_kernel_and_delete_session(kernel_id):
+            if kernel_id == sessions[0]["kernel"]["id"]:
+                # the other kernel is deleted while this one is culled
+                await http.delete(f"{url}/api/sessions/{sessions[1]['id']}")
+            await stop_kernel(kernel_id)
+
+        kernels_plugin.stop_kernel = stop_kernel_and_delete_session
+        with anyio.fail_after(10):
+            while (await http.get(f"{url}/api/kernels")).json():
+                await anyio.sleep(0.1)
+
+        # the culler is still running
+        response = await http.post(
+            f"{url}/api/sessions",
+            json={
+                "kernel": {"name": "python3"},
+                "name": "notebook.ipynb",
+                "path": "notebook.ipynb",
+                "type": "notebook",
+            },
+        )
+        with anyio.fail_after(10):
+            while (await http.get(f"{url}/api/kernels")).json():
+                await anyio.sleep(0.1)
+
+
+def write_kernelspec(kernel_dir, language):
+    kernel_dir.mkdir(parents=True)
+    (kernel_dir / "kernel.json").write_text(json.dumps({"language": language}))
+    (kernel_dir / "logo-64x64.png").write_bytes(b"")
+
+
+@pytest.mark.anyio
+async def test_kernelspec_registry(tmp_path):
+    user_dir = tmp_path / "user" / "kernels"
+    system_dir = tmp_path / "system" / "kernels"
+    write_kernelspec(system_dir / "kernel0", "system")
+    write_kernelspec(system_dir / "kernel1", "system")
+    user_dir.parent.mkdir()
+    registry = KernelspecRegistry([str(user_dir), str(system_dir)])
+    assert registry.find("kernel0") == str(system_dir / "kernel0" / "kernel.json")
+    assert registry.kernelspecs["kernel0"]["resources"] == ["logo-64x64.png"]
+    assert registry.find("kernel2") == ""
+    etag = registry.etag
+
+    async with create_task_group() as tg:
+        tg.start_soon(registry.watch)
+        await anyio.sleep(0.1)
+        # the user directory doesn't exist yet, and takes precedence over the system directory
+        write_kernelspec(user_dir / "kernel1", "user")
+        with anyio.fail_after(10):
+            while registry.kernelspecs["kernel1"]["spec"]["language"] != "user":
+                await anyio.sleep(0.1)
+        assert registry.find("kernel1") == str(user_dir / "kernel1" / "kernel.json")
+        assert registry.etag != etag
+        tg.cancel_scope.cancel()
+
+
+@pytest.mark.anyio
+async def test_kernelspecs_etag(unused_tcp_port):
+    url = f"http://127.0.0.1:{unused_tcp_port}"
+    config = merge_config(
+        CONFIG,
+        {
+            "jupyverse": {
+                "config": {"port": unused_tcp_port},
+                "modules": {"auth": {"config": {"mode": "noauth"}}},
+            }
+        },
+    )
+    async with get_root_module(config), AsyncClient() as http:
+        response = await http.get(f"{url}/api/kernelspecs")
+        assert response.status_code == 200
+        assert "python3" in response.json()["kernelspecs"]
+        etag = response.headers["etag"]
+        response = await http.get(f"{url}/api/kernelspecs", headers={"If-None-Match": etag})
+        assert response.status_code == 304
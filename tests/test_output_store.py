@@ -0,0 +1,166 @@
+import json
+import os
+from pathlib import Path
+
+import anyio
+import pytest
+from fps import get_root_module, merge_config
+from fps_yjs.output_store import OUTPUT_REF_MIMETYPE, OutputNotFound, OutputStore
+from fps_yjs.ydocs import ydocs
+from fps_yjs.ywebsocket import WebsocketProvider
+from httpx import AsyncClient
+from httpx_ws import aconnect_ws
+from utils import Websocket
+
+pytestmark = pytest.mark.anyio
+
+CONFIG = {
+    "jupyverse": {
+        "type": "jupyverse",
+        "modules": {
+            "app": {
+                "type": "app",
+            },
+            "auth": {
+                "type": "auth",
+                "config": {
+                    "test": True,
+                    "mode": "noauth",
+                },
+            },
+            "contents": {
+                "type": "contents",
+            },
+            "frontend": {
+                "type": "frontend",
+            },
+            "yjs": {
+                "type": "yjs",
+            },
+        }
+    }
+}
+
+
+async def test_output_store(tmp_path):
+    output_store = OutputStore(str(tmp_path), threshold=100)
+    small_output = {
+        "data": {"text/plain": "small"},
+        "metadata": {},
+        "output_type": "display_data",
+    }
+    large_output = {
+        "data": {"text/html": "<p>" + "large" * 100 + "</p>"},
+        "execution_count": 1,
+        "metadata": {},
+        "output_type": "execute_result",
+    }
+    assert await output_store.externalize(small_output) == small_output
+
+    reference = await output_store.externalize(large_output)
+    assert reference["output_type"] == "execute_result"
+    assert reference["execution_count"] == 1
+    output_id = reference["data"][OUTPUT_REF_MIMETYPE]["output_id"]
+    assert await output_store.get(output_id) == large_output
+    # outputs are content-addressed
+    assert await output_store.externalize(large_output) == reference
+    assert len(list(tmp_path.iterdir())) == 1
+
+    nb = {
+        "cells": [{"cell_type": "code", "outputs": [small_output, large_output]}],
+        "metadata": {},
+    }
+    externalized_nb = await output_store.externalize_notebook(nb)
+    assert externalized_nb["cells"][0]["outputs"] == [small_output, reference]
+    assert await output_store.inline_notebook(externalized_nb) == nb
+
+    with pytest.raises(OutputNotFound):
+        await output_store.get("../" + output_id)
+
+
+async def test_output_store_room(tmp_path, unused_tcp_port):
+    prev_dir = os.getcwd()
+    os.chdir(tmp_path)
+    file_output = {
+        "data": {"text/html": "<p>" + "file" * 100 + "</p>"},
+        "execution_count": 1,
+        "metadata": {},
+        "output_type": "execute_result",
+    }
+    client_output = {
+        "data": {"text/html": "<p>" + "client" * 100 + "</p>"},
+        "metadata": {},
+        "output_type": "display_data",
+    }
+    nb = {
+        "cells": [
+            {
+                "cell_type": "code",
+                "execution_count": 1,
+                "id": f"cell{i}",
+                "metadata": {},
+                "outputs": outputs,
+                "source": "",
+            }
+            for i, outputs in enumerate(([file_output], []))
+        ],
+        "metadata": {},
+        "nbformat": 4,
+        "nbformat_minor": 5,
+    }
+    path = "notebook.ipynb"
+    Path(path).write_text(json.dumps(nb))
+    url = f"http://127.0.0.1:{unused_tcp_port}"
+    config = merge_config(
+        CONFIG,
+        {
+            "jupyverse": {
+                "config": {"port": unused_tcp_port},
+                "modules": {
+                    "yjs": {
+                        "config": {
+                            "output_store_threshold": 100,
+                            "output_store_path": str(tmp_path / "outputs"),
+                        }
+                    }
+                },
+            }
+        },
+    )
+    try:
+        async with get_root_module(config), AsyncClient() as http:
+            response = await http.put(
+                f"{url}/api/collaboration/session/{path}",
+                json={"format": "json", "type": "notebook"},
+            )
+            file_id = response.json()["fileId"]
+            room_id = f"json:notebook:{file_id}"
+            ynb = ydocs["notebook"]()
+            async with aconnect_ws(
+                f"{url}/api/collaboration/room/{room_id}"
+            ) as websocket, WebsocketProvider(ynb.ydoc, Websocket(websocket, room_id)):
+                await anyio.sleep(0.5)
+                # the outputs of a notebook opened from disk are stored out-of-band
+                reference = ynb.get_cell(0)["outputs"][0]
+                output_id = reference["data"][OUTPUT_REF_MIMETYPE]["output_id"]
+                response = await http.get(f"{url}/api/collaboration/outputs/{output_id}")
+                assert response.json() == file_output
+
+                # the outputs written by a client too
+                ynb.ycells[1]["outputs"].append(client_output)
+                await anyio.sleep(0.5)
+                reference = ynb.get_cell(1)["outputs"][0]
+                output_id = reference["data"][OUTPUT_REF_MIMETYPE]["output_id"]
+                response = await http.get(f"{url}/api/collaboration/outputs/{output_id}")
+                assert response.json() == client_output
+
+                # the saved notebook has the full outputs
+                await anyio.sleep(1.5)
+                saved_nb = json.loads(Path(path).read_text())
+                assert saved_nb["cells"][0]["outputs"] == [file_output]
+                assert saved_nb["cells"][1]["outputs"] == [client_output]
+
+            response = await http.get(f"{url}/api/collaboration/outputs/{'0' * 64}")
+            assert response.status_code == 404
+    finally:
+        os.chdir(prev_dir)
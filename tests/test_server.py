@@ -1,4 +1,6 @@
 import json
+import os
+import shutil
 from functools import partial
 from pathlib import Path
 
@@ -15,6 +17,15 @@ prev_theme = {}
 test_theme = {"raw": '{// jupyverse test\n"theme": "JupyterLab Dark"}'}
 
 
+@pytest.fixture()
+def cwd(tmp_path):
+    # serve a copy of the test data, so that the notebooks saved by the server are thrown away
+    shutil.copytree(Path(__file__).parent / "data", tmp_path / "tests" / "data")
+    prev_dir = os.getcwd()
+    yield tmp_path
+    os.chdir(prev_dir)
+
+
 @pytest.mark.parametrize("auth_mode", ("noauth",))
 @pytest.mark.parametrize("clear_users", (False,))
 def test_settings_persistence_put(start_jupyverse):
@@ -125,6 +136,136 @@ async def test_rest_api(start_jupyverse):
         ]
 
 
+@pytest.mark.anyio
+@pytest.mark.parametrize("auth_mode", ("noauth",))
+@pytest.mark.parametrize("clear_users", (False,))
+async def test_execution_queue(start_jupyverse):
+    url = start_jupyverse
+    name = "notebook2.ipynb"
+    path = (Path("tests") / "data" / name).as_posix()
+    # create a session to launch a kernel
+    response = requests.post(
+        f"{url}/api/sessions",
+        data=json.dumps(
+            {
+                "kernel": {"name": "python3"},
+                "name": name,
+                "path": path,
+                "type": "notebook",
+            }
+        ),
+    )
+    r = response.json()
+    kernel_id = r["kernel"]["id"]
+    # get the room ID for the document
+    response = requests.put(
+        f"{url}/api/collaboration/session/{path}",
+        data=json.dumps(
+            {
+                "format": "json",
+                "type": "notebook",
+            }
+        ),
+    )
+    file_id = response.json()["fileId"]
+    document_id = f"json:notebook:{file_id}"
+    ydoc = Doc()
+
+    def get_cell_ids(status):
+        return {
+            key: [execution["cell_id"] for execution in executions]
+            for key, executions in status.items()
+        }
+
+    async def wait_for_status(status):
+        with anyio.fail_after(10):
+            while True:
+                response = requests.get(f"{url}/api/kernels/{kernel_id}/execution")
+                if get_cell_ids(response.json()) == status:
+                    break
+                await anyio.sleep(0.1)
+
+    async def wait_for_executed():
+        await wait_for_status({"running": [], "queued": []})
+        # wait for Y model to be updated
+        await anyio.sleep(0.5)
+        return json.loads(str(ycells))
+
+    async with aconnect_ws(
+        f"{url}/api/collaboration/room/{document_id}"
+    ) as websocket, WebsocketProvider(ydoc, Websocket(websocket, document_id)):
+        # connect to the shared notebook document
+        # wait for file to be loaded and Y model to be created in server and client
+        await anyio.sleep(0.5)
+        ydoc["cells"] = ycells = Array()
+        cell_ids = [ycell["id"] for ycell in ycells]
+
+        # run all: the cells after a failing cell are not executed
+        response = requests.post(
+            f"{url}/api/kernels/{kernel_id}/execution",
+            data=json.dumps({"document_id": document_id, "cell_ids": cell_ids[:3]}),
+        )
+        assert response.status_code == 200
+        # the first two cells are sent to the kernel, the third one is queued
+        await wait_for_status({"running": cell_ids[:2], "queued": cell_ids[2:3]})
+        cells = await wait_for_executed()
+        assert cells[1]["outputs"][0]["ename"] == "ZeroDivisionError"
+        assert cells[2]["outputs"] == []
+        assert cells[2]["execution_count"] is None
+
+        # a queued cell can be cancelled
+        response = requests.post(
+            f"{url}/api/kernels/{kernel_id}/execution",
+            data=json.dumps(
+                {
+                    "document_id": document_id,
+                    "cell_ids": [cell_ids[0], cell_ids[3], cell_ids[2]],
+                }
+            ),
+        )
+        await wait_for_status({"running": [cell_ids[0], cell_ids[3]], "queued": cell_ids[2:3]})
+        response = requests.post(
+            f"{url}/api/kernels/{kernel_id}/execution/cancel",
+            data=json.dumps({"cell_ids": [cell_ids[2]]}),
+        )
+        assert get_cell_ids(response.json()) == {
+            "running": [cell_ids[0], cell_ids[3]],
+            "queued": [],
+        }
+        cells = await wait_for_executed()
+        assert cells[3]["outputs"] == [
+            {"name": "stdout", "output_type": "stream", "text": ["executed\n"]}
+        ]
+        assert cells[2]["outputs"] == []
+
+        # the cells of a batch are not sent while a previous batch stopping on error is running
+        for cell_id in (cell_ids[0], cell_ids[3]):
+            response = requests.post(
+                f"{url}/api/kernels/{kernel_id}/execution",
+                data=json.dumps({"document_id": document_id, "cell_ids": [cell_id]}),
+            )
+        await wait_for_status({"running": cell_ids[:1], "queued": cell_ids[3:4]})
+        cells = await wait_for_executed()
+        assert cells[3]["outputs"] == [
+            {"name": "stdout", "output_type": "stream", "text": ["executed\n"]}
+        ]
+
+        # a running cell whose kernel dies doesn't block the queue
+        response = requests.post(
+            f"{url}/api/kernels/{kernel_id}/execution",
+            data=json.dumps({"document_id": document_id, "cell_ids": cell_ids[4:]}),
+        )
+        cells = await wait_for_executed()
+        assert cells[4]["execution_state"] == "idle"
+
+        # unknown cells are not queued
+        response = requests.post(
+            f"{url}/api/kernels/{kernel_id}/execution",
+            data=json.dumps({"document_id": document_id, "cell_ids": ["unknown"]}),
+        )
+        assert response.status_code == 404
+
+
 @pytest.mark.anyio
 @pytest.mark.parametrize("auth_mode", ("noauth",))
 @pytest.mark.parametrize("clear_users", (False,))
@@ -0,0 +1,59 @@
+import sys
+
+import anyio
+import pytest
+from fps import get_root_module, merge_config
+from httpx import AsyncClient
+
+CONFIG = {
+    "jupyverse": {
+        "type": "jupyverse",
+        "modules": {
+            "app": {
+                "type": "app",
+            },
+            "auth": {
+                "type": "auth",
+                "config": {
+                    "test": True,
+                    "mode": "noauth",
+                },
+            },
+            "frontend": {
+                "type": "frontend",
+            },
+            "terminals": {
+                "type": "terminals",
+            },
+        }
+    }
+}
+
+
+@pytest.mark.anyio
+@pytest.mark.skipif(sys.platform == "win32", reason="pty is not available on Windows")
+async def test_terminal_culling(unused_tcp_port):
+    url = f"http://127.0.0.1:{unused_tcp_port}"
+    config = merge_config(
+        CONFIG,
+        {
+            "jupyverse": {
+                "config": {"port": unused_tcp_port},
+                "modules": {
+                    "terminals": {
+                        "config": {"cull_inactive_timeout": 1, "cull_interval": 0.2},
+                    },
+                },
+            }
+        },
+    )
+    async with get_root_module(config), AsyncClient() as http:
+        response = await http.post(f"{url}/api/terminals")
+        name = response.json()["name"]
+        response = await http.get(f"{url}/api/terminals")
+        assert [terminal["name"] for terminal in response.json()] == [name]
+
+        # an inactive terminal is closed
+        with anyio.fail_after(10):
+            while (await http.get(f"{url}/api/terminals")).json():
+                await anyio.sleep(0.1)
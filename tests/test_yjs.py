@@ -0,0 +1,500 @@
+import json
+import os
+from pathlib import Path
+
+import anyio
+import pytest
+from anyio import create_memory_object_stream
+from fps import get_root_module, merge_config
+from fps_yjs.sharding import get_shard_index
+from fps_yjs.ydocs import ydocs
+from fps_yjs.ywebsocket import WebsocketProvider
+from fps_yjs.ywebsocket.yroom import ClientLimits, YRoom
+from httpx import AsyncClient
+from httpx_ws import aconnect_ws
+from pycrdt import (
+    Doc,
+    Text,
+    YMessageType,
+    YSyncMessageType,
+    create_sync_message,
+    create_update_message,
+    handle_sync_message,
+    write_message,
+)
+from utils import Websocket
+
+CONFIG = {
+    "jupyverse": {
+        "type": "jupyverse",
+        "modules": {
+            "app": {
+                "type": "app",
+            },
+            "auth": {
+                "type": "auth",
+                "config": {
+                    "test": True,
+                    "mode": "noauth",
+                },
+            },
+            "contents": {
+                "type": "contents",
+            },
+            "frontend": {
+                "type": "frontend",
+            },
+            "yjs": {
+                "type": "yjs",
+            },
+        }
+    }
+}
+
+
+@pytest.mark.anyio
+async def test_multiple_views(tmp_path, unused_tcp_port):
+    prev_dir = os.getcwd()
+    os.chdir(tmp_path)
+    nb = {
+        "cells": [
+            {
+                "cell_type": "markdown",
+                "id": "cell0",
+                "metadata": {},
+                "source": "# Hello",
+            },
+        ],
+        "metadata": {},
+        "nbformat": 4,
+        "nbformat_minor": 5,
+    }
+    path = "notebook.ipynb"
+    Path(path).write_text(json.dumps(nb))
+    url = f"http://127.0.0.1:{unused_tcp_port}"
+    config = merge_config(
+        CONFIG,
+        {
+            "jupyverse": {
+                "config": {"port": unused_tcp_port},
+                "modules": {"yjs": {"config": {"view_update_delay": 0.1}}},
+            }
+        },
+    )
+    try:
+        async with get_root_module(config) as root_module, AsyncClient() as http:
+            response = await http.put(
+                f"{url}/api/collaboration/session/{path}",
+                json={"format": "json", "type": "notebook"},
+            )
+            file_id = response.json()["fileId"]
+            notebook_id = f"json:notebook:{file_id}"
+            text_id = f"text:file:{file_id}"
+            ynb = ydocs["notebook"]()
+            ytext = ydocs["file"]()
+            async with aconnect_ws(
+                f"{url}/api/collaboration/room/{notebook_id}"
+            ) as websocket0, WebsocketProvider(
+                ynb.ydoc, Websocket(websocket0, notebook_id)
+            ), aconnect_ws(
+                f"{url}/api/collaboration/room/{text_id}"
+            ) as websocket1, WebsocketProvider(
+                ytext.ydoc, Websocket(websocket1, text_id)
+            ):
+                await anyio.sleep(0.5)
+                # the text view is derived from the notebook document
+                assert json.loads(ytext.source)["cells"][0]["source"] == "# Hello"
+                room_manager = root_module.modules["yjs"].yjs.room_manager
+                assert list(room_manager.file_documents[file_id]) == [notebook_id, text_id]
+                assert room_manager.websocket_server.rooms[text_id].ystore is None
+
+                # editing the text view updates the notebook document, which is saved
+                new_nb = json.loads(ytext.source)
+                new_nb["cells"][0]["source"] = "# Bye"
+                ytext.source = json.dumps(new_nb, indent=2)
+                await anyio.sleep(2)
+                assert ynb.get_cell(0)["source"] == "# Bye"
+                assert json.loads(Path(path).read_text())["cells"][0]["source"] == "# Bye"
+    finally:
+        os.chdir(prev_dir)
+
+
+@pytest.mark.anyio
+async def test_transient_room_lifetime(unused_tcp_port):
+    url = f"http://127.0.0.1:{unused_tcp_port}"
+    config = merge_config(CONFIG, {"jupyverse": {"config": {"port": unused_tcp_port}}})
+    async with get_root_module(config) as root_module:
+        room_manager = root_module.modules["yjs"].yjs.room_manager
+        rooms = room_manager.websocket_server.rooms
+
+        # an awareness room is deleted when its last client leaves
+        room_id = "JupyterLab:globalAwareness"
+        async with aconnect_ws(f"{url}/api/collaboration/room/{room_id}"):
+            await anyio.sleep(0.1)
+            assert room_id in rooms
+        await anyio.sleep(0.1)
+        assert room_id not in rooms
+
+        # a widget room is deleted when it is released by its owner and has no client
+        room_id = "ywidget:guid"
+        await room_manager.acquire_room(room_id, "comm_id")
+        async with aconnect_ws(f"{url}/api/collaboration/room/{room_id}"):
+            await anyio.sleep(0.1)
+        await anyio.sleep(0.1)
+        assert room_id in rooms
+        room_manager.release_room(room_id, "comm_id")
+        assert room_id not in rooms
+
+
+@pytest.mark.anyio
+async def test_room_released_while_joining(unused_tcp_port):
+    url = f"http://127.0.0.1:{unused_tcp_port}"
+    config = merge_config(CONFIG, {"jupyverse": {"config": {"port": unused_tcp_port}}})
+    async with get_root_module(config) as root_module:
+        room_manager = root_module.modules["yjs"].yjs.room_manager
+        websocket_server = room_manager.websocket_server
+        rooms = websocket_server.rooms
+        room_id = "ywidget:guid"
+        room = await room_manager.acquire_room(room_id, "comm_id")
+        serve = websocket_server.serve
+
+        async def serve_after_release(websocket, *args, **kwargs):
+            # the owner releases the room after it was resolved for the client
+            room_manager.release_room(room_id, "comm_id")
+            assert rooms.get(room_id) is room
+            await serve(websocket, *args, **kwargs)
+
+        websocket_server.serve = serve_after_release
+        async with aconnect_ws(f"{url}/api/collaboration/room/{room_id}"):
+            await anyio.sleep(0.1)
+            # the client joined the room it was resolved to
+            assert len(room.clients) == 1
+            assert rooms.get(room_id) is room
+        await anyio.sleep(0.1)
+        assert room_id not in rooms
+
+
+class MemoryWebsocket:
+    def __init__(self, path, send_stream, receive_stream):
+        self.path = path
+        self._send_stream = send_stream
+        self._receive_stream = receive_stream
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.recv()
+        except anyio.EndOfStream:
+            raise StopAsyncIteration()
+
+    async def send(self, message):
+        await self._send_stream.send(message)
+
+    async def recv(self):
+        return await self._receive_stream.receive()
+
+
+@pytest.mark.anyio
+async def test_viewer():
+    server_send_stream, client_receive_stream = create_memory_object_stream(16)
+    client_send_stream, server_receive_stream = create_memory_object_stream(16)
+    server_websocket = MemoryWebsocket("room", server_send_stream, server_receive_stream)
+    writer_send_stream, writer_receive_stream = create_memory_object_stream(16)
+    _, writer_server_receive_stream = create_memory_object_stream(16)
+    writer_websocket = MemoryWebsocket("room", writer_send_stream, writer_server_receive_stream)
+    room = YRoom(viewer_interval=0.2)
+    text = room.ydoc["text"] = Text("Hello")
+    async with room, anyio.create_task_group() as tg:
+        tg.start_soon(room.serve, writer_websocket)
+        message = await writer_receive_stream.receive()
+        assert message[:2] == bytes([YMessageType.SYNC, YSyncMessageType.SYNC_STEP1])
+        tg.start_soon(room.serve, server_websocket, True)
+        ydoc = Doc()
+        client_text = ydoc["text"] = Text()
+
+        # a viewer gets a snapshot of the document
+        message = await client_receive_stream.receive()
+        assert message[:2] == bytes([YMessageType.SYNC, YSyncMessageType.SYNC_STEP2])
+        handle_sync_message(message[1:], ydoc)
+        assert str(client_text) == "Hello"
+
+        # updates are batched
+        text += ","
+        text += " World!"
+        message = await client_receive_stream.receive()
+        handle_sync_message(message[1:], ydoc)
+        assert str(client_text) == "Hello, World!"
+
+        # a viewer cannot update the document
+        await client_send_stream.send(create_sync_message(ydoc))
+        client_text += " Bye!"
+        await client_send_stream.send(create_update_message(ydoc.get_update()))
+        await anyio.sleep(0.3)
+        assert str(text) == "Hello, World!"
+        assert client_receive_stream.statistics().current_buffer_used == 0
+
+        # the awareness of a viewer is forwarded to all clients
+        awareness_message = bytes([YMessageType.AWARENESS]) + write_message(b"viewer")
+        await client_send_stream.send(awareness_message)
+        assert await client_receive_stream.receive() == awareness_message
+        with anyio.fail_after(1):
+            while True:
+                # skip the document updates
+                message = await writer_receive_stream.receive()
+                if message[0] == YMessageType.AWARENESS:
+                    break
+        assert message == awareness_message
+
+        tg.cancel_scope.cancel()
+
+
+@pytest.mark.anyio
+async def test_sync_step2_cache():
+    room = YRoom()
+    text = room.ydoc["text"] = Text("Hello")
+    async with room, anyio.create_task_group() as tg:
+
+        async def join():
+            server_send_stream, client_receive_stream = create_memory_object_stream(16)
+            client_send_stream, server_receive_stream = create_memory_object_stream(16)
+            server_websocket = MemoryWebsocket("room", server_send_stream, server_receive_stream)
+            tg.start_soon(room.serve, server_websocket)
+            # the room sends its SYNC_STEP1 first
+            await client_receive_stream.receive()
+            # a client with an empty document gets the full state
+            await client_send_stream.send(create_sync_message(Doc()))
+            while True:
+                message = await client_receive_stream.receive()
+                if message[:2] == bytes([YMessageType.SYNC, YSyncMessageType.SYNC_STEP2]):
+                    return message
+
+        # the SYNC_STEP2 message is shared by the clients joining with an empty document
+        message0 = await join()
+        message1 = await join()
+        assert message1 is message0
+
+        # a document update invalidates it
+        text += ", World!"
+        message2 = await join()
+        assert message2 != message0
+        ydoc = Doc()
+        client_text = ydoc["text"] = Text()
+        handle_sync_message(message2[1:], ydoc)
+        assert str(client_text) == "Hello, World!"
+
+        tg.cancel_scope.cancel()
+
+
+@pytest.mark.anyio
+async def test_sharding(tmp_path, unused_tcp_port_factory):
+    prev_dir = os.getcwd()
+    os.chdir(tmp_path)
+    path = "file.txt"
+    Path(path).write_text("Hello")
+    ports = [unused_tcp_port_factory(), unused_tcp_port_factory()]
+    shard_urls = [f"http://127.0.0.1:{port}" for port in ports]
+    configs = [
+        merge_config(
+            CONFIG,
+            {
+                "jupyverse": {
+                    "config": {"port": port},
+                    "modules": {
+                        "yjs": {"config": {"shard_urls": shard_urls, "shard_index": shard_index}}
+                    },
+                }
+            },
+        )
+        for shard_index, port in enumerate(ports)
+    ]
+    try:
+        async with get_root_module(configs[0]) as root_module0, get_root_module(
+            configs[1]
+        ) as root_module1, AsyncClient() as http:
+            root_modules = [root_module0, root_module1]
+            response = await http.put(
+                f"{shard_urls[0]}/api/collaboration/session/{path}",
+                json={"format": "text", "type": "file"},
+            )
+            file_id = response.json()["fileId"]
+            room_id = f"text:file:{file_id}"
+            owner = get_shard_index(room_id, 2)
+            # connect to the instance that doesn't own the room
+            url = shard_urls[1 - owner]
+            ytext = ydocs["file"]()
+            async with aconnect_ws(
+                f"{url}/api/collaboration/room/{room_id}"
+            ) as websocket, WebsocketProvider(ytext.ydoc, Websocket(websocket, room_id)):
+                await anyio.sleep(0.5)
+                assert ytext.source == "Hello"
+                rooms = [
+                    root_module.modules["yjs"].yjs.room_manager.websocket_server.rooms
+                    for root_module in root_modules
+                ]
+                assert room_id in rooms[owner]
+                assert room_id not in rooms[1 - owner]
+
+                # the owner saves the file
+                ytext.source = "Bye"
+                await anyio.sleep(2)
+                assert Path(path).read_text() == "Bye"
+    finally:
+        os.chdir(prev_dir)
+
+
+@pytest.mark.anyio
+async def test_replication(tmp_path, unused_tcp_port_factory):
+    prev_dir = os.getcwd()
+    os.chdir(tmp_path)
+    path = "file.txt"
+    Path(path).write_text("Hello")
+    primary_port, replica_port = unused_tcp_port_factory(), unused_tcp_port_factory()
+    primary_url = f"http://127.0.0.1:{primary_port}"
+    replica_url = f"http://127.0.0.1:{replica_port}"
+    primary_config = merge_config(CONFIG, {"jupyverse": {"config": {"port": primary_port}}})
+    replica_config = merge_config(
+        CONFIG,
+        {
+            "jupyverse": {
+                "config": {"port": replica_port},
+                "modules": {
+                    "yjs": {
+                        "config": {
+                            "replication_url": primary_url,
+                            "replicated_rooms": ["text:file:*"],
+                        }
+                    }
+                },
+            }
+        },
+    )
+    try:
+        async with get_root_module(primary_config), get_root_module(
+            replica_config
+        ) as replica_module, AsyncClient() as http:
+            room_manager = replica_module.modules["yjs"].yjs.room_manager
+            response = await http.put(
+                f"{primary_url}/api/collaboration/session/{path}",
+                json={"format": "text", "type": "file"},
+            )
+            file_id = response.json()["fileId"]
+            room_id = f"text:file:{file_id}"
+            ytext0 = ydocs["file"]()
+            ytext1 = ydocs["file"]()
+            async with aconnect_ws(
+                f"{primary_url}/api/collaboration/room/{room_id}"
+            ) as websocket0, WebsocketProvider(
+                ytext0.ydoc, Websocket(websocket0, room_id)
+            ), aconnect_ws(
+                f"{replica_url}/api/collaboration/room/{room_id}"
+            ) as websocket1, WebsocketProvider(
+                ytext1.ydoc, Websocket(websocket1, room_id)
+            ):
+                await anyio.sleep(0.5)
+                assert ytext1.source == "Hello"
+
+                # changes on the primary are replicated
+                ytext0.source = "Bye"
+                await anyio.sleep(0.5)
+                assert ytext1.source == "Bye"
+
+                # a replica is read-only
+                ytext1.source = "Hello again"
+                await anyio.sleep(0.5)
+                assert ytext0.source == "Bye"
+
+            # a replica room is released when its last client leaves
+            await anyio.sleep(0.5)
+            assert room_id not in room_manager.replicators
+            assert room_id not in room_manager.websocket_server.rooms
+    finally:
+        os.chdir(prev_dir)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("action", ("drop", "disconnect"))
+async def test_client_limits(action):
+    server_send_stream, client_receive_stream = create_memory_object_stream(16)
+    client_send_stream, server_receive_stream = create_memory_object_stream(16)
+    server_websocket = MemoryWebsocket("room", server_send_stream, server_receive_stream)
+    room = YRoom(client_limits=ClientLimits(max_message_size=100, action=action))
+    text = room.ydoc["text"] = Text()
+    async with room, anyio.create_task_group() as tg:
+        served = anyio.Event()
+
+        async def serve():
+            await room.serve(server_websocket)
+            served.set()
+
+        tg.start_soon(serve)
+        ydoc = Doc()
+        client_text = ydoc["text"] = Text()
+        await client_receive_stream.receive()
+
+        # a message that is too big is not processed
+        client_text += "x" * 200
+        await client_send_stream.send(create_update_message(ydoc.get_update()))
+        await anyio.sleep(0.1)
+        assert str(text) == ""
+        if action == "drop":
+            assert room.metrics["messages_dropped"] == 1
+            assert not served.is_set()
+        else:
+            assert room.metrics["clients_disconnected"] == 1
+            assert served.is_set()
+            assert room.clients == []
+
+        tg.cancel_scope.cancel()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("limit", ("messages", "bytes"))
+async def test_client_rate_limits(limit):
+    server_send_stream, client_receive_stream = create_memory_object_stream(16)
+    client_send_stream, server_receive_stream = create_memory_object_stream(16)
+    server_websocket = MemoryWebsocket("room", server_send_stream, server_receive_stream)
+    if limit == "messages":
+        client_limits = ClientLimits(max_messages_per_second=2)
+    else:
+        client_limits = ClientLimits(max_bytes_per_second=100)
+    room = YRoom(client_limits=client_limits)
+    async with room, anyio.create_task_group() as tg:
+        tg.start_soon(room.serve, server_websocket)
+        await client_receive_stream.receive()
+
+        # a burst of up to one second's worth passes, the rest is dropped
+        message = bytes([YMessageType.AWARENESS]) + b"x" * 39
+        for _ in range(4):
+            await client_send_stream.send(message)
+        await anyio.sleep(0.1)
+        assert room.metrics["messages_received"] == 4
+        assert room.metrics["bytes_received"] == 160
+        assert room.metrics["messages_dropped"] == 2
+
+        # the bucket is refilled over time
+        await anyio.sleep(1)
+        await client_send_stream.send(message)
+        await anyio.sleep(0.1)
+        assert room.metrics["messages_dropped"] == 2
+
+        tg.cancel_scope.cancel()
+
+
+@pytest.mark.anyio
+async def test_room_metrics(unused_tcp_port):
+    url = f"http://127.0.0.1:{unused_tcp_port}"
+    config = merge_config(CONFIG, {"jupyverse": {"config": {"port": unused_tcp_port}}})
+    async with get_root_module(config), AsyncClient() as http:
+        room_id = "JupyterLab:globalAwareness"
+        async with aconnect_ws(f"{url}/api/collaboration/room/{room_id}") as websocket:
+            await websocket.send_bytes(create_sync_message(Doc()))
+            await anyio.sleep(0.1)
+            response = await http.get(f"{url}/api/collaboration/metrics")
+        assert response.status_code == 200
+        metrics = response.json()[room_id]
+        assert metrics["messages_received"] == 1
+        assert metrics["bytes_received"] > 0
+        assert metrics["messages_dropped"] == 0
+        assert metrics["clients_disconnected"] == 0